@@ -2,3 +2,4 @@ from app.api.auth import AuthRouter  # noqa
 from app.api.imports import ImportRouter  # noqa
 from app.api.library import LibraryRouter  # noqa
 from app.api.conversation import ConversationRouter  # noqa
+from app.api.jobs import JobRouter  # noqa
@@ -6,7 +6,6 @@ import logging
 from typing import Optional
 
 from fastapi import APIRouter, Depends, HTTPException
-import nltk
 from pydantic import BaseModel
 from sqlalchemy.orm import Session
 
@@ -18,7 +17,12 @@ from app.index.llm import (
     extract_ids_from_llm_response,
     generate_query_variants,
 )
-from app.index.retrieval import retrieve_candidate_chunks
+from app.index.preprocessing import split_sentences
+from app.index.retrieval import (
+    normalise_query,
+    pack_context,
+    retrieve_candidate_chunks_for_queries,
+)
 from app.schemas import MessageRoles
 
 ConversationRouter = APIRouter()
@@ -339,7 +343,7 @@ def complete_conversation(
             )
 
         if conversation.name is None:
-            name = nltk.sent_tokenize(query)[0]
+            name = split_sentences(query)[0]
             conversation = operations.add_conversation_name(
                 db, user_id, conversation_id, name
             )
@@ -347,34 +351,37 @@ def complete_conversation(
         generated_queries = generate_query_variants(query, max_variants=3)
         # Add query variants and original query
         generated_queries = generated_queries + [query]
+        # Drop repeated variants so each distinct query is searched once
+        generated_queries = list(
+            {normalise_query(q): q for q in generated_queries}.values()
+        )
         logger.info(f"Generated queries: {generated_queries}")
 
-        # We could make this batch
-        candidates = []
-
-        # Need to remove duplicate text
-        referenced_chunks = set()
-        for q in generated_queries:
-            candidates_and_scores = retrieve_candidate_chunks(
-                db, user_id, query, topk=5, threshold=THRESHOLD_SCORE
-            )
-            for result in candidates_and_scores:
-                if result.chunk_content in referenced_chunks:
-                    continue
-                referenced_chunks.add(result.chunk_content)
-                candidates.append(result)
-
-            # Log candidates
+        # Search for every variant at once and fuse the rankings
+        per_query, fused = retrieve_candidate_chunks_for_queries(
+            db, user_id, generated_queries, topk=5, threshold=THRESHOLD_SCORE
+        )
+        for q, candidates_and_scores in zip(generated_queries, per_query):
             for result in candidates_and_scores:
                 logger.info(
                     f"Found candidate: ({result.chunk_content}, {result.score})"
                     f" from ({result.source_id}) for query: {q}"
                 )
 
-        # Extract context as list of Tuples with (source_id, chunk_text)
+        # Need to remove duplicate text
+        candidates = []
+        referenced_chunks = set()
+        for result in fused:
+            if result.chunk_content in referenced_chunks:
+                continue
+            referenced_chunks.add(result.chunk_content)
+            candidates.append(result)
+
+        # Extract context as list of Tuples with (source_id, chunk_text),
+        # keeping the best candidates that fit the context budget
         llm_context = [
             {"id": str(result.source_id), "text": result.chunk_content}
-            for result in candidates
+            for result in pack_context(candidates, ranked=True)
         ]
         response = answer_question(query, llm_context)
         logger.info(f"Response to question: {response}")
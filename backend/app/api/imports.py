@@ -10,6 +10,7 @@ Endpoints for importing new content into a user's knowledge base.
 import os
 import logging
 import tempfile
+from typing import Optional
 
 from fastapi import APIRouter, UploadFile, HTTPException, Depends
 from pydantic import BaseModel
@@ -31,7 +32,23 @@ class ImportResponse(BaseModel):
     total_documents: int
     total_clips: int
     new_clip_inserts: int
-    embedding_index_job_id: str = "6d032281-9e69-4753-a455-b48f7cb9b5c1"
+    # None when there were no new clips to index
+    embedding_index_job_id: Optional[str] = None
+
+
+def queue_index_job(
+    db: Session, user_id: str, clip_ids: list
+) -> Optional[str]:
+    """
+    Queues new clips to be chunked and embedded by an index worker and
+    returns the job id.
+    """
+    if not clip_ids:
+        return None
+
+    job = operations.create_index_job(db, user_id, clip_ids)
+    logger.info(f"Queued index job {job.id} for {len(clip_ids)} clips")
+    return str(job.id)
 
 
 @ImportRouter.post("/document/upload/readwise")
@@ -102,6 +119,7 @@ async def import_book_annotations_from_readwise(
 
         total_clips = 0
         new_inserts = 0
+        new_clip_ids = []
         for doc in documents:
             all_clips = []
             annotations = contents[(doc.title, doc.authors)]
@@ -122,15 +140,15 @@ async def import_book_annotations_from_readwise(
             all_clips.extend(doc_clips)
             successful_inserts = operations.insert_clips(db, all_clips)
             new_inserts += len(successful_inserts)
+            new_clip_ids.extend(clip.id for clip in successful_inserts)
 
-        # Run a background job to generate embeddings
-        # TODO: Do we do this for all annotations at once?
-        # Want to pass the job id to frontend to check status
-        # Add callback?
+        # Index workers chunk and embed the new clips in the background
+        job_id = queue_index_job(db, user_id, new_clip_ids)
         return ImportResponse(
             total_documents=len(contents),
             total_clips=total_clips,
             new_clip_inserts=new_inserts,
+            embedding_index_job_id=job_id,
         )
 
     except Exception as err:
@@ -152,7 +170,6 @@ async def import_kindle_annotations(
     and add those to the database.
 
     TODO: Handle repeated uploads by the same user.
-    TODO: Run a background job for embeddings
     """
     # Error if don't receive text kindle_file
     # Note that the kindle_file has to be submitted as part of a multipart form
@@ -239,14 +256,15 @@ async def import_kindle_annotations(
         successful_inserts = operations.insert_clips(db, all_clips)
         n_new_annos = len(successful_inserts)
 
-        # Run a background job to generate embeddings
-        # TODO: Do we do this for all annotations at once?
-        # Want to pass the job id to frontend to check status
-        # Add callback?
+        # Index workers chunk and embed the new clips in the background
+        job_id = queue_index_job(
+            db, user_id, [clip.id for clip in successful_inserts]
+        )
         return ImportResponse(
             total_documents=len(contents),
             total_clips=len(all_clips),
             new_clip_inserts=n_new_annos,
+            embedding_index_job_id=job_id,
         )
 
     except Exception as err:
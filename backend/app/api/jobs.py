@@ -0,0 +1,50 @@
+"""
+Endpoints for checking on background jobs.
+"""
+
+from datetime import datetime
+import logging
+from typing import Optional
+from uuid import UUID
+
+from fastapi import APIRouter, Depends, HTTPException
+from pydantic import BaseModel, ConfigDict
+from sqlalchemy.orm import Session
+
+from app.api.auth import get_current_user
+from app.db import get_db, operations
+
+JobRouter = APIRouter()
+logger = logging.getLogger(__name__)
+
+
+class JobStatus(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: UUID
+    status: str
+    total: int
+    processed: int
+    error: Optional[str]
+    attempts: int
+    retry_at: Optional[datetime]
+    created_at: datetime
+    started_at: Optional[datetime]
+    finished_at: Optional[datetime]
+
+
+@JobRouter.get("/jobs/{job_id}")
+def get_job_status(
+    job_id: str,
+    user_id: str = Depends(get_current_user),
+    db: Session = Depends(get_db),
+) -> JobStatus:
+    """
+    Returns the status and progress of one of the user's indexing jobs.
+    """
+    job = operations.get_user_index_job(db, user_id, job_id)
+    if not job:
+        raise HTTPException(
+            status_code=404, detail=f"Job with id {job_id} not found"
+        )
+    return JobStatus.model_validate(job)
@@ -279,60 +279,54 @@ def get_similar_clips(
     clip_id: str,
     topk: int = 5,
     threshold: float = 0.5,
+    aggregation: str = "mean",
     user_id: str = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
     """
     Get semantically similar documents to a given document based on the
-    content and return up to topk similar documents.
+    content and return up to topk similar documents, best match first.
+    A clip's score is the min or mean distance of its matching chunks, and
+    clips scoring above threshold are left out. A threshold of 0 keeps all.
     """
+    if aggregation not in ("min", "mean"):
+        raise HTTPException(
+            status_code=400, detail="Aggregation must be min or mean."
+        )
+
     if not operations.get_user_clip_by_id(db, user_id, clip_id):
-        return HTTPException(
+        raise HTTPException(
             status_code=404,
             detail=(
                 f"Clip with {clip_id=} " f"belonging to {user_id=} not found.",
             ),
         )
 
-    similar_document_ids = retrieval.get_similar_user_clips(
-        db, user_id, clip_id, topk=topk
+    similar_clips = retrieval.get_similar_user_clips(
+        db,
+        user_id,
+        clip_id,
+        topk=topk,
+        aggregation=aggregation,
+        threshold=threshold or None,
     )
-
-    output = []
-    for clip_id, score in similar_document_ids:
-        document = operations.get_user_clip_by_id(db, user_id, clip_id)
-        if not document:
-            logger.error(f"Document with id {clip_id} not found in database.")
-            continue
-
-        book = operations.get_user_book_by_id(
-            db, user_id, str(document.document_id)
-        )
-
-        if not book:
-            logger.error(
-                f"No book with id {document.document_id} associated "
-                f"with clip {clip_id}."
-            )
-            continue
-
-        output.append(
-            {
-                "id": document.id,
-                "title": book.title,
-                "authors": book.authors,
-                "created_at": document.created_at,
-                "updated_at": document.updated_at,
-                "content": document.content,
-                "is_clip": True,
-                "location_type": document.location_type,
-                "clip_start": document.clip_start,
-                "clip_end": document.clip_end,
-                "catalogue_id": book.catalogue_id,
-                "score": score,
-            }
-        )
-    return output
+    return [
+        {
+            "id": clip.id,
+            "title": book.title,
+            "authors": book.authors,
+            "created_at": clip.created_at,
+            "updated_at": clip.updated_at,
+            "content": clip.content,
+            "is_clip": True,
+            "location_type": clip.location_type,
+            "clip_start": clip.clip_start,
+            "clip_end": clip.clip_end,
+            "catalogue_id": book.catalogue_id,
+            "score": score,
+        }
+        for clip, book, score in similar_clips
+    ]
 
 
 class AnswerPayload(BaseModel):
@@ -455,6 +449,8 @@ def update_clip_content(
         clip = operations.update_clip_content(
             db, user_id, clip_id, new_content
         )
+        # Re-chunk and re-embed the edited clip in the background
+        operations.create_index_job(db, user_id, [clip.id])
     except ValueError:
         return HTTPException(
             status_code=400,
@@ -9,17 +9,132 @@ DB_USERNAME = os.getenv("DB_USERNAME")
 DB_NAME = os.getenv("DB_NAME")
 DB_HOST = os.getenv("DB_HOST")
 DB_PORT = int(os.getenv("DB_PORT", 5432))
+# Point the OpenAI clients at another server, e.g. scripts/mock_openai_server
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
 QUERY_DECOMPOSITION_MODEL = os.getenv("QUERY_DECOMPOSITION_MODEL")
 ANSWER_MODEL = os.getenv("ANSWER_MODEL")
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL")
+# Set while migrating embeddings from a previous model to EMBEDDING_MODEL.
+# Retrieval reads from both until scripts/migrate_embeddings.py cuts over.
+# Both models must produce EMBEDDING_DIMENSIONS sized embeddings.
+EMBEDDING_PREVIOUS_MODEL = os.getenv("EMBEDDING_PREVIOUS_MODEL") or None
+# "openai" or "local" to run a sentence-transformers model on CPU, which
+# needs the packages in requirements-local.txt
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "openai")
 EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", 1536))
+# Compressed copy of embeddings used for the first pass of vector search,
+# either "full" (no copy), "halfvec" or "binary". The first pass over fetches
+# EMBEDDING_RERANK_FACTOR * topk candidates which are then rescored with the
+# full precision vectors. Changing this requires recreating the embeddings
+# table.
+EMBEDDING_STORAGE = os.getenv("EMBEDDING_STORAGE", "full")
+EMBEDDING_RERANK_FACTOR = int(os.getenv("EMBEDDING_RERANK_FACTOR", 4))
+# Matryoshka models (text-embedding-3) can be shortened by keeping the first
+# dimensions. When set, a normalised copy of the first
+# EMBEDDING_SEARCH_DIMENSIONS of each embedding is stored for searching.
+# Must be less than EMBEDDING_DIMENSIONS.
+EMBEDDING_SEARCH_DIMENSIONS = int(os.getenv("EMBEDDING_SEARCH_DIMENSIONS", 0))
+# "exact", "compressed" or "matryoshka". Compressed and matryoshka search a
+# smaller copy of the embeddings first then rerank with the full vector.
+RETRIEVAL_MODE = os.getenv(
+    "RETRIEVAL_MODE", "exact" if EMBEDDING_STORAGE == "full" else "compressed"
+)
+# The shortened copy only exists when EMBEDDING_SEARCH_DIMENSIONS is set, so
+# fail on startup rather than on every search
+if RETRIEVAL_MODE == "matryoshka" and not (
+    0 < EMBEDDING_SEARCH_DIMENSIONS < EMBEDDING_DIMENSIONS
+):
+    raise ValueError(
+        "RETRIEVAL_MODE=matryoshka needs EMBEDDING_SEARCH_DIMENSIONS between "
+        f"1 and EMBEDDING_DIMENSIONS - 1, got {EMBEDDING_SEARCH_DIMENSIONS}"
+    )
+# Approximate nearest neighbour index on the copy of the vectors searched
+# first, built with scripts.build_vector_index: "hnsw", "ivfflat" or "none".
+VECTOR_INDEX_TYPE = os.getenv("VECTOR_INDEX_TYPE", "hnsw")
+VECTOR_INDEX_HNSW_M = int(os.getenv("VECTOR_INDEX_HNSW_M", 16))
+VECTOR_INDEX_HNSW_EF_CONSTRUCTION = int(
+    os.getenv("VECTOR_INDEX_HNSW_EF_CONSTRUCTION", 64)
+)
+# 0 picks rows / 1000 lists, or sqrt(rows) above a million rows
+VECTOR_INDEX_IVFFLAT_LISTS = int(os.getenv("VECTOR_INDEX_IVFFLAT_LISTS", 0))
+# Candidates explored per search, trading latency for recall. 0 keeps the
+# postgres defaults (hnsw.ef_search 40, ivfflat.probes 1).
+VECTOR_SEARCH_EF_SEARCH = int(os.getenv("VECTOR_SEARCH_EF_SEARCH", 0))
+VECTOR_SEARCH_PROBES = int(os.getenv("VECTOR_SEARCH_PROBES", 0))
+# The vector index holds every user's vectors and the user filter is only
+# checked on the rows it returns. Users with fewer chunks than this, or too
+# small a share of the vectors for the index to find enough of their chunks
+# within its scan budget, are searched exactly.
+VECTOR_SEARCH_EXACT_THRESHOLD = int(
+    os.getenv("VECTOR_SEARCH_EXACT_THRESHOLD", 20000)
+)
+# Needs pgvector 0.8+, where the index keeps scanning until enough rows pass
+# the user filter: "relaxed_order", "strict_order" or "off". Older versions
+# reject the setting so it is off by default.
+VECTOR_SEARCH_ITERATIVE_SCAN = os.getenv(
+    "VECTOR_SEARCH_ITERATIVE_SCAN", "off"
+)
+# Most index rows an iterative scan visits (hnsw.max_scan_tuples)
+VECTOR_SEARCH_MAX_SCAN_TUPLES = int(
+    os.getenv("VECTOR_SEARCH_MAX_SCAN_TUPLES", 20000)
+)
+# Per request limits when batching inputs to the embeddings endpoint
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 1024))
+EMBEDDING_BATCH_MAX_TOKENS = int(
+    os.getenv("EMBEDDING_BATCH_MAX_TOKENS", 250000)
+)
+# How slices of text longer than the model's context are combined, either
+# "mean" (weighted by token count) or "max"
+EMBEDDING_LONG_AGGREGATION = os.getenv("EMBEDDING_LONG_AGGREGATION", "mean")
+# Concurrency and account quota for the async embedder
+EMBEDDING_MAX_CONCURRENCY = int(os.getenv("EMBEDDING_MAX_CONCURRENCY", 8))
+EMBEDDING_REQUESTS_PER_MINUTE = int(
+    os.getenv("EMBEDDING_REQUESTS_PER_MINUTE", 3000)
+)
+EMBEDDING_TOKENS_PER_MINUTE = int(
+    os.getenv("EMBEDDING_TOKENS_PER_MINUTE", 1000000)
+)
+EMBEDDING_MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES", 6))
+# Index jobs are retried after a failure, or a worker dying mid job, until
+# they have been tried this many times. Retries wait
+# INDEX_JOB_RETRY_DELAY seconds, doubling after each attempt.
+INDEX_JOB_MAX_ATTEMPTS = int(os.getenv("INDEX_JOB_MAX_ATTEMPTS", 5))
+INDEX_JOB_RETRY_DELAY = float(os.getenv("INDEX_JOB_RETRY_DELAY", 30))
+# Local embedding model settings
+LOCAL_EMBEDDING_BATCH_SIZE = int(os.getenv("LOCAL_EMBEDDING_BATCH_SIZE", 32))
+LOCAL_EMBEDDING_WORKERS = int(os.getenv("LOCAL_EMBEDDING_WORKERS", 1))
+LOCAL_EMBEDDING_RUNTIME = os.getenv("LOCAL_EMBEDDING_RUNTIME", "torch")
+LOCAL_EMBEDDING_ONNX_FILE = os.getenv("LOCAL_EMBEDDING_ONNX_FILE") or None
+# Query embeddings cached in the retrieval path and for how long (seconds)
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", 1000))
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", 3600))
+# Number of embeddings held in memory. Set to 0 to only use the database.
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", 10000))
+EMBEDDING_CACHE_PERSISTENT = (
+    os.getenv("EMBEDDING_CACHE_PERSISTENT", "true").lower() == "true"
+)
+# "copy" streams embeddings into postgres with COPY, "insert" uses multi-row
+# INSERT statements of EMBEDDING_WRITE_BATCH_SIZE rows.
+EMBEDDING_WRITE_METHOD = os.getenv("EMBEDDING_WRITE_METHOD", "copy")
+EMBEDDING_WRITE_BATCH_SIZE = int(os.getenv("EMBEDDING_WRITE_BATCH_SIZE", 1000))
 CHUNKING_STRATEGY = (
     os.getenv("CHUNKING_STRATEGY", "")
     if os.getenv("CHUNKING_STRATEGY")
     else None
 )
 THRESHOLD_SCORE = float(os.getenv("THRESHOLD_SCORE", 0.6))
+# Most tokens of retrieved chunks put into the context of an answer
+LLM_CONTEXT_MAX_TOKENS = int(os.getenv("LLM_CONTEXT_MAX_TOKENS", 6000))
+# Similar clips precomputed for each clip. Requests for more are searched.
+CLIP_NEIGHBOURS_COUNT = int(os.getenv("CLIP_NEIGHBOURS_COUNT", 20))
 AUTHOR_SEPARATOR = os.getenv("AUTHOR_SEPARATOR", ";")
 MIN_CHUNK_SIZE = int(os.getenv("MIN_CHUNK_SIZE", 20))
+# "punkt" uses nltk's Punkt model, "rules" a faster regular expression
+# splitter that needs no model.
+SENTENCE_SPLITTER = os.getenv("SENTENCE_SPLITTER", "punkt")
+# Where the Punkt model is stored. It is downloaded once if missing.
+NLTK_DATA_DIR = os.getenv("NLTK_DATA_DIR", "nltk_data")
+# Processes used to chunk large imports
+CHUNKING_WORKERS = int(os.getenv("CHUNKING_WORKERS", os.cpu_count() or 1))
 TOKEN_ALGORITHM = os.getenv("TOKEN_ALGORITHM", "HS256")
 TOKEN_SECRET_KEY = os.getenv("TOKEN_SECRET_KEY")
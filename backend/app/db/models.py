@@ -4,23 +4,31 @@ from datetime import datetime
 
 # See pgvector.sqlalchemy support
 # https://github.com/pgvector/pgvector-python?tab=readme-ov-file#sqlalchemy
-from pgvector.sqlalchemy import Vector
+from pgvector.sqlalchemy import BIT, HALFVEC, Vector
 
 # See https://fastapi-utils.davidmontague.xyz/user-guide/basics/guid-type/
 from sqlalchemy import (
     Boolean,
+    Computed,
+    Float,
     ForeignKey,
+    ForeignKeyConstraint,
+    Index,
     Integer,
     String,
     DateTime,
     UniqueConstraint,
     text,
 )
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.dialects.postgresql import ARRAY, UUID
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 from sqlalchemy.sql import func
 
-from app.config import EMBEDDING_DIMENSIONS
+from app.config import (
+    EMBEDDING_DIMENSIONS,
+    EMBEDDING_SEARCH_DIMENSIONS,
+    EMBEDDING_STORAGE,
+)
 
 
 class Base(DeclarativeBase):
@@ -258,6 +266,18 @@ class Comment(Base):
 class Embedding(Base):
 
     __tablename__ = "document_embeddings"
+    __table_args__ = (
+        Index(
+            "ix_document_embeddings_user_model", "user_id", "embedding_model"
+        ),
+        # A vector cannot be deleted while a chunk still points at it
+        ForeignKeyConstraint(
+            ["chunk_hash", "embedding_model"],
+            ["chunk_vector.chunk_hash", "chunk_vector.embedding_model"],
+            ondelete="RESTRICT",
+            name="fk_document_embeddings_chunk_vector",
+        ),
+    )
 
     id: Mapped[uuid.UUID] = mapped_column(
         UUID,
@@ -270,14 +290,289 @@ class Embedding(Base):
     source_id: Mapped[uuid.UUID] = mapped_column(
         UUID, ForeignKey("clip.id", ondelete="CASCADE"), nullable=False
     )
+    # Owner of the source clip, copied onto each chunk so searches filter
+    # on it without joining the clip table. Clips never change owner.
+    user_id: Mapped[uuid.UUID] = mapped_column(
+        UUID, ForeignKey("user.id", ondelete="CASCADE"), nullable=False
+    )
 
     chunk_content: Mapped[str] = mapped_column(String, nullable=False)
     cleaned_chunk: Mapped[str] = mapped_column(String, nullable=True)
     chunking_strategy: Mapped[str] = mapped_column(String, nullable=True)
+    # Model that produced the embedding. Embeddings from before models were
+    # recorded are null.
+    embedding_model: Mapped[str] = mapped_column(String, nullable=True)
+    embedding_dimensions: Mapped[int] = mapped_column(Integer, nullable=True)
+    # Content hash of the clip when it was chunked. Chunks are stale once
+    # this no longer matches clip.content_hash.
+    source_hash: Mapped[str] = mapped_column(String(32), nullable=True)
+    # The vector lives in chunk_vector, shared by every chunk with the same
+    # text, and is looked up with the chunk hash and embedding model.
+    chunk_hash: Mapped[str] = mapped_column(
+        String(32), nullable=False, index=True
+    )
+    # Tokens in the chunk, counted once when it was chunked
+    token_count: Mapped[int] = mapped_column(Integer, nullable=True)
+
+    # A chunk can have an embedding from each model while migrating
+    UniqueConstraint(
+        source_id, chunk_content, embedding_model, name="unique_embedding"
+    )
+
+    def __repr__(self) -> str:
+        cols = ", ".join(
+            [
+                f"{k}={v}"
+                for k, v in self.__dict__.items()
+                if k != "_sa_instance_state"
+            ]
+        )
+        return f"{self.__class__.__name__}({cols})"
+
+
+class ChunkVector(Base):
+    """
+    Content addressed store of chunk embeddings. Chunks with the same text,
+    from any clip or user, share one vector per model so storage and
+    embedding cost grow with unique text rather than total highlights.
+    """
+
+    __tablename__ = "chunk_vector"
+
+    chunk_hash: Mapped[str] = mapped_column(String(32), primary_key=True)
+    embedding_model: Mapped[str] = mapped_column(String, primary_key=True)
+    embedding_dimensions: Mapped[int] = mapped_column(Integer, nullable=True)
     embedding = mapped_column(Vector(EMBEDDING_DIMENSIONS), nullable=False)
 
-    # Assuming you have same embedder for all embeddings
-    UniqueConstraint(source_id, chunk_content, name="unique_embedding")
+    # Compact copy of the embedding kept in sync by postgres and used for
+    # the first pass of vector search before rescoring with the full vector.
+    if EMBEDDING_STORAGE == "halfvec":
+        embedding_compressed = mapped_column(
+            HALFVEC(EMBEDDING_DIMENSIONS),
+            Computed(
+                f"embedding::halfvec({EMBEDDING_DIMENSIONS})", persisted=True
+            ),
+        )
+    elif EMBEDDING_STORAGE == "binary":
+        embedding_compressed = mapped_column(
+            BIT(EMBEDDING_DIMENSIONS),
+            Computed(
+                f"binary_quantize(embedding)::bit({EMBEDDING_DIMENSIONS})",
+                persisted=True,
+            ),
+        )
+
+    # Shortened and renormalised copy of a matryoshka embedding
+    if EMBEDDING_SEARCH_DIMENSIONS:
+        embedding_short = mapped_column(
+            Vector(EMBEDDING_SEARCH_DIMENSIONS),
+            Computed(
+                "l2_normalize(subvector(embedding, 1, "
+                f"{EMBEDDING_SEARCH_DIMENSIONS}))"
+                f"::vector({EMBEDDING_SEARCH_DIMENSIONS})",
+                persisted=True,
+            ),
+        )
+
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=False, server_default=func.now()
+    )
+
+    def __repr__(self) -> str:
+        cols = ", ".join(
+            [
+                f"{k}={v}"
+                for k, v in self.__dict__.items()
+                if k != "_sa_instance_state"
+            ]
+        )
+        return f"{self.__class__.__name__}({cols})"
+
+
+class EmbeddingCacheEntry(Base):
+    """
+    Content addressed store of embeddings. Rows are keyed on the model,
+    its output dimensions and the hash of the preprocessed text so the
+    same text is only ever embedded once per model.
+    """
+
+    __tablename__ = "embedding_cache"
+
+    model_name: Mapped[str] = mapped_column(String, primary_key=True)
+    dimensions: Mapped[int] = mapped_column(Integer, primary_key=True)
+    content_hash: Mapped[str] = mapped_column(String(32), primary_key=True)
+    # Dimensions vary by model so the column is not fixed in size
+    embedding = mapped_column(Vector(), nullable=False)
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=False, default=func.now()
+    )
+
+    def __repr__(self) -> str:
+        cols = ", ".join(
+            [
+                f"{k}={v}"
+                for k, v in self.__dict__.items()
+                if k != "_sa_instance_state"
+            ]
+        )
+        return f"{self.__class__.__name__}({cols})"
+
+
+class IndexJob(Base):
+    """
+    Queue of clips waiting to be chunked and embedded. Workers claim queued
+    jobs and record their progress as they go.
+    """
+
+    __tablename__ = "index_job"
+
+    id: Mapped[uuid.UUID] = mapped_column(
+        UUID,
+        primary_key=True,
+        nullable=False,
+        unique=True,
+        server_default=text("uuid_generate_v4()"),
+    )
+    user_id: Mapped[uuid.UUID] = mapped_column(
+        UUID, ForeignKey("user.id", ondelete="CASCADE"), nullable=False
+    )
+    # queued, running, completed or failed
+    status: Mapped[str] = mapped_column(
+        String, nullable=False, default="queued", index=True
+    )
+    clip_ids: Mapped[list[uuid.UUID]] = mapped_column(
+        ARRAY(UUID), nullable=False
+    )
+    total: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    processed: Mapped[int] = mapped_column(
+        Integer, nullable=False, default=0
+    )
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    error: Mapped[str] = mapped_column(String, nullable=True)
+    # A queued job that failed is not claimed again before this time
+    retry_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=True
+    )
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=False, default=func.now()
+    )
+    updated_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=False, default=func.now()
+    )
+    started_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=True
+    )
+    finished_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=True
+    )
+
+    def __repr__(self) -> str:
+        cols = ", ".join(
+            [
+                f"{k}={v}"
+                for k, v in self.__dict__.items()
+                if k != "_sa_instance_state"
+            ]
+        )
+        return f"{self.__class__.__name__}({cols})"
+
+
+class ReindexCheckpoint(Base):
+    """
+    Progress of one shard of a reindex run. Clips are split into shards by
+    a hash of their id and each shard is indexed in id order, so a run that
+    stops can resume after last_clip_id.
+    """
+
+    __tablename__ = "reindex_checkpoint"
+
+    run_id: Mapped[str] = mapped_column(String, primary_key=True)
+    shard: Mapped[int] = mapped_column(Integer, primary_key=True)
+    shards: Mapped[int] = mapped_column(Integer, nullable=False)
+    # Users being reindexed, or null for every user
+    user_ids: Mapped[list[uuid.UUID]] = mapped_column(
+        ARRAY(UUID), nullable=True
+    )
+    # queued, running, completed or failed
+    status: Mapped[str] = mapped_column(
+        String, nullable=False, default="queued"
+    )
+    last_clip_id: Mapped[uuid.UUID] = mapped_column(UUID, nullable=True)
+    total: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    processed: Mapped[int] = mapped_column(
+        Integer, nullable=False, default=0
+    )
+    error: Mapped[str] = mapped_column(String, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=False, default=func.now()
+    )
+    updated_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=False, default=func.now()
+    )
+
+    def __repr__(self) -> str:
+        cols = ", ".join(
+            [
+                f"{k}={v}"
+                for k, v in self.__dict__.items()
+                if k != "_sa_instance_state"
+            ]
+        )
+        return f"{self.__class__.__name__}({cols})"
+
+
+class ClipNeighbour(Base):
+    """
+    Precomputed most similar clips of each clip, ranked from 1 with their
+    mean cosine distance, so similar clips can be browsed without a vector
+    search.
+    """
+
+    __tablename__ = "clip_neighbours"
+
+    clip_id: Mapped[uuid.UUID] = mapped_column(
+        UUID, ForeignKey("clip.id", ondelete="CASCADE"), primary_key=True
+    )
+    neighbour_id: Mapped[uuid.UUID] = mapped_column(
+        UUID,
+        ForeignKey("clip.id", ondelete="CASCADE"),
+        primary_key=True,
+        index=True,
+    )
+    rank: Mapped[int] = mapped_column(Integer, nullable=False)
+    score: Mapped[float] = mapped_column(Float, nullable=False)
+
+    def __repr__(self) -> str:
+        cols = ", ".join(
+            [
+                f"{k}={v}"
+                for k, v in self.__dict__.items()
+                if k != "_sa_instance_state"
+            ]
+        )
+        return f"{self.__class__.__name__}({cols})"
+
+
+class ClipNeighbourStatus(Base):
+    """
+    When each clip's neighbours were computed. A list is out of date when
+    the clip's content or the embedding model has changed since, or when it
+    is marked stale because a clip in it was edited or deleted.
+    """
+
+    __tablename__ = "clip_neighbour_status"
+
+    clip_id: Mapped[uuid.UUID] = mapped_column(
+        UUID, ForeignKey("clip.id", ondelete="CASCADE"), primary_key=True
+    )
+    content_hash: Mapped[str] = mapped_column(String(32), nullable=False)
+    embedding_model: Mapped[str] = mapped_column(String, nullable=False)
+    stale: Mapped[bool] = mapped_column(
+        Boolean, nullable=False, default=False, index=True
+    )
+    built_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=False, default=func.now()
+    )
 
     def __repr__(self) -> str:
         cols = ", ".join(
@@ -1,13 +1,46 @@
+from datetime import datetime, timedelta, timezone
+import io
+import math
 from typing import Optional, Tuple
 import uuid
 
 # import numpy as np
-from sqlalchemy import func, select, Row, delete
-from sqlalchemy.dialects.postgresql import insert
+from pgvector.sqlalchemy import HALFVEC, Vector
+from sqlalchemy import (
+    String,
+    and_,
+    cast,
+    delete,
+    exists,
+    func,
+    or_,
+    select,
+    text,
+    true,
+    tuple_,
+    update,
+    Row,
+)
+from sqlalchemy.dialects.postgresql import ARRAY, insert
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
-from sqlalchemy.orm import Session
-
+from sqlalchemy.orm import Session, aliased
+
+from app.config import (
+    EMBEDDING_DIMENSIONS,
+    EMBEDDING_RERANK_FACTOR,
+    EMBEDDING_SEARCH_DIMENSIONS,
+    EMBEDDING_STORAGE,
+    EMBEDDING_WRITE_BATCH_SIZE,
+    EMBEDDING_WRITE_METHOD,
+    INDEX_JOB_MAX_ATTEMPTS,
+    VECTOR_SEARCH_EF_SEARCH,
+    VECTOR_SEARCH_EXACT_THRESHOLD,
+    VECTOR_SEARCH_ITERATIVE_SCAN,
+    VECTOR_SEARCH_MAX_SCAN_TUPLES,
+    VECTOR_SEARCH_PROBES,
+)
 from app.db import models
+from app.utils import hash_content
 
 
 def get_user(db: Session, user_id: str) -> models.User | None:
@@ -122,7 +155,11 @@ def get_user_book_by_id(
 
 def delete_user_book(db: Session, user_id: str, book_id: str) -> None:
     """This will delete a book and all associated clips and embeddings"""
+    book_clips = select(models.Clip.id).where(
+        models.Clip.document_id == book_id, models.Clip.user_id == user_id
+    )
     try:
+        db.execute(_stale_neighbour_lists(book_clips))
         statement = (
             delete(models.Book)
             .where(models.Book.id == book_id)
@@ -406,205 +443,1538 @@ def insert_embedding(
     return embedding
 
 
-def insert_embeddings(
+# Columns written for each chunk and each shared chunk vector, with their
+# types for the COPY staging tables. The remaining columns are generated.
+EMBEDDING_COLUMNS = {
+    "source_id": "uuid",
+    "user_id": "uuid",
+    "chunk_content": "varchar",
+    "cleaned_chunk": "varchar",
+    "chunking_strategy": "varchar",
+    "embedding_model": "varchar",
+    "embedding_dimensions": "integer",
+    "source_hash": "varchar(32)",
+    "chunk_hash": "varchar(32)",
+    "token_count": "integer",
+}
+CHUNK_VECTOR_COLUMNS = {
+    "chunk_hash": "varchar(32)",
+    "embedding_model": "varchar",
+    "embedding_dimensions": "integer",
+    "embedding": "vector",
+}
+
+
+def _row_values(row, columns: dict[str, str]) -> dict:
+    return {column: getattr(row, column) for column in columns}
+
+
+def _vector_literal(vector) -> str:
+    """Text representation of a vector understood by pgvector."""
+    return "[" + ",".join(str(float(x)) for x in vector) + "]"
+
+
+def _csv_field(value, column_type: str) -> str:
+    """
+    One field of a COPY CSV row. None is written as an unquoted empty field,
+    which COPY reads as NULL, and every other text value is quoted so empty
+    strings stay empty strings.
+    """
+    if value is None:
+        return ""
+    if column_type == "integer":
+        return str(int(value))
+    if column_type == "vector":
+        value = _vector_literal(value)
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def _csv_rows(columns: dict[str, str], values: list[dict]) -> str:
+    """Rows in the CSV format read by COPY ... WITH (FORMAT csv)."""
+    return "".join(
+        ",".join(
+            _csv_field(row[name], kind) for name, kind in columns.items()
+        )
+        + "\n"
+        for row in values
+    )
+
+
+def _insert_batches(
+    db: Session, model, values: list[dict], batch_size: int, **conflict
+) -> int:
+    """
+    Writes rows with multi-row INSERT statements, skipping rows that
+    conflict with existing ones.
+    """
+    inserted = 0
+    for start in range(0, len(values), batch_size):
+        statement = (
+            insert(model)
+            .values(values[start : start + batch_size])
+            .on_conflict_do_nothing(**conflict)
+        )
+        inserted += db.execute(statement).rowcount
+    return inserted
+
+
+def _copy_rows(
+    db: Session,
+    table_name: str,
+    columns: dict[str, str],
+    values: list[dict],
+    conflict: str,
+) -> int:
+    """
+    Streams rows into a temporary table with COPY and moves them into the
+    table with a single INSERT ... SELECT, skipping rows that conflict with
+    existing ones.
+
+    Rows are sent in CSV format as psycopg2 has no binary encoder for
+    pgvector types.
+    """
+    buffer = io.StringIO(_csv_rows(columns, values))
+
+    staging = f"{table_name}_staging"
+    names = ", ".join(columns)
+    definitions = ", ".join(f"{name} {kind}" for name, kind in columns.items())
+    # Uses the session's connection so the copy is part of its transaction
+    cursor = db.connection().connection.cursor()
+    try:
+        cursor.execute(
+            f"CREATE TEMP TABLE IF NOT EXISTS {staging} ({definitions}) "
+            "ON COMMIT DELETE ROWS"
+        )
+        cursor.copy_expert(
+            f"COPY {staging} ({names}) FROM STDIN WITH (FORMAT csv)",
+            buffer,
+        )
+        cursor.execute(
+            f"INSERT INTO {table_name} ({names}) "
+            f"SELECT {names} FROM {staging} {conflict}"
+        )
+        inserted = cursor.rowcount
+        cursor.execute(f"TRUNCATE {staging}")
+        return inserted
+    finally:
+        cursor.close()
+
+
+def get_existing_chunk_hashes(
+    db: Session, embedding_model: str, chunk_hashes: list[str]
+) -> set[str]:
+    """Returns the chunk hashes that already have a vector from the model."""
+    if not chunk_hashes:
+        return set()
+
+    query = select(models.ChunkVector.chunk_hash).where(
+        models.ChunkVector.embedding_model == embedding_model,
+        models.ChunkVector.chunk_hash.in_(chunk_hashes),
+    )
+    return set(db.scalars(query).all())
+
+
+def write_chunk_vectors(
+    db: Session,
+    vectors: list[models.ChunkVector],
+    method: str = EMBEDDING_WRITE_METHOD,
+    batch_size: int = EMBEDDING_WRITE_BATCH_SIZE,
+) -> int:
+    """
+    Writes shared chunk vectors in bulk without committing. Vectors that
+    already exist for the chunk hash and model are skipped. Returns the
+    number of rows inserted.
+    """
+    if not vectors:
+        return 0
+
+    values = [_row_values(v, CHUNK_VECTOR_COLUMNS) for v in vectors]
+    if method == "copy":
+        return _copy_rows(
+            db,
+            "chunk_vector",
+            CHUNK_VECTOR_COLUMNS,
+            values,
+            "ON CONFLICT (chunk_hash, embedding_model) DO NOTHING",
+        )
+    return _insert_batches(
+        db,
+        models.ChunkVector,
+        values,
+        batch_size,
+        index_elements=["chunk_hash", "embedding_model"],
+    )
+
+
+def write_embeddings(
     db: Session,
     embeddings: list[models.Embedding],
-) -> list[models.Embedding]:
+    method: str = EMBEDDING_WRITE_METHOD,
+    batch_size: int = EMBEDDING_WRITE_BATCH_SIZE,
+) -> int:
     """
-    Inserts embeddings into the database.
+    Writes embeddings in bulk without committing. Chunks that already have
+    an embedding from the same model are skipped. Returns the number of
+    rows inserted.
     """
-    inserted_rows = []
-    for emb in embeddings:
-        try:
-            r = insert_embedding(db, emb)
-            inserted_rows.append(r)
-        except IntegrityError as e:
-            print(f"Could not insert {emb}")
-            print(f"Error: {e}")
-            db.rollback()
-        except SQLAlchemyError as e:
-            print(f"Could not insert {emb}")
-            print(f"Error: {e}")
-            db.rollback()
+    if not embeddings:
+        return 0
 
-    return inserted_rows
+    values = [_row_values(e, EMBEDDING_COLUMNS) for e in embeddings]
+    if method == "copy":
+        return _copy_rows(
+            db,
+            "document_embeddings",
+            EMBEDDING_COLUMNS,
+            values,
+            "ON CONFLICT ON CONSTRAINT unique_embedding DO NOTHING",
+        )
+    return _insert_batches(
+        db,
+        models.Embedding,
+        values,
+        batch_size,
+        constraint="unique_embedding",
+    )
 
 
-def get_user_annotations_for_catalogue_item(
+def insert_embeddings(
     db: Session,
-    user_id: str,
-    catalogue_id: str,
-) -> list[models.Book]:
+    embeddings: list[models.Embedding],
+    vectors: Optional[list[models.ChunkVector]] = None,
+    method: str = EMBEDDING_WRITE_METHOD,
+) -> int:
     """
-    Get all documents belonging to a catalogue item
+    Inserts embeddings, and the vectors of any chunks not embedded before,
+    into the database in one transaction. Returns the number of embeddings
+    inserted.
     """
-    query = select(models.Book).filter_by(catalogue_id=catalogue_id)
-    return list(db.scalars(query).all())
+    try:
+        write_chunk_vectors(db, vectors or [], method)
+        inserted = write_embeddings(db, embeddings, method)
+        db.commit()
+        return inserted
+    except Exception as e:
+        print(f"Could not insert {len(embeddings)} embeddings")
+        print(f"Error: {e}")
+        db.rollback()
+        raise e
 
 
-def get_all_user_documents(db: Session, user_id: str) -> list[models.Book]:
+def delete_orphan_chunk_vectors(db: Session) -> int:
     """
-    Returns all document associated with user.
+    Deletes chunk vectors no longer referenced by any chunk. Returns the
+    number of rows deleted.
+
+    Vectors locked by a transaction writing chunks that use them are
+    skipped. An indexer that found a vector before it was deleted fails on
+    the chunks' foreign key when writing and is retried, rather than
+    leaving chunks that point at nothing.
     """
-    query = select(models.Book).filter_by(user_id=user_id)
-    return list(db.scalars(query).all())
+    vector = aliased(models.ChunkVector)
+    orphans = (
+        select(vector.chunk_hash, vector.embedding_model)
+        .where(
+            ~exists().where(
+                models.Embedding.chunk_hash == vector.chunk_hash,
+                models.Embedding.embedding_model == vector.embedding_model,
+            )
+        )
+        .with_for_update(skip_locked=True)
+    )
+    try:
+        result = db.execute(
+            delete(models.ChunkVector).where(
+                tuple_(
+                    models.ChunkVector.chunk_hash,
+                    models.ChunkVector.embedding_model,
+                ).in_(orphans)
+            )
+        )
+        db.commit()
+        return result.rowcount
+    except Exception as e:
+        print("Could not delete orphaned chunk vectors")
+        print(f"Error: {e}")
+        db.rollback()
+        raise e
 
 
-def get_document_chunks(
-    db: Session, document_id: str
-) -> list[models.Embedding]:
+def _needs_index_filter(
+    embedding_model: str, chunking_strategy: Optional[str] = None
+):
     """
-    Get all chunks and embeddings associated with a document.
+    Clips with no embeddings from the model for their current content,
+    either because they were never indexed or because they were edited.
+    When chunking_strategy is given, clips chunked with any other strategy
+    also need indexing.
     """
-    query = select(models.Embedding).filter_by(source_id=document_id)
-    return list(db.scalars(query).all())
+    conditions = [
+        models.Embedding.source_id == models.Clip.id,
+        models.Embedding.embedding_model == embedding_model,
+        models.Embedding.source_hash == models.Clip.content_hash,
+    ]
+    if chunking_strategy:
+        conditions.append(
+            models.Embedding.chunking_strategy == chunking_strategy
+        )
+    return ~exists().where(*conditions)
 
 
-def get_random_user_clips(
+def get_clips_needing_index(
     db: Session,
-    user_id: str,
-    limit: int = 10,
+    embedding_model: str,
+    user_id: Optional[str] = None,
+    after_id: Optional[uuid.UUID] = None,
+    limit: int = 100,
+    chunking_strategy: Optional[str] = None,
 ) -> list[models.Clip]:
     """
-    Returns a random selection of documents from the user's library up
-    to the limit.
+    Returns up to limit clips, ordered by id, whose embeddings are missing or
+    were produced from different content or with a different chunking
+    strategy. Pass the id of the last clip returned as after_id to get the
+    next page.
     """
-
-    query = (
-        select(models.Clip)
-        .where(models.Clip.user_id == user_id)
-        .order_by(func.random())
-        .limit(limit)
+    query = select(models.Clip).where(
+        _needs_index_filter(embedding_model, chunking_strategy)
     )
+    if user_id:
+        query = query.where(models.Clip.user_id == user_id)
+    if after_id:
+        query = query.where(models.Clip.id > after_id)
+    query = query.order_by(models.Clip.id).limit(limit)
     return list(db.scalars(query).all())
 
 
-def get_random_user_clips_with_book(
+def count_clips_needing_index(
     db: Session,
-    user_id: str,
-    limit: int = 10,
-) -> list[Row[Tuple[models.Clip, models.Book]]]:
+    embedding_model: str,
+    user_id: Optional[str] = None,
+    chunking_strategy: Optional[str] = None,
+) -> int:
+    """Number of clips with missing or stale embeddings."""
+    query = select(func.count(models.Clip.id)).where(
+        _needs_index_filter(embedding_model, chunking_strategy)
+    )
+    if user_id:
+        query = query.where(models.Clip.user_id == user_id)
+    return db.scalar(query) or 0
+
+
+def replace_clip_embeddings(
+    db: Session,
+    clip_ids: list[uuid.UUID | str],
+    embeddings: list[models.Embedding],
+    embedding_model: str,
+    vectors: Optional[list[models.ChunkVector]] = None,
+) -> int:
     """
-    Returns a random selection of documents from the user's library up
-    to the limit.
+    Replaces the chunks of the clips with new embeddings in one transaction,
+    adding the vectors of any chunks not embedded before.
+
+    Existing chunks from embedding_model, and chunks from any model that were
+    produced from older content of the clip, are deleted. Chunks from other
+    models for the current content are kept so migrations can still read
+    them.
     """
+    if not clip_ids:
+        return 0
 
-    query = (
-        select(models.Clip, models.Book)
-        .join(
-            models.Book,
-            models.Clip.document_id == models.Book.id,
-        )
-        .where(models.Clip.user_id == user_id)
-        .order_by(func.random())
-        .limit(limit)
+    clip_hash = (
+        select(models.Clip.content_hash)
+        .where(models.Clip.id == models.Embedding.source_id)
+        .scalar_subquery()
     )
-    return list(db.execute(query).all())
+    try:
+        statement = delete(models.Embedding).where(
+            models.Embedding.source_id.in_(clip_ids),
+            or_(
+                models.Embedding.embedding_model == embedding_model,
+                models.Embedding.source_hash.is_distinct_from(clip_hash),
+            ),
+        )
+        db.execute(statement)
+        write_chunk_vectors(db, vectors or [])
+        inserted = write_embeddings(db, embeddings)
+        db.execute(_stale_neighbour_lists(clip_ids))
+        db.commit()
+        return inserted
+    except Exception as e:
+        print(f"Could not replace embeddings for {len(clip_ids)} clips")
+        print(f"Error: {e}")
+        db.rollback()
+        raise e
 
 
-def get_user_clips(
+def get_cached_embeddings(
     db: Session,
-    user_id: str,
-    limit: int = 10,
-    offset: int = 0,
-    sort: Optional[str] = None,
-    order_by: str = "desc",
-) -> list[models.Clip]:
+    model_name: str,
+    dimensions: int,
+    content_hashes: list[str],
+) -> list[models.EmbeddingCacheEntry]:
     """
-    Assumes sort is a column in the Book table.
+    Returns the cached embeddings for any of the content hashes that have
+    already been embedded by the model.
     """
-    if sort:
-        order = models.Clip.__table__.c[sort]
-        order = order.desc() if order_by == "desc" else order.asc()
-        query = (
-            select(models.Clip)
-            .where(models.Clip.user_id == user_id)
-            .order_by(order)
-            .limit(limit)
-            .offset(offset)
-        )
-    else:
-        query = (
-            select(models.Clip)
-            .where(models.Clip.user_id == user_id)
-            .limit(limit)
-            .offset(offset)
-        )
+    if not content_hashes:
+        return []
 
+    query = select(models.EmbeddingCacheEntry).where(
+        models.EmbeddingCacheEntry.model_name == model_name,
+        models.EmbeddingCacheEntry.dimensions == dimensions,
+        models.EmbeddingCacheEntry.content_hash.in_(content_hashes),
+    )
     return list(db.scalars(query).all())
 
 
-def get_user_clips_with_book(
+def insert_cached_embeddings(db: Session, values: list[dict]) -> None:
+    """
+    Adds embeddings to the cache. Entries already in the cache are left
+    untouched.
+    """
+    if not values:
+        return
+
+    stmt = insert(models.EmbeddingCacheEntry).values(values)
+    stmt = stmt.on_conflict_do_nothing()
+    db.execute(stmt)
+    db.commit()
+
+
+def get_clips_by_ids(
+    db: Session, clip_ids: list[uuid.UUID | str]
+) -> list[models.Clip]:
+    """Returns the clips with the given ids that still exist."""
+    if not clip_ids:
+        return []
+
+    query = select(models.Clip).where(models.Clip.id.in_(clip_ids))
+    return list(db.scalars(query).all())
+
+
+def create_index_job(
+    db: Session, user_id: str, clip_ids: list[uuid.UUID | str]
+) -> models.IndexJob:
+    """
+    Queues a job to chunk and embed the clips.
+    """
+    job = models.IndexJob(
+        user_id=user_id,
+        clip_ids=[str(clip_id) for clip_id in clip_ids],
+        total=len(clip_ids),
+    )
+    try:
+        db.add(job)
+        db.commit()
+        db.refresh(job)
+    except SQLAlchemyError as e:
+        print("Could not create index job")
+        print(f"Error: {e}")
+        db.rollback()
+        raise e
+    return job
+
+
+def get_user_index_job(
+    db: Session, user_id: str, job_id: str
+) -> models.IndexJob | None:
+    """Retrieves one of the user's index jobs."""
+    query = select(models.IndexJob).filter_by(id=job_id, user_id=user_id)
+    return db.scalars(query).first()
+
+
+def claim_index_job(
     db: Session,
-    user_id: str,
-    limit: int = 10,
-    offset: int = 0,
-    sort: Optional[str] = None,
-    order_by: str = "desc",
-) -> list[Row[Tuple[models.Clip, models.Book]]]:
+    stale_after: timedelta = timedelta(minutes=30),
+    max_attempts: int = INDEX_JOB_MAX_ATTEMPTS,
+) -> models.IndexJob | None:
     """
-    Assumes sort is a column in the Book table.
+    Claims the oldest queued job that is due to run and marks it as
+    running. Jobs left running by a worker that has not reported progress
+    within stale_after are claimed again, unless they have already been
+    tried max_attempts times, in which case they are marked as failed.
+
+    Rows locked by other workers are skipped so any number of workers can
+    claim jobs concurrently.
     """
-    if sort:
-        order = models.Clip.__table__.c[sort]
-        order = order.desc() if order_by == "desc" else order.asc()
-        query = (
-            select(models.Clip, models.Book)
-            .join(
-                models.Book,
-                models.Clip.document_id == models.Book.id,
+    now = datetime.now(timezone.utc)
+    is_stale = (models.IndexJob.status == "running") & (
+        models.IndexJob.updated_at < now - stale_after
+    )
+    query = (
+        select(models.IndexJob)
+        .where(
+            (
+                (models.IndexJob.status == "queued")
+                & (
+                    models.IndexJob.retry_at.is_(None)
+                    | (models.IndexJob.retry_at <= now)
+                )
             )
-            .where(models.Clip.user_id == user_id)
-            .order_by(order)
-            .limit(limit)
-            .offset(offset)
+            | (is_stale & (models.IndexJob.attempts < max_attempts))
         )
-    else:
-        query = (
-            select(models.Clip, models.Book)
-            .join(
-                models.Book,
-                models.Clip.document_id == models.Book.id,
+        .order_by(models.IndexJob.created_at)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+    )
+    try:
+        # Jobs that keep stopping their worker are given up on
+        db.execute(
+            update(models.IndexJob)
+            .where(is_stale, models.IndexJob.attempts >= max_attempts)
+            .values(
+                status="failed",
+                error=f"Worker stopped during {max_attempts} attempts",
+                finished_at=func.now(),
+                updated_at=func.now(),
             )
-            .where(models.Clip.user_id == user_id)
-            .limit(limit)
-            .offset(offset)
         )
+        job = db.scalars(query).first()
+        if not job:
+            db.commit()
+            return None
+
+        job.status = "running"
+        job.attempts += 1
+        job.started_at = func.now()
+        job.updated_at = func.now()
+        db.commit()
+        db.refresh(job)
+        return job
+    except SQLAlchemyError as e:
+        print("Could not claim index job")
+        print(f"Error: {e}")
+        db.rollback()
+        raise e
 
-    return list(db.execute(query).all())
 
+def update_index_job_progress(
+    db: Session, job: models.IndexJob, processed: int
+) -> models.IndexJob:
+    """Records how many of the job's clips have been indexed."""
+    job.processed = processed
+    job.updated_at = func.now()
+    db.commit()
+    return job
 
-def get_similar_chunks(
+
+def requeue_index_job(
+    db: Session, job: models.IndexJob, error: str, delay: timedelta
+) -> models.IndexJob:
+    """Puts a failed job back in the queue to be retried after delay."""
+    job.status = "queued"
+    job.error = error
+    job.retry_at = datetime.now(timezone.utc) + delay
+    job.updated_at = func.now()
+    db.commit()
+    return job
+
+
+def finish_index_job(
+    db: Session, job: models.IndexJob, error: Optional[str] = None
+) -> models.IndexJob:
+    """Marks the job as completed, or failed when an error is given."""
+    job.status = "failed" if error else "completed"
+    job.error = error
+    job.finished_at = func.now()
+    job.updated_at = func.now()
+    db.commit()
+    return job
+
+
+def _reindex_shard(shards: int):
+    """Shard of a clip, from a hash of its id."""
+    return func.abs(func.hashtext(cast(models.Clip.id, String)) % shards)
+
+
+def _reindex_scope(query, user_ids: Optional[list[uuid.UUID | str]]):
+    if user_ids:
+        query = query.where(models.Clip.user_id.in_(user_ids))
+    return query
+
+
+def count_clips_per_reindex_shard(
     db: Session,
-    user_id: str,
-    query_embedding: list[float],
-    topk: int = 5,
-    exclude_documents: list[str] | None = None,
-    exclude_chunks: list[str] | None = None,
-) -> list[Row[Tuple[models.Embedding, float]]]:
-    """
-    Retrieve similar chunks to a user's text by performing a cosine similarity
-    search across embeddings belonging to the user. Returns the topk results.
+    shards: int,
+    user_ids: Optional[list[uuid.UUID | str]] = None,
+) -> dict[int, int]:
+    """Number of the users' clips, or all clips, in each shard."""
+    shard = _reindex_shard(shards).label("shard")
+    query = _reindex_scope(
+        select(shard, func.count(models.Clip.id)).group_by(shard), user_ids
+    )
+    return {shard: count for shard, count in db.execute(query).all()}
 
-    Returns: list of tuples containing ids of similar chunks from Embedding
-    table and their cosine similarity scores, ordered by highest to lowest
-    score.
+
+def get_clips_for_reindex(
+    db: Session,
+    shard: int,
+    shards: int,
+    user_ids: Optional[list[uuid.UUID | str]] = None,
+    after_id: Optional[uuid.UUID] = None,
+    limit: int = 100,
+) -> list[models.Clip]:
     """
-    query = (
-        select(models.Embedding)
-        .join(
-            models.Clip,
-            models.Clip.id == models.Embedding.source_id,
-        )
-        .where(models.Clip.user_id == user_id)
+    Returns up to limit clips of the shard ordered by id. Pass the id of the
+    last clip returned as after_id to get the next page.
+    """
+    query = _reindex_scope(
+        select(models.Clip).where(_reindex_shard(shards) == shard), user_ids
     )
+    if after_id:
+        query = query.where(models.Clip.id > after_id)
+    query = query.order_by(models.Clip.id).limit(limit)
+    return list(db.scalars(query).all())
 
-    if exclude_documents:
-        query = query.where(models.Clip.id.notin_(exclude_documents))
+
+def get_reindex_checkpoints(
+    db: Session, run_id: str
+) -> list[models.ReindexCheckpoint]:
+    """Checkpoints of every shard of a reindex run."""
+    query = (
+        select(models.ReindexCheckpoint)
+        .filter_by(run_id=run_id)
+        .order_by(models.ReindexCheckpoint.shard)
+    )
+    return list(db.scalars(query).all())
+
+
+def get_reindex_checkpoint(
+    db: Session, run_id: str, shard: int
+) -> models.ReindexCheckpoint | None:
+    query = select(models.ReindexCheckpoint).filter_by(
+        run_id=run_id, shard=shard
+    )
+    return db.scalars(query).first()
+
+
+def create_reindex_checkpoints(
+    db: Session,
+    run_id: str,
+    shards: int,
+    user_ids: Optional[list[uuid.UUID | str]] = None,
+) -> list[models.ReindexCheckpoint]:
+    """
+    Creates a queued checkpoint for every shard of a new reindex run with
+    the number of clips it holds.
+    """
+    counts = count_clips_per_reindex_shard(db, shards, user_ids)
+    checkpoints = [
+        models.ReindexCheckpoint(
+            run_id=run_id,
+            shard=shard,
+            shards=shards,
+            user_ids=[str(user_id) for user_id in user_ids or []] or None,
+            total=counts.get(shard, 0),
+        )
+        for shard in range(shards)
+    ]
+    try:
+        db.add_all(checkpoints)
+        db.commit()
+    except SQLAlchemyError as e:
+        print(f"Could not create checkpoints for reindex run {run_id}")
+        print(f"Error: {e}")
+        db.rollback()
+        raise e
+    return checkpoints
+
+
+def update_reindex_checkpoint(
+    db: Session,
+    checkpoint: models.ReindexCheckpoint,
+    status: Optional[str] = None,
+    last_clip_id: Optional[uuid.UUID] = None,
+    processed: Optional[int] = None,
+    error: Optional[str] = None,
+) -> models.ReindexCheckpoint:
+    """Records the progress of a shard."""
+    if status is not None:
+        checkpoint.status = status
+    if last_clip_id is not None:
+        checkpoint.last_clip_id = last_clip_id
+    if processed is not None:
+        checkpoint.processed = processed
+    checkpoint.error = error
+    checkpoint.updated_at = func.now()
+    db.commit()
+    return checkpoint
+
+
+def delete_reindex_checkpoints(db: Session, run_id: str) -> int:
+    """Deletes the checkpoints of a reindex run so it starts over."""
+    try:
+        result = db.execute(
+            delete(models.ReindexCheckpoint).filter_by(run_id=run_id)
+        )
+        db.commit()
+        return result.rowcount
+    except SQLAlchemyError as e:
+        print(f"Could not delete checkpoints for reindex run {run_id}")
+        print(f"Error: {e}")
+        db.rollback()
+        raise e
+
+
+def _index_audit_checks(
+    embedding_model: str, chunking_strategy: str, dimensions: int
+) -> dict:
+    """
+    Conditions on a clip for each index consistency check, limited to
+    embeddings from embedding_model.
+
+    - missing: the clip has no embeddings
+    - stale_content: an embedding was made from older content of the clip
+    - stale_strategy: an embedding was chunked with another strategy
+    - bad_vector: an embedding has no vector, or its vector does not have
+      the configured number of dimensions
+
+    Dimensions are judged from the stored vector itself. The recorded
+    embedding_dimensions is missing on vectors from before it was kept.
+    """
+    clip_embedding = [
+        models.Embedding.source_id == models.Clip.id,
+        models.Embedding.embedding_model == embedding_model,
+    ]
+    good_vector = exists().where(
+        models.ChunkVector.chunk_hash == models.Embedding.chunk_hash,
+        models.ChunkVector.embedding_model == embedding_model,
+        func.vector_dims(models.ChunkVector.embedding) == dimensions,
+    )
+    return {
+        "missing": ~exists().where(*clip_embedding),
+        "stale_content": exists().where(
+            *clip_embedding,
+            models.Embedding.source_hash.is_distinct_from(
+                models.Clip.content_hash
+            ),
+        ),
+        "stale_strategy": exists().where(
+            *clip_embedding,
+            models.Embedding.chunking_strategy.is_distinct_from(
+                chunking_strategy
+            ),
+        ),
+        "bad_vector": exists().where(*clip_embedding, ~good_vector),
+    }
+
+
+def count_index_audit(
+    db: Session,
+    embedding_model: str,
+    chunking_strategy: str,
+    dimensions: int,
+    user_id: Optional[str] = None,
+) -> dict[str, int]:
+    """
+    Number of clips failing each index consistency check, counted in a
+    single scan of the clips.
+    """
+    checks = _index_audit_checks(
+        embedding_model, chunking_strategy, dimensions
+    )
+    query = select(
+        func.count(models.Clip.id).label("clips"),
+        *[
+            func.count(models.Clip.id).filter(condition).label(name)
+            for name, condition in checks.items()
+        ],
+    )
+    if user_id:
+        query = query.where(models.Clip.user_id == user_id)
+    return dict(db.execute(query).one()._mapping)
+
+
+def get_index_audit_sample(
+    db: Session,
+    check: str,
+    embedding_model: str,
+    chunking_strategy: str,
+    dimensions: int,
+    user_id: Optional[str] = None,
+    limit: int = 5,
+) -> list[models.Clip]:
+    """Returns up to limit clips failing one consistency check."""
+    condition = _index_audit_checks(
+        embedding_model, chunking_strategy, dimensions
+    )[check]
+    query = select(models.Clip).where(condition)
+    if user_id:
+        query = query.where(models.Clip.user_id == user_id)
+    query = query.order_by(models.Clip.id).limit(limit)
+    return list(db.scalars(query).all())
+
+
+def get_clips_failing_index_audit(
+    db: Session,
+    embedding_model: str,
+    chunking_strategy: str,
+    dimensions: int,
+    user_id: Optional[str] = None,
+) -> list[Row]:
+    """Returns the user_id and id of every clip failing any check."""
+    checks = _index_audit_checks(
+        embedding_model, chunking_strategy, dimensions
+    )
+    query = select(models.Clip.user_id, models.Clip.id).where(
+        or_(*checks.values())
+    )
+    if user_id:
+        query = query.where(models.Clip.user_id == user_id)
+    query = query.order_by(models.Clip.user_id, models.Clip.id)
+    return list(db.execute(query).all())
+
+
+def count_embeddings_by_strategy(
+    db: Session, embedding_model: str, user_id: Optional[str] = None
+) -> dict[Optional[str], int]:
+    """Number of the model's chunks produced by each chunking strategy."""
+    query = (
+        select(
+            models.Embedding.chunking_strategy,
+            func.count(models.Embedding.id),
+        )
+        .where(models.Embedding.embedding_model == embedding_model)
+        .group_by(models.Embedding.chunking_strategy)
+    )
+    if user_id:
+        query = query.where(models.Embedding.user_id == user_id)
+    return {strategy: count for strategy, count in db.execute(query).all()}
+
+
+def _bad_dimensions_filter(embedding_model: str, dimensions: int):
+    """
+    Vectors of the model that do not have the expected dimensions, judged
+    from the vector as embedding_dimensions is null on older vectors.
+    """
+    return and_(
+        models.ChunkVector.embedding_model == embedding_model,
+        func.vector_dims(models.ChunkVector.embedding) != dimensions,
+    )
+
+
+def count_bad_dimension_vectors(
+    db: Session, embedding_model: str, dimensions: int
+) -> int:
+    """Number of the model's vectors without the expected dimensions."""
+    query = select(func.count()).where(
+        _bad_dimensions_filter(embedding_model, dimensions)
+    )
+    return db.scalar(query.select_from(models.ChunkVector)) or 0
+
+
+def delete_bad_dimension_vectors(
+    db: Session, embedding_model: str, dimensions: int
+) -> int:
+    """
+    Deletes the model's vectors without the expected dimensions, and the
+    chunks using them, so their clips are embedded again when reindexed.
+    Returns the number of vectors deleted.
+    """
+    bad_hashes = select(models.ChunkVector.chunk_hash).where(
+        _bad_dimensions_filter(embedding_model, dimensions)
+    )
+    try:
+        db.execute(
+            delete(models.Embedding).where(
+                models.Embedding.embedding_model == embedding_model,
+                models.Embedding.chunk_hash.in_(bad_hashes),
+            )
+        )
+        result = db.execute(
+            delete(models.ChunkVector).where(
+                _bad_dimensions_filter(embedding_model, dimensions)
+            )
+        )
+        db.commit()
+        return result.rowcount
+    except SQLAlchemyError as e:
+        print("Could not delete vectors with the wrong dimensions")
+        print(f"Error: {e}")
+        db.rollback()
+        raise e
+
+
+def _stale_neighbour_lists(clip_ids):
+    """
+    Marks the neighbour lists that include any of the clips as stale. The
+    clips can be a list of ids or a select of ids.
+    """
+    listed_in = select(models.ClipNeighbour.clip_id).where(
+        models.ClipNeighbour.neighbour_id.in_(clip_ids)
+    )
+    return (
+        update(models.ClipNeighbourStatus)
+        .where(models.ClipNeighbourStatus.clip_id.in_(listed_in))
+        .values(stale=True)
+    )
+
+
+def _neighbours_current(embedding_model: str):
+    """Clips whose neighbour list is up to date."""
+    return exists().where(
+        models.ClipNeighbourStatus.clip_id == models.Clip.id,
+        models.ClipNeighbourStatus.content_hash == models.Clip.content_hash,
+        models.ClipNeighbourStatus.embedding_model == embedding_model,
+        models.ClipNeighbourStatus.stale.is_(False),
+    )
+
+
+def get_clips_needing_neighbours(
+    db: Session,
+    embedding_model: str,
+    user_id: Optional[str] = None,
+    after_id: Optional[uuid.UUID] = None,
+    limit: int = 100,
+) -> list[models.Clip]:
+    """
+    Returns up to limit clips, ordered by id, whose neighbour list is
+    missing or out of date. Clips are skipped until their current content
+    has been embedded with embedding_model.
+    """
+    indexed = exists().where(
+        models.Embedding.source_id == models.Clip.id,
+        models.Embedding.embedding_model == embedding_model,
+        models.Embedding.source_hash == models.Clip.content_hash,
+    )
+    query = select(models.Clip).where(
+        indexed, ~_neighbours_current(embedding_model)
+    )
+    if user_id:
+        query = query.where(models.Clip.user_id == user_id)
+    if after_id:
+        query = query.where(models.Clip.id > after_id)
+    query = query.order_by(models.Clip.id).limit(limit)
+    return list(db.scalars(query).all())
+
+
+def get_clip_neighbour_statuses(
+    db: Session, clip_ids: list[uuid.UUID | str]
+) -> dict[uuid.UUID, models.ClipNeighbourStatus]:
+    query = select(models.ClipNeighbourStatus).where(
+        models.ClipNeighbourStatus.clip_id.in_(clip_ids)
+    )
+    return {status.clip_id: status for status in db.scalars(query).all()}
+
+
+def replace_clip_neighbours(
+    db: Session,
+    clip: models.Clip,
+    embedding_model: str,
+    neighbours: list[tuple[uuid.UUID, float]],
+) -> None:
+    """
+    Replaces the neighbour list of a clip with neighbours, given as
+    (clip id, score) best first, and records it as up to date.
+    """
+    status = insert(models.ClipNeighbourStatus).values(
+        clip_id=clip.id,
+        content_hash=clip.content_hash,
+        embedding_model=embedding_model,
+        stale=False,
+        built_at=func.now(),
+    )
+    status = status.on_conflict_do_update(
+        index_elements=[models.ClipNeighbourStatus.clip_id],
+        set_={
+            "content_hash": status.excluded.content_hash,
+            "embedding_model": status.excluded.embedding_model,
+            "stale": False,
+            "built_at": status.excluded.built_at,
+        },
+    )
+    try:
+        db.execute(
+            delete(models.ClipNeighbour).where(
+                models.ClipNeighbour.clip_id == clip.id
+            )
+        )
+        if neighbours:
+            db.execute(
+                insert(models.ClipNeighbour),
+                [
+                    {
+                        "clip_id": clip.id,
+                        "neighbour_id": neighbour_id,
+                        "rank": rank,
+                        "score": score,
+                    }
+                    for rank, (neighbour_id, score) in enumerate(
+                        neighbours, start=1
+                    )
+                ],
+            )
+        db.execute(status)
+        db.commit()
+    except SQLAlchemyError as e:
+        print(f"Could not replace neighbours of clip {clip.id}")
+        print(f"Error: {e}")
+        db.rollback()
+        raise e
+
+
+def mark_clip_neighbours_stale(
+    db: Session, clip_ids: list[uuid.UUID | str]
+) -> None:
+    """Marks the neighbour lists of the clips as stale."""
+    if not clip_ids:
+        return
+
+    try:
+        db.execute(
+            update(models.ClipNeighbourStatus)
+            .where(models.ClipNeighbourStatus.clip_id.in_(clip_ids))
+            .values(stale=True)
+        )
+        db.commit()
+    except SQLAlchemyError as e:
+        print("Could not mark clip neighbours as stale")
+        print(f"Error: {e}")
+        db.rollback()
+        raise e
+
+
+def get_clip_neighbours(
+    db: Session,
+    user_id: str,
+    clip_id: str,
+    embedding_model: str,
+    topk: int = 5,
+    threshold: Optional[float] = None,
+) -> list[Row[Tuple[models.Clip, models.Book, float]]] | None:
+    """
+    Returns the precomputed most similar clips of a clip as rows of
+    (Clip, Book, score), best first, or None when the clip's list is
+    missing or out of date. Neighbours scoring above threshold are left out.
+    """
+    current = db.scalar(
+        select(
+            exists().where(
+                models.Clip.id == clip_id,
+                models.Clip.user_id == user_id,
+                _neighbours_current(embedding_model),
+            )
+        )
+    )
+    if not current:
+        return None
+
+    query = (
+        select(models.Clip, models.Book, models.ClipNeighbour.score)
+        .join(
+            models.ClipNeighbour,
+            models.ClipNeighbour.neighbour_id == models.Clip.id,
+        )
+        .join(models.Book, models.Book.id == models.Clip.document_id)
+        .where(models.ClipNeighbour.clip_id == clip_id)
+        .order_by(models.ClipNeighbour.rank)
+        .limit(topk)
+    )
+    if threshold is not None:
+        query = query.where(models.ClipNeighbour.score <= threshold)
+    return list(db.execute(query).all())
+
+
+def get_user_annotations_for_catalogue_item(
+    db: Session,
+    user_id: str,
+    catalogue_id: str,
+) -> list[models.Book]:
+    """
+    Get all documents belonging to a catalogue item
+    """
+    query = select(models.Book).filter_by(catalogue_id=catalogue_id)
+    return list(db.scalars(query).all())
+
+
+def get_all_user_documents(db: Session, user_id: str) -> list[models.Book]:
+    """
+    Returns all document associated with user.
+    """
+    query = select(models.Book).filter_by(user_id=user_id)
+    return list(db.scalars(query).all())
+
+
+def _chunk_vector_join():
+    """Joins chunks to their shared vector."""
+    return and_(
+        models.ChunkVector.chunk_hash == models.Embedding.chunk_hash,
+        models.ChunkVector.embedding_model == models.Embedding.embedding_model,
+    )
+
+
+def get_random_user_clips(
+    db: Session,
+    user_id: str,
+    limit: int = 10,
+) -> list[models.Clip]:
+    """
+    Returns a random selection of documents from the user's library up
+    to the limit.
+    """
+
+    query = (
+        select(models.Clip)
+        .where(models.Clip.user_id == user_id)
+        .order_by(func.random())
+        .limit(limit)
+    )
+    return list(db.scalars(query).all())
+
+
+def get_random_user_clips_with_book(
+    db: Session,
+    user_id: str,
+    limit: int = 10,
+) -> list[Row[Tuple[models.Clip, models.Book]]]:
+    """
+    Returns a random selection of documents from the user's library up
+    to the limit.
+    """
+
+    query = (
+        select(models.Clip, models.Book)
+        .join(
+            models.Book,
+            models.Clip.document_id == models.Book.id,
+        )
+        .where(models.Clip.user_id == user_id)
+        .order_by(func.random())
+        .limit(limit)
+    )
+    return list(db.execute(query).all())
+
+
+def get_user_clips(
+    db: Session,
+    user_id: str,
+    limit: int = 10,
+    offset: int = 0,
+    sort: Optional[str] = None,
+    order_by: str = "desc",
+) -> list[models.Clip]:
+    """
+    Assumes sort is a column in the Book table.
+    """
+    if sort:
+        order = models.Clip.__table__.c[sort]
+        order = order.desc() if order_by == "desc" else order.asc()
+        query = (
+            select(models.Clip)
+            .where(models.Clip.user_id == user_id)
+            .order_by(order)
+            .limit(limit)
+            .offset(offset)
+        )
+    else:
+        query = (
+            select(models.Clip)
+            .where(models.Clip.user_id == user_id)
+            .limit(limit)
+            .offset(offset)
+        )
+
+    return list(db.scalars(query).all())
+
+
+def get_user_clips_with_book(
+    db: Session,
+    user_id: str,
+    limit: int = 10,
+    offset: int = 0,
+    sort: Optional[str] = None,
+    order_by: str = "desc",
+) -> list[Row[Tuple[models.Clip, models.Book]]]:
+    """
+    Assumes sort is a column in the Book table.
+    """
+    if sort:
+        order = models.Clip.__table__.c[sort]
+        order = order.desc() if order_by == "desc" else order.asc()
+        query = (
+            select(models.Clip, models.Book)
+            .join(
+                models.Book,
+                models.Clip.document_id == models.Book.id,
+            )
+            .where(models.Clip.user_id == user_id)
+            .order_by(order)
+            .limit(limit)
+            .offset(offset)
+        )
+    else:
+        query = (
+            select(models.Clip, models.Book)
+            .join(
+                models.Book,
+                models.Clip.document_id == models.Book.id,
+            )
+            .where(models.Clip.user_id == user_id)
+            .limit(limit)
+            .offset(offset)
+        )
+
+    return list(db.execute(query).all())
+
+
+def _embedding_model_filter(embedding_model: str, include_legacy: bool):
+    """Filters embeddings to those produced by the model."""
+    condition = models.Embedding.embedding_model == embedding_model
+    if include_legacy:
+        condition = or_(condition, models.Embedding.embedding_model.is_(None))
+    return condition
+
+
+def _has_embeddings_from(source_id, embedding_model: str):
+    """True where the source has any embeddings from the model."""
+    other = aliased(models.Embedding)
+    return exists().where(
+        other.source_id == source_id,
+        other.embedding_model == embedding_model,
+    )
+
+
+def _unmigrated_filter(from_model: str, to_model: str):
+    """
+    Chunks embedded with from_model, or with no recorded model, that have no
+    embedding from to_model yet.
+    """
+    migrated = aliased(models.Embedding)
+    is_migrated = exists().where(
+        migrated.source_id == models.Embedding.source_id,
+        migrated.chunk_content == models.Embedding.chunk_content,
+        migrated.embedding_model == to_model,
+    )
+    return and_(
+        _embedding_model_filter(from_model, include_legacy=True),
+        ~is_migrated,
+    )
+
+
+def get_unmigrated_chunks(
+    db: Session,
+    from_model: str,
+    to_model: str,
+    limit: int = 100,
+) -> list[models.Embedding]:
+    """
+    Returns the chunks that still need embedding with to_model of up to
+    limit clips. Whole clips are returned so none is left part migrated, as
+    searches of from_model skip clips with any embeddings from to_model.
+    """
+    sources = (
+        select(models.Embedding.source_id)
+        .where(_unmigrated_filter(from_model, to_model))
+        .group_by(models.Embedding.source_id)
+        .order_by(models.Embedding.source_id)
+        .limit(limit)
+    )
+    query = (
+        select(models.Embedding)
+        .where(
+            models.Embedding.source_id.in_(sources),
+            _unmigrated_filter(from_model, to_model),
+        )
+        .order_by(models.Embedding.source_id, models.Embedding.id)
+    )
+    return list(db.scalars(query).all())
+
+
+def count_unmigrated_chunks(
+    db: Session, from_model: str, to_model: str
+) -> int:
+    """Number of chunks still to be embedded with to_model."""
+    query = select(func.count(models.Embedding.id)).where(
+        _unmigrated_filter(from_model, to_model)
+    )
+    return db.scalar(query) or 0
+
+
+def delete_model_embeddings(db: Session, embedding_model: str) -> int:
+    """
+    Deletes all embeddings from the model, including embeddings with no
+    recorded model, and the model's chunk vectors. Returns the number of
+    embeddings deleted.
+    """
+    try:
+        statement = delete(models.Embedding).where(
+            _embedding_model_filter(embedding_model, include_legacy=True)
+        )
+        result = db.execute(statement)
+        db.execute(
+            delete(models.ChunkVector).where(
+                models.ChunkVector.embedding_model == embedding_model
+            )
+        )
+        db.commit()
+        return result.rowcount
+    except Exception as e:
+        print(f"Could not delete embeddings for {embedding_model}")
+        print(f"Error: {e}")
+        db.rollback()
+        raise e
+
+
+# Largest hnsw.ef_search pgvector accepts
+MAX_EF_SEARCH = 1000
+
+
+def _search_distance(storage: str, query_embedding: list[float]):
+    """
+    Distance between the query and the copy of the embeddings searched
+    first: the full embedding, or its compressed (halfvec or binary) or
+    shortened (matryoshka) copy. Ordering by this expression lets postgres
+    use the vector index on that column.
+    """
+    if storage == "full":
+        return models.ChunkVector.embedding.cosine_distance(query_embedding)
+    if storage == "halfvec":
+        return models.ChunkVector.embedding_compressed.cosine_distance(
+            cast(query_embedding, HALFVEC(EMBEDDING_DIMENSIONS))
+        )
+    if storage == "binary":
+        query_bits = func.binary_quantize(
+            cast(query_embedding, Vector(EMBEDDING_DIMENSIONS))
+        )
+        return models.ChunkVector.embedding_compressed.hamming_distance(
+            query_bits
+        )
+    if storage == "matryoshka":
+        # Shorten the query the same way as the stored embeddings
+        query_short = func.l2_normalize(
+            func.subvector(
+                cast(query_embedding, Vector(EMBEDDING_DIMENSIONS)),
+                1,
+                EMBEDDING_SEARCH_DIMENSIONS,
+            ),
+            type_=Vector(EMBEDDING_SEARCH_DIMENSIONS),
+        )
+        return models.ChunkVector.embedding_short.cosine_distance(query_short)
+    raise ValueError(f"Unknown embedding storage {storage}")
+
+
+def set_vector_search_params(
+    db: Session,
+    ef_search: int = 0,
+    probes: int = 0,
+    iterative_scan: str = "off",
+    max_scan_tuples: int = 0,
+) -> None:
+    """
+    Sets how many candidates the vector indexes explore for the rest of the
+    current transaction. Higher values improve recall at the cost of
+    latency. Zero leaves the setting unchanged.
+
+    With iterative_scan the index is scanned again until enough rows pass
+    the query's filters, visiting at most max_scan_tuples rows. IVFFlat
+    only supports relaxed_order. Both need pgvector 0.8+.
+    """
+    settings = {}
+    if ef_search:
+        settings["hnsw.ef_search"] = str(ef_search)
+    if probes:
+        settings["ivfflat.probes"] = str(probes)
+    if iterative_scan != "off":
+        settings["hnsw.iterative_scan"] = iterative_scan
+        if iterative_scan == "relaxed_order":
+            settings["ivfflat.iterative_scan"] = iterative_scan
+        if max_scan_tuples:
+            settings["hnsw.max_scan_tuples"] = str(max_scan_tuples)
+    if settings:
+        db.execute(
+            select(
+                *[
+                    func.set_config(name, value, True)
+                    for name, value in settings.items()
+                ]
+            )
+        )
+
+
+def count_user_chunks(
+    db: Session, user_id: str, limit: Optional[int] = None
+) -> int:
+    """
+    Number of chunks in the user's library. With limit, counting stops
+    after limit rows so checking a large library stays cheap.
+    """
+    query = select(models.Embedding.id).where(
+        models.Embedding.user_id == user_id
+    )
+    if limit is not None:
+        query = query.limit(limit)
+    return db.scalar(select(func.count()).select_from(query.subquery())) or 0
+
+
+def _user_chunks_query(
+    user_id: str,
+    exclude_documents: list[str] | None = None,
+    exclude_chunks: list[str] | None = None,
+    embedding_model: Optional[str] = None,
+    include_legacy: bool = False,
+    exclude_indexed_with: Optional[str] = None,
+):
+    """The user's chunks with their vectors, filtered for search."""
+    query = (
+        select(models.Embedding, models.ChunkVector.embedding)
+        .join(models.ChunkVector, _chunk_vector_join())
+        .where(models.Embedding.user_id == user_id)
+    )
+
+    if exclude_documents:
+        query = query.where(
+            models.Embedding.source_id.notin_(exclude_documents)
+        )
     if exclude_chunks:
         query = query.where(models.Embedding.id.notin_(exclude_chunks))
+    if embedding_model:
+        query = query.where(
+            _embedding_model_filter(embedding_model, include_legacy)
+        )
+    if exclude_indexed_with:
+        query = query.where(
+            ~_has_embeddings_from(
+                models.Embedding.source_id, exclude_indexed_with
+            )
+        )
+    return query
+
+
+def estimate_chunk_vectors(db: Session) -> int:
+    """
+    Planner's estimate of the rows in chunk_vector, which costs nothing to
+    read. Zero if the table has not been analysed yet.
+    """
+    n_rows = db.scalar(
+        text(
+            "SELECT reltuples FROM pg_class "
+            "WHERE oid = 'chunk_vector'::regclass"
+        )
+    )
+    return max(int(n_rows or 0), 0)
+
+
+def _plan_vector_search(
+    db: Session,
+    user_id: str,
+    storage: str,
+    topk: int,
+    rerank_factor: int,
+    ef_search: int,
+    probes: int,
+    exact: Optional[bool] = None,
+) -> Optional[int]:
+    """
+    Chooses between an exact scan of the user's chunks and a vector index
+    scan. Returns None for an exact scan, otherwise sets the index
+    parameters and returns the number of candidates to fetch from it.
+
+    The index holds every user's vectors and the user filter is checked on
+    the rows it returns, so about candidates / share rows are scanned to
+    find enough of the user's chunks, where share is their fraction of the
+    vectors. HNSW scans at most ef_search rows, or max_scan_tuples with an
+    iterative scan. Users whose share is too small for that budget, or with
+    fewer than VECTOR_SEARCH_EXACT_THRESHOLD chunks, are searched exactly.
+    """
+    if exact:
+        return None
+
+    candidates = topk if storage == "full" else topk * rerank_factor
+    iterative = VECTOR_SEARCH_ITERATIVE_SCAN != "off"
+    budget = VECTOR_SEARCH_MAX_SCAN_TUPLES if iterative else MAX_EF_SEARCH
+    # Twice the expected rows leaves a margin for uneven distributions
+    scan_rows = 2 * candidates * estimate_chunk_vectors(db)
+    # Counting stops once the user has enough chunks for an index scan
+    enough = max(VECTOR_SEARCH_EXACT_THRESHOLD, math.ceil(scan_rows / budget))
+    user_chunks = count_user_chunks(db, user_id, enough)
+    if exact is None and user_chunks < enough:
+        return None
+
+    # HNSW returns at most ef_search rows, 40 by default
+    ef_search = max(ef_search or 40, candidates)
+    if not iterative and user_chunks:
+        # Scan deep enough for the filter to leave candidates of the user's
+        # chunks. user_chunks is a lower bound so this errs towards recall.
+        ef_search = max(
+            ef_search, min(MAX_EF_SEARCH, math.ceil(scan_rows / user_chunks))
+        )
+    set_vector_search_params(
+        db,
+        ef_search,
+        probes,
+        VECTOR_SEARCH_ITERATIVE_SCAN,
+        VECTOR_SEARCH_MAX_SCAN_TUPLES,
+    )
+    return candidates
+
+
+def get_similar_chunks(
+    db: Session,
+    user_id: str,
+    query_embedding: list[float],
+    topk: int = 5,
+    exclude_documents: list[str] | None = None,
+    exclude_chunks: list[str] | None = None,
+    storage: str = EMBEDDING_STORAGE,
+    rerank_factor: int = EMBEDDING_RERANK_FACTOR,
+    embedding_model: Optional[str] = None,
+    include_legacy: bool = False,
+    exclude_indexed_with: Optional[str] = None,
+    ef_search: int = VECTOR_SEARCH_EF_SEARCH,
+    probes: int = VECTOR_SEARCH_PROBES,
+    exact: Optional[bool] = None,
+) -> list[Row[Tuple[models.Embedding, float]]]:
+    """
+    Retrieve similar chunks to a user's text by performing a cosine similarity
+    search across embeddings belonging to the user. Returns the topk results.
+
+    embedding_model restricts the search to embeddings from that model, plus
+    embeddings with no recorded model when include_legacy is set.
+    exclude_indexed_with skips clips that already have embeddings from the
+    given model.
+
+    When a compressed storage is used, the compressed embeddings are searched
+    first for rerank_factor * topk candidates, which are then rescored with
+    the full precision embeddings.
+
+    The first pass uses the HNSW or IVFFlat index on the searched column
+    when one has been built. ef_search and probes tune its recall for this
+    query, and ef_search is raised to at least the number of candidates.
+    The index covers every user's vectors, so the user_id filter is applied
+    to the rows the index returns, after joining them to the chunks.
+
+    exact scans every chunk of the user with the full precision embeddings
+    instead. By default it is used for users with fewer than
+    VECTOR_SEARCH_EXACT_THRESHOLD chunks, or too small a share of the
+    vectors for the index to return enough of their chunks, see
+    _plan_vector_search.
+
+    Returns: list of tuples containing ids of similar chunks from Embedding
+    table and their cosine similarity scores, ordered by highest to lowest
+    score.
+    """
+    query = _user_chunks_query(
+        user_id,
+        exclude_documents,
+        exclude_chunks,
+        embedding_model,
+        include_legacy,
+        exclude_indexed_with,
+    )
+
+    candidates = _plan_vector_search(
+        db, user_id, storage, topk, rerank_factor, ef_search, probes, exact
+    )
+    if candidates is None:
+        # Materialising the user's chunks stops postgres from walking the
+        # shared vector index instead of scanning them
+        query = query.cte("user_chunks").prefix_with("MATERIALIZED")
+    else:
+        query = query.order_by(
+            _search_distance(storage, query_embedding)
+        ).limit(candidates)
+        query = query.subquery()
 
-    query = query.subquery()
     query = (
         select(
             query,
@@ -616,6 +1986,228 @@ def get_similar_chunks(
     return list(db.execute(query).all())
 
 
+def _nearest_chunks_lateral(
+    db: Session,
+    user_id: str,
+    chunks,
+    query_embedding,
+    topk: int,
+    storage: str,
+    rerank_factor: int,
+    ef_search: int,
+    probes: int,
+    exact: Optional[bool],
+    embedding_model=None,
+):
+    """
+    LATERAL subquery of the chunks nearest to query_embedding, a column of
+    the outer query, searched the same way as get_similar_chunks. The
+    results still need rescoring with the full embeddings. embedding_model
+    can be a column of the outer query that the chunks' model must match.
+    """
+    candidates = _plan_vector_search(
+        db, user_id, storage, topk, rerank_factor, ef_search, probes, exact
+    )
+    if candidates is None:
+        user_chunks = chunks.cte("user_chunks").prefix_with("MATERIALIZED")
+        matches = (
+            select(user_chunks)
+            .order_by(user_chunks.c.embedding.cosine_distance(query_embedding))
+            .limit(topk)
+        )
+        if embedding_model is not None:
+            matches = matches.where(
+                user_chunks.c.embedding_model == embedding_model
+            )
+    else:
+        matches = chunks.order_by(
+            _search_distance(storage, query_embedding)
+        ).limit(candidates)
+        if embedding_model is not None:
+            matches = matches.where(
+                models.Embedding.embedding_model == embedding_model
+            )
+    return matches.lateral("matches")
+
+
+def get_similar_chunks_for_queries(
+    db: Session,
+    user_id: str,
+    query_embeddings: list[list[float]],
+    topk: int = 5,
+    storage: str = EMBEDDING_STORAGE,
+    rerank_factor: int = EMBEDDING_RERANK_FACTOR,
+    embedding_model: Optional[str] = None,
+    include_legacy: bool = False,
+    exclude_indexed_with: Optional[str] = None,
+    ef_search: int = VECTOR_SEARCH_EF_SEARCH,
+    probes: int = VECTOR_SEARCH_PROBES,
+    exact: Optional[bool] = None,
+) -> list[Row]:
+    """
+    Searches the user's chunks for several queries in one statement, the
+    same way as get_similar_chunks. The query embeddings are unnested into
+    rows and each is searched in a LATERAL subquery.
+
+    Returns the topk chunks of every query with query_index, the position
+    of the query in query_embeddings, and rank, starting at 1, ordered by
+    query then best score first.
+    """
+    if not query_embeddings:
+        return []
+
+    vectors = func.unnest(
+        cast(
+            [_vector_literal(embedding) for embedding in query_embeddings],
+            ARRAY(String),
+        )
+    ).table_valued("vector", with_ordinality="ordinality")
+    queries = select(
+        (vectors.c.ordinality - 1).label("query_index"),
+        cast(vectors.c.vector, Vector(EMBEDDING_DIMENSIONS)).label(
+            "query_embedding"
+        ),
+    ).cte("queries")
+    query_embedding = queries.c.query_embedding
+
+    chunks = _user_chunks_query(
+        user_id,
+        embedding_model=embedding_model,
+        include_legacy=include_legacy,
+        exclude_indexed_with=exclude_indexed_with,
+    )
+    matches = _nearest_chunks_lateral(
+        db,
+        user_id,
+        chunks,
+        query_embedding,
+        topk,
+        storage,
+        rerank_factor,
+        ef_search,
+        probes,
+        exact,
+    )
+
+    score = matches.c.embedding.cosine_distance(query_embedding)
+    ranked = (
+        select(
+            queries.c.query_index,
+            matches,
+            score.label("score"),
+            func.row_number()
+            .over(partition_by=queries.c.query_index, order_by=score)
+            .label("rank"),
+        )
+        .select_from(queries)
+        .join(matches, true())
+        .subquery()
+    )
+    query = (
+        select(ranked)
+        .where(ranked.c.rank <= topk)
+        .order_by(ranked.c.query_index, ranked.c.rank)
+    )
+    return list(db.execute(query).all())
+
+
+def get_similar_clips(
+    db: Session,
+    user_id: str,
+    clip_id: str,
+    topk: int = 5,
+    aggregation: str = "mean",
+    chunks_per_source: int = 10,
+    storage: str = EMBEDDING_STORAGE,
+    rerank_factor: int = EMBEDDING_RERANK_FACTOR,
+    ef_search: int = VECTOR_SEARCH_EF_SEARCH,
+    probes: int = VECTOR_SEARCH_PROBES,
+    exact: Optional[bool] = None,
+    threshold: Optional[float] = None,
+) -> list[Row[Tuple[models.Clip, models.Book, float]]]:
+    """
+    Finds the user's clips most similar to a clip in one query.
+
+    Every chunk of the clip is searched for its chunks_per_source nearest
+    chunks in the user's other clips, comparing only embeddings from the
+    same model. Each neighbouring chunk keeps its smallest distance to any
+    of the clip's chunks, and a clip's score is the min or mean of the
+    distances of its chunks, depending on aggregation.
+
+    Returns up to topk rows of (Clip, Book, score), best score first.
+    Clips scoring above threshold are left out before the limit.
+    """
+    if aggregation not in ("min", "mean"):
+        raise ValueError(f"Unknown aggregation {aggregation}")
+
+    source = (
+        select(
+            models.Embedding.id.label("source_chunk_id"),
+            models.ChunkVector.embedding.label("query_embedding"),
+            models.Embedding.embedding_model,
+        )
+        .join(models.ChunkVector, _chunk_vector_join())
+        .where(models.Embedding.source_id == clip_id)
+        .cte("source_chunks")
+    )
+    chunks = _user_chunks_query(user_id, exclude_documents=[clip_id])
+    matches = _nearest_chunks_lateral(
+        db,
+        user_id,
+        chunks,
+        source.c.query_embedding,
+        chunks_per_source,
+        storage,
+        rerank_factor,
+        ef_search,
+        probes,
+        exact,
+        embedding_model=source.c.embedding_model,
+    )
+    distance = matches.c.embedding.cosine_distance(source.c.query_embedding)
+    ranked = (
+        select(
+            matches.c.id,
+            matches.c.source_id,
+            distance.label("distance"),
+            func.row_number()
+            .over(partition_by=source.c.source_chunk_id, order_by=distance)
+            .label("rank"),
+        )
+        .select_from(source)
+        .join(matches, true())
+        .subquery()
+    )
+    # Best distance of each neighbouring chunk to any of the clip's chunks
+    neighbour_chunks = (
+        select(
+            ranked.c.source_id, func.min(ranked.c.distance).label("distance")
+        )
+        .where(ranked.c.rank <= chunks_per_source)
+        .group_by(ranked.c.id, ranked.c.source_id)
+        .subquery()
+    )
+    aggregate = func.min if aggregation == "min" else func.avg
+    neighbour_clips = (
+        select(
+            neighbour_chunks.c.source_id,
+            aggregate(neighbour_chunks.c.distance).label("score"),
+        )
+        .group_by(neighbour_chunks.c.source_id)
+        .subquery()
+    )
+    query = (
+        select(models.Clip, models.Book, neighbour_clips.c.score)
+        .join(neighbour_clips, neighbour_clips.c.source_id == models.Clip.id)
+        .join(models.Book, models.Book.id == models.Clip.document_id)
+        .order_by(neighbour_clips.c.score, models.Clip.id)
+        .limit(topk)
+    )
+    if threshold is not None:
+        query = query.where(neighbour_clips.c.score <= threshold)
+    return list(db.execute(query).all())
+
+
 def create_conversation(db: Session, user_id: str) -> models.Conversation:
     """
     Creates a new conversation for the user.
@@ -809,15 +2401,17 @@ def update_clip_content(
     Updates the content of a clip. The original content remains
     in original_content_field.
 
-    TODO: New embeddings need to be generated. Let's assume for now that
-    the edits are minor and do not affect the overall meaning of the text.
+    The content hash is updated too so the clip's embeddings are picked up
+    as stale and regenerated by the next index run.
     """
     clip = get_user_clip_by_id(db, user_id, clip_id)
     if not clip:
         raise ValueError("Clip does not exist")
 
     clip.content = content
+    clip.content_hash = hash_content(content)
     try:
+        db.execute(_stale_neighbour_lists([clip.id]))
         db.commit()
         return clip
     except Exception as e:
@@ -838,6 +2432,7 @@ def delete_clip(
     Embeddings should also be deleted via cascade.
     """
     try:
+        db.execute(_stale_neighbour_lists([clip_id]))
         statement = (
             delete(models.Clip)
             .where(models.Clip.id == clip_id)
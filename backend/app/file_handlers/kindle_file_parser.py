@@ -2,7 +2,7 @@
 from datetime import datetime
 import io
 import re
-from typing import BinaryIO, Dict, List, Optional, Tuple
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
 
 from app.config import AUTHOR_SEPARATOR
 from app.schemas import (
@@ -112,10 +112,10 @@ def extract_annotations_from_file(filename: str) -> List[BookAnnotation]:
         return annotations
 
 
-def extract_annotations_from_buffer(file: BinaryIO) -> List[BookAnnotation]:
+def iter_annotations_from_buffer(file: BinaryIO) -> Iterator[BookAnnotation]:
     """
-    Extracts annotations from buffer of bytes and returns those in order they
-    appear in the file.
+    Extracts annotations from buffer of bytes and yields those in order they
+    appear in the file, reading one line at a time.
 
     The way clippings.io does it is to check for the existence of the
     title, author and page information. If these exist then ok.
@@ -127,7 +127,6 @@ def extract_annotations_from_buffer(file: BinaryIO) -> List[BookAnnotation]:
     parsed_title = False
     parsed_metadata = False
     separator = "=========="
-    annotations = []
     content = ""
     for line in io.TextIOWrapper(file, encoding="utf-8-sig"):
         # \ufeff is the BOM (byte order mark) character
@@ -166,7 +165,7 @@ def extract_annotations_from_buffer(file: BinaryIO) -> List[BookAnnotation]:
             )
 
             if is_valid_annotation(annotation):
-                annotations.append(annotation)
+                yield annotation
 
             parsed_title = False
             parsed_metadata = False
@@ -187,9 +186,15 @@ def extract_annotations_from_buffer(file: BinaryIO) -> List[BookAnnotation]:
             date_annotated=date_annotated,
         )
         if is_valid_annotation(annotation):
-            annotations.append(annotation)
+            yield annotation
+
 
-    return annotations
+def extract_annotations_from_buffer(file: BinaryIO) -> List[BookAnnotation]:
+    """
+    Extracts annotations from buffer of bytes and returns those in order they
+    appear in the file.
+    """
+    return list(iter_annotations_from_buffer(file))
 
 
 def is_valid_annotation(annotation: BookAnnotation) -> bool:
@@ -1,9 +1,149 @@
+import asyncio
 import os
+from typing import Optional
 
-from app.config import EMBEDDING_MODEL
-from app.index.openai import OpenAIEmbedder
+from app.config import (
+    EMBEDDING_BACKEND,
+    EMBEDDING_BATCH_MAX_TOKENS,
+    EMBEDDING_BATCH_SIZE,
+    EMBEDDING_CACHE_PERSISTENT,
+    EMBEDDING_CACHE_SIZE,
+    EMBEDDING_DIMENSIONS,
+    EMBEDDING_LONG_AGGREGATION,
+    EMBEDDING_MAX_CONCURRENCY,
+    EMBEDDING_MAX_RETRIES,
+    EMBEDDING_MODEL,
+    EMBEDDING_PREVIOUS_MODEL,
+    EMBEDDING_REQUESTS_PER_MINUTE,
+    EMBEDDING_TOKENS_PER_MINUTE,
+    LOCAL_EMBEDDING_BATCH_SIZE,
+    LOCAL_EMBEDDING_ONNX_FILE,
+    LOCAL_EMBEDDING_RUNTIME,
+    LOCAL_EMBEDDING_WORKERS,
+    OPENAI_BASE_URL,
+)
+from app.db.database import SessionLocal
+from app.index.cache import EmbeddingCache
+from app.index.openai import AsyncOpenAIEmbedder, OpenAIEmbedder
+from app.index.vectoriser import LocalEmbedder
 
 api_key = os.getenv("OPENAI_API_KEY", "")
 
-# Doesn't work with openai embedding model
-embedding_model = OpenAIEmbedder(api_key=api_key, model_name=EMBEDDING_MODEL)
+
+def create_embedding_models(
+    model_name: str,
+) -> tuple[
+    EmbeddingCache, OpenAIEmbedder | LocalEmbedder, AsyncOpenAIEmbedder | None
+]:
+    """
+    Creates the cache, embedder and async embedder for a model using the
+    configured backend. Local models embed in process so have no async
+    counterpart.
+    """
+    cache = EmbeddingCache(
+        model_name=model_name,
+        dimensions=EMBEDDING_DIMENSIONS,
+        maxsize=EMBEDDING_CACHE_SIZE,
+        session_factory=SessionLocal if EMBEDDING_CACHE_PERSISTENT else None,
+    )
+
+    if EMBEDDING_BACKEND == "local":
+        embedder = LocalEmbedder(
+            model_name=model_name,
+            dimensions=EMBEDDING_DIMENSIONS,
+            batch_size=LOCAL_EMBEDDING_BATCH_SIZE,
+            num_workers=LOCAL_EMBEDDING_WORKERS,
+            backend=LOCAL_EMBEDDING_RUNTIME,
+            onnx_file=LOCAL_EMBEDDING_ONNX_FILE,
+            cache=cache,
+        )
+        return cache, embedder, None
+
+    embedder = OpenAIEmbedder(
+        api_key=api_key,
+        model_name=model_name,
+        batch_size=EMBEDDING_BATCH_SIZE,
+        max_batch_tokens=EMBEDDING_BATCH_MAX_TOKENS,
+        cache=cache,
+        aggregation=EMBEDDING_LONG_AGGREGATION,
+        dimensions=EMBEDDING_DIMENSIONS,
+        base_url=OPENAI_BASE_URL,
+        max_retries=EMBEDDING_MAX_RETRIES,
+    )
+    async_embedder = AsyncOpenAIEmbedder(
+        api_key=api_key,
+        model_name=model_name,
+        batch_size=EMBEDDING_BATCH_SIZE,
+        max_batch_tokens=EMBEDDING_BATCH_MAX_TOKENS,
+        cache=cache,
+        aggregation=EMBEDDING_LONG_AGGREGATION,
+        dimensions=EMBEDDING_DIMENSIONS,
+        base_url=OPENAI_BASE_URL,
+        max_concurrency=EMBEDDING_MAX_CONCURRENCY,
+        requests_per_minute=EMBEDDING_REQUESTS_PER_MINUTE,
+        tokens_per_minute=EMBEDDING_TOKENS_PER_MINUTE,
+        max_retries=EMBEDDING_MAX_RETRIES,
+    )
+    return cache, embedder, async_embedder
+
+
+# async_embedding_model is used for bulk indexing where many batches can be
+# sent concurrently.
+embedding_cache, embedding_model, async_embedding_model = (
+    create_embedding_models(EMBEDDING_MODEL)
+)
+
+# While embeddings are migrated to a new model, queries also need embedding
+# with the previous model to search the embeddings not yet migrated.
+previous_embedding_model = None
+if EMBEDDING_PREVIOUS_MODEL:
+    _, previous_embedding_model, _ = create_embedding_models(
+        EMBEDDING_PREVIOUS_MODEL
+    )
+
+
+def _in_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+def embed_passages(
+    texts: list[str], token_counts: Optional[list[int]] = None
+) -> list[list[float]]:
+    """
+    Embeds texts for indexing with the configured backend, sending
+    requests concurrently when the backend supports it. Token counts
+    recorded at chunking time save tokenising the texts again.
+
+    asyncio.run cannot be used inside a running event loop, so there the
+    texts are embedded synchronously. Async code should await
+    aembed_passages instead.
+    """
+    if async_embedding_model is not None and not _in_event_loop():
+        return asyncio.run(
+            async_embedding_model.aembed(texts, token_counts=token_counts)
+        )
+    if isinstance(embedding_model, LocalEmbedder):
+        return embedding_model.embed(texts)
+    return embedding_model.embed(texts, token_counts=token_counts)
+
+
+async def aembed_passages(
+    texts: list[str], token_counts: Optional[list[int]] = None
+) -> list[list[float]]:
+    """
+    Embeds texts for indexing from async code. Local models embed in a
+    worker thread so the event loop is not blocked.
+    """
+    if async_embedding_model is not None:
+        return await async_embedding_model.aembed(
+            texts, token_counts=token_counts
+        )
+    if isinstance(embedding_model, LocalEmbedder):
+        return await asyncio.to_thread(embedding_model.embed, texts)
+    return await asyncio.to_thread(
+        embedding_model.embed, texts, token_counts=token_counts
+    )
@@ -0,0 +1,97 @@
+"""
+Consistency checks of the search index against the clips it was built
+from. Every check runs as set based SQL so auditing a large library takes
+a few queries rather than one per clip.
+"""
+
+import logging
+from typing import Any, Optional
+
+from sqlalchemy.orm import Session
+
+from app.config import CHUNKING_STRATEGY, EMBEDDING_DIMENSIONS, EMBEDDING_MODEL
+from app.db import models, operations
+from app.index.chunking import get_chunker, is_known_strategy
+
+logger = logging.getLogger(__name__)
+
+CHECKS = ["missing", "stale_content", "stale_strategy", "bad_vector"]
+
+
+def audit_index(
+    db: Session, user_id: Optional[str] = None, sample_size: int = 5
+) -> dict[str, Any]:
+    """
+    Counts the clips failing each check, with a sample of their ids, the
+    chunks stored for each chunking strategy and whether it is known, and
+    the vectors whose dimensions differ from EMBEDDING_DIMENSIONS.
+    """
+    strategy = get_chunker(CHUNKING_STRATEGY).strategy_id
+    counts = operations.count_index_audit(
+        db, EMBEDDING_MODEL, strategy, EMBEDDING_DIMENSIONS, user_id
+    )
+    samples = {
+        check: [
+            str(clip.id)
+            for clip in operations.get_index_audit_sample(
+                db,
+                check,
+                EMBEDDING_MODEL,
+                strategy,
+                EMBEDDING_DIMENSIONS,
+                user_id,
+                sample_size,
+            )
+        ]
+        for check in CHECKS
+        if counts[check] and sample_size
+    }
+    strategies = operations.count_embeddings_by_strategy(
+        db, EMBEDDING_MODEL, user_id
+    )
+    return {
+        "embedding_model": EMBEDDING_MODEL,
+        "chunking_strategy": strategy,
+        "clips": counts["clips"],
+        "failing": {check: counts[check] for check in CHECKS},
+        "samples": samples,
+        "strategies": {
+            name: {
+                "chunks": count,
+                "current": name == strategy,
+                "known": is_known_strategy(name),
+            }
+            for name, count in strategies.items()
+        },
+        "bad_dimension_vectors": operations.count_bad_dimension_vectors(
+            db, EMBEDDING_MODEL, EMBEDDING_DIMENSIONS
+        ),
+    }
+
+
+def repair_index(
+    db: Session, user_id: Optional[str] = None
+) -> list[models.IndexJob]:
+    """
+    Deletes vectors with the wrong dimensions so they are embedded again,
+    then queues one index job per user for every clip failing a check.
+    """
+    deleted = operations.delete_bad_dimension_vectors(
+        db, EMBEDDING_MODEL, EMBEDDING_DIMENSIONS
+    )
+    if deleted:
+        logger.info(f"Deleted {deleted} vectors with the wrong dimensions")
+
+    strategy = get_chunker(CHUNKING_STRATEGY).strategy_id
+    rows = operations.get_clips_failing_index_audit(
+        db, EMBEDDING_MODEL, strategy, EMBEDDING_DIMENSIONS, user_id
+    )
+    clip_ids: dict[str, list] = {}
+    for clip_user_id, clip_id in rows:
+        clip_ids.setdefault(clip_user_id, []).append(clip_id)
+
+    jobs = []
+    for clip_user_id, ids in clip_ids.items():
+        jobs.append(operations.create_index_job(db, clip_user_id, ids))
+        logger.info(f"Queued {len(ids)} clips of user {clip_user_id}")
+    return jobs
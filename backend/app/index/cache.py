@@ -0,0 +1,182 @@
+"""
+Caches for embeddings so the same text is not sent to the embedding model
+more than once.
+"""
+
+from collections import OrderedDict
+import logging
+from threading import Lock
+import time
+from typing import Callable, Optional
+
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from app.db import operations
+from app.utils import hash_content
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """
+    Thread safe least recently used cache. When ttl is given, entries
+    expire that many seconds after they were set.
+    """
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None) -> None:
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._items: OrderedDict = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                return None
+            value, expires_at = self._items[key]
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value) -> None:
+        if self._maxsize <= 0:
+            return
+
+        expires_at = time.monotonic() + self._ttl if self._ttl else None
+        with self._lock:
+            self._items[key] = (value, expires_at)
+            self._items.move_to_end(key)
+            while len(self._items) > self._maxsize:
+                self._items.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+class EmbeddingCache:
+    """
+    Content addressed embedding cache keyed on the model name, the output
+    dimensions and the hash of the preprocessed text.
+
+    Lookups check an in-process LRU first and then the persistent
+    embedding_cache table when a session factory is given. Failures to reach
+    the database are logged and treated as misses so embedding still works.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        dimensions: int,
+        maxsize: int = 10000,
+        session_factory: Optional[Callable[[], Session]] = None,
+    ) -> None:
+        self._model_name = model_name
+        self._dimensions = dimensions
+        self._memory = LRUCache(maxsize)
+        self._session_factory = session_factory
+        self._lock = Lock()
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    def _key(self, content_hash: str) -> tuple[str, int, str]:
+        return (self._model_name, self._dimensions, content_hash)
+
+    def get_many(self, texts: list[str]) -> list[Optional[list[float]]]:
+        """
+        Returns the cached embedding for each text, or None where the text
+        has not been embedded before.
+        """
+        hashes = [hash_content(text) for text in texts]
+        embeddings = [self._memory.get(self._key(h)) for h in hashes]
+        memory_hits = sum(e is not None for e in embeddings)
+
+        missing = {h for h, e in zip(hashes, embeddings) if e is None}
+        db_hits = 0
+        if missing and self._session_factory:
+            found = self._get_persisted(list(missing))
+            for i, h in enumerate(hashes):
+                if embeddings[i] is None and h in found:
+                    embeddings[i] = found[h]
+                    self._memory.set(self._key(h), found[h])
+                    db_hits += 1
+
+        with self._lock:
+            self.memory_hits += memory_hits
+            self.db_hits += db_hits
+            self.misses += len(texts) - memory_hits - db_hits
+
+        return embeddings
+
+    def set_many(self, texts: list[str], embeddings: list) -> None:
+        """Adds newly computed embeddings to the cache."""
+        values = {}
+        for text, embedding in zip(texts, embeddings):
+            content_hash = hash_content(text)
+            self._memory.set(self._key(content_hash), embedding)
+            values[content_hash] = {
+                "model_name": self._model_name,
+                "dimensions": self._dimensions,
+                "content_hash": content_hash,
+                "embedding": embedding,
+            }
+
+        if values and self._session_factory:
+            self._persist(list(values.values()))
+
+    def get_or_embed(
+        self,
+        texts: list[str],
+        embed_fn: Callable[[list[str]], list],
+    ) -> list:
+        """
+        Returns embeddings for the texts, only calling embed_fn for texts
+        that are not cached. Repeated texts are embedded once.
+        """
+        embeddings = self.get_many(texts)
+        missing = list(
+            dict.fromkeys(t for t, e in zip(texts, embeddings) if e is None)
+        )
+        if not missing:
+            return embeddings
+
+        new_embeddings = embed_fn(missing)
+        self.set_many(missing, new_embeddings)
+        computed = dict(zip(missing, new_embeddings))
+        return [
+            computed[t] if e is None else e for t, e in zip(texts, embeddings)
+        ]
+
+    def stats(self) -> dict[str, int | float]:
+        """Hit and miss counters since the cache was created."""
+        with self._lock:
+            lookups = self.memory_hits + self.db_hits + self.misses
+            hits = self.memory_hits + self.db_hits
+            return {
+                "memory_hits": self.memory_hits,
+                "db_hits": self.db_hits,
+                "misses": self.misses,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "memory_size": len(self._memory),
+            }
+
+    def _get_persisted(self, content_hashes: list[str]) -> dict[str, list]:
+        try:
+            with self._session_factory() as db:
+                rows = operations.get_cached_embeddings(
+                    db, self._model_name, self._dimensions, content_hashes
+                )
+                return {row.content_hash: row.embedding for row in rows}
+        except SQLAlchemyError as e:
+            logger.error(f"Could not read embedding cache: {e}")
+            return {}
+
+    def _persist(self, values: list[dict]) -> None:
+        try:
+            with self._session_factory() as db:
+                operations.insert_cached_embeddings(db, values)
+        except SQLAlchemyError as e:
+            logger.error(f"Could not write embedding cache: {e}")
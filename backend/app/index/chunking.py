@@ -0,0 +1,273 @@
+"""
+Chunking strategies that can be selected per deployment with
+CHUNKING_STRATEGY.
+
+A strategy id names the chunker and its parameters and is stored on every
+chunk it produces, for example
+
+- sent-group-3-overlap-1: groups of 3 sentences overlapping by 1 sentence
+- token-window-256-overlap-32: windows of 256 tokens overlapping by 32
+- token-pack-200-overlap-40: sentences packed into chunks of up to 200
+  tokens, repeating up to 40 tokens of trailing sentences in the next chunk
+- whole-clip: the whole clip as a single chunk
+
+Chunkers also return the token count of each chunk, counted once with the
+cached tiktoken encoder, so it can be stored and reused when batching
+embedding requests and packing LLM context.
+"""
+
+from abc import ABC, abstractmethod
+from functools import lru_cache
+import re
+from typing import Callable, Optional
+
+from app.config import CHUNKING_STRATEGY, MIN_CHUNK_SIZE
+from app.index.openai import get_encoding, num_tokens_from_string
+from app.index.preprocessing import (
+    chunk_texts,
+    multisentence_tokeniser,
+    split_sentences,
+)
+
+DEFAULT_CHUNKING_STRATEGY = "sent-group-3-overlap-1"
+
+
+class Chunker(ABC):
+    """Splits clips into the chunks that are embedded."""
+
+    strategy_id: str
+
+    @abstractmethod
+    def chunk(self, text: str) -> list[str]:
+        """Splits one text into its chunks."""
+
+    def chunk_many(self, texts: list[str]) -> list[list[str]]:
+        """Chunks each text, returning the chunks in input order."""
+        return [self.chunk(text) for text in texts]
+
+    def chunk_with_counts(self, text: str) -> list[tuple[str, int]]:
+        """Chunks the text and returns each chunk with its token count."""
+        return [
+            (chunk, num_tokens_from_string(chunk))
+            for chunk in self.chunk(text)
+        ]
+
+    def chunk_many_with_counts(
+        self, texts: list[str]
+    ) -> list[list[tuple[str, int]]]:
+        """Chunks each text, pairing every chunk with its token count."""
+        return [
+            [(chunk, num_tokens_from_string(chunk)) for chunk in chunks]
+            for chunks in self.chunk_many(texts)
+        ]
+
+
+class SentenceGroupChunker(Chunker):
+    """Groups of max_sentences sentences overlapping by group_overlap."""
+
+    def __init__(self, max_sentences: int, group_overlap: int) -> None:
+        self.max_sentences = max_sentences
+        self.group_overlap = group_overlap
+        self.strategy_id = (
+            f"sent-group-{max_sentences}-overlap-{group_overlap}"
+        )
+
+    def chunk(self, text: str) -> list[str]:
+        return multisentence_tokeniser(
+            text,
+            self.max_sentences,
+            self.group_overlap,
+            min_characters=MIN_CHUNK_SIZE,
+        )
+
+    def chunk_many(self, texts: list[str]) -> list[list[str]]:
+        # Large imports are chunked across a process pool
+        return chunk_texts(
+            texts,
+            self.max_sentences,
+            self.group_overlap,
+            min_characters=MIN_CHUNK_SIZE,
+        )
+
+
+class TokenWindowChunker(Chunker):
+    """
+    Fixed windows of window_size tokens, each starting overlap tokens before
+    the end of the previous one. Windows ignore sentence boundaries.
+    """
+
+    def __init__(
+        self,
+        window_size: int,
+        overlap: int,
+        encoding_name: str = "cl100k_base",
+    ) -> None:
+        if overlap < 0 or overlap >= window_size:
+            raise ValueError(
+                "Overlap must be non-negative and less than the window size."
+            )
+
+        self.window_size = window_size
+        self.overlap = overlap
+        self.encoding_name = encoding_name
+        self.strategy_id = f"token-window-{window_size}-overlap-{overlap}"
+
+    def chunk(self, text: str) -> list[str]:
+        encoding = get_encoding(self.encoding_name)
+        tokens = encoding.encode(text)
+        chunks = []
+        step = self.window_size - self.overlap
+        for start in range(0, len(tokens), step):
+            window = tokens[start : start + self.window_size]
+            chunk = encoding.decode(window).strip()
+            if chunk:
+                chunks.append(chunk)
+            if start + self.window_size >= len(tokens):
+                break
+        return chunks
+
+
+class TokenPackChunker(Chunker):
+    """
+    Packs whole sentences into chunks of at most target_tokens. Each chunk
+    starts with the trailing sentences of the previous one that fit within
+    overlap tokens. Sentences longer than target_tokens are split on token
+    boundaries.
+
+    Like the sentence group chunker, a final chunk adding fewer than
+    min_characters of new text is merged into the previous chunk, which may
+    then run slightly over target_tokens.
+    """
+
+    def __init__(
+        self,
+        target_tokens: int,
+        overlap: int,
+        encoding_name: str = "cl100k_base",
+        min_characters: int = MIN_CHUNK_SIZE,
+    ) -> None:
+        if overlap < 0 or overlap >= target_tokens:
+            raise ValueError(
+                "Overlap must be non-negative and less than the target size."
+            )
+
+        self.target_tokens = target_tokens
+        self.overlap = overlap
+        self.encoding_name = encoding_name
+        self.min_characters = min_characters
+        self.strategy_id = f"token-pack-{target_tokens}-overlap-{overlap}"
+
+    def _sentences(self, text: str) -> list[tuple[str, int]]:
+        """Sentences with their token counts, none above the target."""
+        encoding = get_encoding(self.encoding_name)
+        sentences = []
+        for sentence in split_sentences(text):
+            tokens = encoding.encode(sentence)
+            for start in range(0, len(tokens), self.target_tokens):
+                window = tokens[start : start + self.target_tokens]
+                sentences.append((encoding.decode(window), len(window)))
+        return sentences
+
+    def chunk_with_counts(self, text: str) -> list[tuple[str, int]]:
+        groups = []
+        current: list[tuple[str, int]] = []
+        current_tokens = 0
+        # Sentences at the start of current repeated from the previous group
+        n_carried = 0
+        for sentence, n_tokens in self._sentences(text):
+            if current and current_tokens + n_tokens > self.target_tokens:
+                groups.append(current)
+                # Carry trailing sentences into the next chunk
+                carried: list[tuple[str, int]] = []
+                carried_tokens = 0
+                for previous, k in reversed(current):
+                    if carried_tokens + k > self.overlap:
+                        break
+                    carried.insert(0, (previous, k))
+                    carried_tokens += k
+                if carried_tokens + n_tokens > self.target_tokens:
+                    carried, carried_tokens = [], 0
+                current, current_tokens = carried, carried_tokens
+                n_carried = len(carried)
+
+            current.append((sentence, n_tokens))
+            current_tokens += n_tokens
+
+        new = current[n_carried:]
+        if groups and len(" ".join(s for s, _ in new)) < self.min_characters:
+            # Too little new text for a chunk of its own
+            groups[-1].extend(new)
+        elif current:
+            groups.append(current)
+
+        # Joining can merge tokens at the boundaries so count each chunk
+        chunks = [" ".join(s for s, _ in group).strip() for group in groups]
+        return [
+            (chunk, num_tokens_from_string(chunk, self.encoding_name))
+            for chunk in chunks
+            if chunk
+        ]
+
+    def chunk(self, text: str) -> list[str]:
+        return [chunk for chunk, _ in self.chunk_with_counts(text)]
+
+    def chunk_many_with_counts(
+        self, texts: list[str]
+    ) -> list[list[tuple[str, int]]]:
+        return [self.chunk_with_counts(text) for text in texts]
+
+
+class WholeClipChunker(Chunker):
+    """Embeds each clip whole, which suits short highlights."""
+
+    strategy_id = "whole-clip"
+
+    def chunk(self, text: str) -> list[str]:
+        text = text.strip()
+        return [text] if text else []
+
+
+# Strategy id patterns and the chunker each one builds
+CHUNKERS: list[tuple[re.Pattern, Callable[[re.Match], Chunker]]] = [
+    (
+        re.compile(r"sent-group-(\d+)-overlap-(\d+)"),
+        lambda m: SentenceGroupChunker(int(m[1]), int(m[2])),
+    ),
+    (
+        re.compile(r"token-window-(\d+)-overlap-(\d+)"),
+        lambda m: TokenWindowChunker(int(m[1]), int(m[2])),
+    ),
+    (
+        re.compile(r"token-pack-(\d+)-overlap-(\d+)"),
+        lambda m: TokenPackChunker(int(m[1]), int(m[2])),
+    ),
+    (re.compile(r"whole-clip"), lambda m: WholeClipChunker()),
+]
+
+
+def register_chunker(
+    pattern: str, factory: Callable[[re.Match], Chunker]
+) -> None:
+    """Adds a chunker built for strategy ids matching the pattern."""
+    CHUNKERS.append((re.compile(pattern), factory))
+
+
+@lru_cache(maxsize=None)
+def get_chunker(strategy: Optional[str] = CHUNKING_STRATEGY) -> Chunker:
+    """
+    Returns the chunker for a strategy id, defaulting to
+    DEFAULT_CHUNKING_STRATEGY when none is configured.
+    """
+    strategy = strategy or DEFAULT_CHUNKING_STRATEGY
+    for pattern, factory in CHUNKERS:
+        match = pattern.fullmatch(strategy)
+        if match:
+            return factory(match)
+    raise ValueError(f"Unknown chunking strategy {strategy}")
+
+
+def is_known_strategy(strategy: Optional[str]) -> bool:
+    """True if the strategy id can be built by a registered chunker."""
+    if not strategy:
+        return False
+    return any(pattern.fullmatch(strategy) for pattern, _ in CHUNKERS)
@@ -1,49 +1,197 @@
-# from uuid import uuid4
-
-# from redis import Redis
-# from rq import Queue
+from collections.abc import Callable
+from datetime import timedelta
+import logging
+from typing import Optional
 
 from sqlalchemy.orm import Session
 
-from app.config import MIN_CHUNK_SIZE
+from app.config import (
+    CHUNKING_STRATEGY,
+    EMBEDDING_DIMENSIONS,
+    EMBEDDING_MODEL,
+    INDEX_JOB_MAX_ATTEMPTS,
+    INDEX_JOB_RETRY_DELAY,
+)
 from app.db import models
-from app.db.operations import insert_embeddings
-from app.index.preprocessing import multisentence_tokeniser
-from app.index import embedding_model
+from app.db import operations
+from app.index.chunking import get_chunker
+from app.index import embed_passages, embedding_cache
+from app.utils import hash_content
+
+logger = logging.getLogger(__name__)
 
 
 def index_content(
     db: Session,
-    documents: list[models.Document],
+    documents: list[models.Clip],
 ) -> None:
     """
     Index content into the search index.
+
+    Any existing chunks of the clips are replaced, so this can be used both
+    for new clips and to re-index edited ones.
     """
+    chunker = get_chunker(CHUNKING_STRATEGY)
+    chunked_contents = chunker.chunk_many_with_counts(
+        [doc.content for doc in documents]
+    )
+    chunks = []
+    for doc, chunked_content in zip(documents, chunked_contents):
+        for chunk, token_count in chunked_content:
+            chunks.append((doc, chunk, token_count))
+
+    chunk_hashes, vectors = embed_new_chunks(
+        db,
+        [chunk for _, chunk, _ in chunks],
+        token_counts=[token_count for _, _, token_count in chunks],
+    )
     embedding_rows = []
-    for doc in documents:
-        content = doc.content
-        group_overlap = 1
-        max_sentences = 3
-        chunking_strategy = (
-            "sent-group-{max_sentences}-overlap-{group_overlap}"
+    for (doc, chunk, token_count), chunk_hash in zip(chunks, chunk_hashes):
+        embedding_rows.append(
+            models.Embedding(
+                source_id=doc.id,
+                user_id=doc.user_id,
+                chunk_content=chunk,
+                cleaned_chunk=chunk,
+                chunking_strategy=chunker.strategy_id,
+                source_hash=doc.content_hash,
+                chunk_hash=chunk_hash,
+                token_count=token_count,
+                embedding_model=EMBEDDING_MODEL,
+                embedding_dimensions=EMBEDDING_DIMENSIONS,
+            )
         )
-        # There may be token limit considerations for embedding models.
-        chunked_content = multisentence_tokeniser(
-            content,
-            max_sentences,
-            group_overlap,
-            min_characters=MIN_CHUNK_SIZE,
+
+    operations.replace_clip_embeddings(
+        db,
+        [doc.id for doc in documents],
+        embedding_rows,
+        EMBEDDING_MODEL,
+        vectors,
+    )
+
+
+def embed_new_chunks(
+    db: Session,
+    chunks: list[str],
+    embedding_model: str = EMBEDDING_MODEL,
+    embed_fn: Callable[..., list] = embed_passages,
+    token_counts: Optional[list[int]] = None,
+) -> tuple[list[str], list[models.ChunkVector]]:
+    """
+    Returns the hash of each chunk and vectors for the chunks that have not
+    been embedded with the model before. Text already in chunk_vector, from
+    any clip or user, is not embedded again. Token counts of the chunks, if
+    known, are passed on to the embedder.
+    """
+    chunk_hashes = [hash_content(chunk) for chunk in chunks]
+    existing = operations.get_existing_chunk_hashes(
+        db, embedding_model, list(set(chunk_hashes))
+    )
+    new_chunks = {}
+    new_token_counts = {}
+    for i, (chunk_hash, chunk) in enumerate(zip(chunk_hashes, chunks)):
+        if chunk_hash not in existing:
+            new_chunks[chunk_hash] = chunk
+            if token_counts:
+                new_token_counts[chunk_hash] = token_counts[i]
+    logger.info(
+        f"Embedding {len(new_chunks)} new chunks, "
+        f"{len(chunks) - len(new_chunks)} already embedded"
+    )
+    if not new_chunks:
+        return chunk_hashes, []
+
+    # Embed all chunks together so they are sent in as few requests as
+    # possible, with the batches running concurrently within rate limits.
+    if new_token_counts:
+        embeddings = embed_fn(
+            list(new_chunks.values()),
+            token_counts=list(new_token_counts.values()),
         )
-        for chunk in chunked_content:
-            embedding = embedding_model.embed(chunk)
-            embedding_rows.append(
-                models.Embedding(
-                    source_id=doc.id,
-                    chunk_content=content,
-                    cleaned_chunk=content,
-                    chunking_strategy=chunking_strategy,
-                    embedding=embedding,
-                )
-            )
+    else:
+        embeddings = embed_fn(list(new_chunks.values()))
+    logger.info(f"Embedding cache stats: {embedding_cache.stats()}")
+    vectors = [
+        models.ChunkVector(
+            chunk_hash=chunk_hash,
+            embedding_model=embedding_model,
+            embedding_dimensions=EMBEDDING_DIMENSIONS,
+            embedding=embedding,
+        )
+        for chunk_hash, embedding in zip(new_chunks, embeddings)
+    ]
+    return chunk_hashes, vectors
+
 
-    insert_embeddings(db, embedding_rows)
+def index_stale_clips(
+    db: Session, user_id: Optional[str] = None, batch_size: int = 100
+) -> int:
+    """
+    Re-chunks and re-embeds only the clips that have no embeddings from the
+    current model and chunking strategy, or whose content changed since they
+    were embedded.
+    Returns the number of clips indexed.
+    """
+    strategy = get_chunker(CHUNKING_STRATEGY).strategy_id
+    total = operations.count_clips_needing_index(
+        db, EMBEDDING_MODEL, user_id, strategy
+    )
+    logger.info(f"{total} clips need indexing")
+
+    indexed = 0
+    after_id = None
+    while True:
+        clips = operations.get_clips_needing_index(
+            db, EMBEDDING_MODEL, user_id, after_id, batch_size, strategy
+        )
+        if not clips:
+            break
+
+        index_content(db, clips)
+        indexed += len(clips)
+        after_id = clips[-1].id
+        logger.info(f"Indexed {indexed}/{total} stale clips")
+
+    return indexed
+
+
+def run_index_job(
+    db: Session, job: models.IndexJob, batch_size: int = 100
+) -> None:
+    """
+    Chunks and embeds the clips of a claimed job in batches, recording
+    progress after each batch. Clips deleted since the job was queued are
+    skipped.
+
+    A retried job carries on from its recorded progress. A job that fails
+    is queued again with exponential backoff until it has been tried
+    INDEX_JOB_MAX_ATTEMPTS times, then marked as failed.
+    """
+    logger.info(f"Running index job {job.id} for {job.total} clips")
+    try:
+        processed = job.processed
+        for start in range(processed, len(job.clip_ids), batch_size):
+            clip_ids = job.clip_ids[start : start + batch_size]
+            clips = operations.get_clips_by_ids(db, clip_ids)
+            index_content(db, clips)
+            processed += len(clip_ids)
+            operations.update_index_job_progress(db, job, processed)
+            logger.info(f"Index job {job.id}: {processed}/{job.total}")
+
+        operations.finish_index_job(db, job)
+    except Exception as e:
+        db.rollback()
+        if job.attempts < INDEX_JOB_MAX_ATTEMPTS:
+            delay = timedelta(
+                seconds=INDEX_JOB_RETRY_DELAY * 2 ** (job.attempts - 1)
+            )
+            logger.warning(
+                f"Index job {job.id} failed on attempt {job.attempts}, "
+                f"retrying in {delay}: {e}"
+            )
+            operations.requeue_index_job(db, job, str(e), delay)
+        else:
+            logger.error(f"Index job {job.id} failed: {e}")
+            operations.finish_index_job(db, job, error=str(e))
+        raise e
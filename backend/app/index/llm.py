@@ -8,7 +8,11 @@ from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_openai import ChatOpenAI
 
-from app.config import QUERY_DECOMPOSITION_MODEL, ANSWER_MODEL
+from app.config import (
+    ANSWER_MODEL,
+    OPENAI_BASE_URL,
+    QUERY_DECOMPOSITION_MODEL,
+)
 from app.index.prompts import (
     answer_message,
     query_decomposition_message,
@@ -17,8 +21,10 @@ from app.index.prompts import (
 
 logger = logging.getLogger(__name__)
 
-query_decomposition_model = ChatOpenAI(model=QUERY_DECOMPOSITION_MODEL)
-answer_model = ChatOpenAI(model=ANSWER_MODEL)
+query_decomposition_model = ChatOpenAI(
+    model=QUERY_DECOMPOSITION_MODEL, base_url=OPENAI_BASE_URL
+)
+answer_model = ChatOpenAI(model=ANSWER_MODEL, base_url=OPENAI_BASE_URL)
 
 
 def generate_query_variants(user_query: str, max_variants: int) -> list[str]:
@@ -0,0 +1,189 @@
+"""
+Re-embeds existing chunks when the embedding model changes.
+
+Chunks embedded with EMBEDDING_PREVIOUS_MODEL are embedded again with
+EMBEDDING_MODEL in small batches, alongside the old embeddings. Retrieval
+reads from both models until every chunk has been migrated, after which the
+old embeddings are deleted.
+"""
+
+import logging
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from app.config import (
+    EMBEDDING_DIMENSIONS,
+    EMBEDDING_MODEL,
+    EMBEDDING_PREVIOUS_MODEL,
+)
+from app.db import models, operations
+from app.index.index_job import embed_new_chunks
+
+logger = logging.getLogger(__name__)
+
+# Brings tables created before embeddings recorded their model up to date
+PREPARE_STATEMENTS = [
+    "ALTER TABLE document_embeddings "
+    "ADD COLUMN IF NOT EXISTS embedding_model VARCHAR",
+    "ALTER TABLE document_embeddings "
+    "ADD COLUMN IF NOT EXISTS embedding_dimensions INTEGER",
+    "ALTER TABLE document_embeddings "
+    "ADD COLUMN IF NOT EXISTS source_hash VARCHAR(32)",
+    "ALTER TABLE document_embeddings "
+    "DROP CONSTRAINT IF EXISTS unique_embedding",
+    "ALTER TABLE document_embeddings ADD CONSTRAINT unique_embedding "
+    "UNIQUE (source_id, chunk_content, embedding_model)",
+    "ALTER TABLE document_embeddings "
+    "ADD COLUMN IF NOT EXISTS chunk_hash VARCHAR(32)",
+    "ALTER TABLE document_embeddings "
+    "ADD COLUMN IF NOT EXISTS token_count INTEGER",
+    "ALTER TABLE document_embeddings ADD COLUMN IF NOT EXISTS user_id UUID "
+    'REFERENCES "user" (id) ON DELETE CASCADE',
+    "UPDATE document_embeddings e SET user_id = c.user_id FROM clip c "
+    "WHERE e.source_id = c.id AND e.user_id IS NULL",
+    "ALTER TABLE document_embeddings ALTER COLUMN user_id SET NOT NULL",
+    "CREATE INDEX IF NOT EXISTS ix_document_embeddings_user_model "
+    "ON document_embeddings (user_id, embedding_model)",
+]
+
+# Moves vectors stored on each chunk into the shared chunk_vector table.
+# Chunks with no recorded model are assigned the model in use before any
+# migration so their vectors can be keyed on it.
+#
+# Chunks from before source_hash was recorded stored the whole clip as
+# chunk_content next to the vector of one group of its sentences, so their
+# text does not match their vector. They are keyed on their own id rather
+# than their text so no other chunk can share the wrong vector. They stay
+# searchable until reindexed, which their missing source_hash forces.
+NORMALISE_STATEMENTS = [
+    "UPDATE document_embeddings SET embedding_model = :legacy_model "
+    "WHERE embedding_model IS NULL",
+    "UPDATE document_embeddings SET chunk_hash = md5('legacy:' || id) "
+    "WHERE chunk_hash IS NULL AND source_hash IS NULL",
+    "UPDATE document_embeddings SET chunk_hash = md5(chunk_content) "
+    "WHERE chunk_hash IS NULL",
+    "INSERT INTO chunk_vector "
+    "(chunk_hash, embedding_model, embedding_dimensions, embedding) "
+    "SELECT DISTINCT ON (chunk_hash, embedding_model) "
+    "chunk_hash, embedding_model, vector_dims(embedding), embedding "
+    "FROM document_embeddings "
+    "ON CONFLICT (chunk_hash, embedding_model) DO NOTHING",
+    "ALTER TABLE document_embeddings "
+    "DROP COLUMN IF EXISTS embedding_compressed, "
+    "DROP COLUMN IF EXISTS embedding_short, "
+    "DROP COLUMN IF EXISTS embedding",
+    "ALTER TABLE document_embeddings ALTER COLUMN chunk_hash SET NOT NULL",
+    "CREATE INDEX IF NOT EXISTS ix_document_embeddings_chunk_hash "
+    "ON document_embeddings (chunk_hash)",
+]
+
+# Chunks whose vector was deleted by the orphan sweep while they were being
+# written point at nothing. They are dropped, so their clips are reindexed
+# by the next sweep, before vectors are protected by a foreign key.
+FOREIGN_KEY_STATEMENTS = [
+    "DELETE FROM document_embeddings e WHERE NOT EXISTS ("
+    "SELECT 1 FROM chunk_vector v WHERE v.chunk_hash = e.chunk_hash "
+    "AND v.embedding_model = e.embedding_model)",
+    "ALTER TABLE document_embeddings "
+    "DROP CONSTRAINT IF EXISTS fk_document_embeddings_chunk_vector",
+    "ALTER TABLE document_embeddings "
+    "ADD CONSTRAINT fk_document_embeddings_chunk_vector "
+    "FOREIGN KEY (chunk_hash, embedding_model) "
+    "REFERENCES chunk_vector (chunk_hash, embedding_model) "
+    "ON DELETE RESTRICT",
+]
+
+
+def prepare_embeddings_table(db: Session) -> None:
+    """
+    Adds the model metadata columns to an existing embeddings table, moves
+    any vectors still stored on it into chunk_vector and links each chunk
+    to its vector with a foreign key.
+    """
+    try:
+        for statement in PREPARE_STATEMENTS:
+            db.execute(text(statement))
+
+        has_vectors = db.scalar(
+            text(
+                "SELECT EXISTS (SELECT 1 FROM information_schema.columns "
+                "WHERE table_name = 'document_embeddings' "
+                "AND column_name = 'embedding')"
+            )
+        )
+        if has_vectors:
+            legacy_model = EMBEDDING_PREVIOUS_MODEL or EMBEDDING_MODEL
+            for statement in NORMALISE_STATEMENTS:
+                db.execute(text(statement), {"legacy_model": legacy_model})
+        for statement in FOREIGN_KEY_STATEMENTS:
+            db.execute(text(statement))
+        db.commit()
+    except Exception as e:
+        print("Could not prepare embeddings table")
+        print(f"Error: {e}")
+        db.rollback()
+        raise e
+
+
+def remaining_chunks(db: Session) -> int:
+    """Number of chunks still to be embedded with the new model."""
+    return operations.count_unmigrated_chunks(
+        db, EMBEDDING_PREVIOUS_MODEL, EMBEDDING_MODEL
+    )
+
+
+def migrate_batch(db: Session, batch_size: int = 100) -> int:
+    """
+    Embeds the unmigrated chunks of the next batch_size clips with the new
+    model. Returns the number of chunks migrated, which is 0 once the
+    migration is done.
+    """
+    chunks = operations.get_unmigrated_chunks(
+        db, EMBEDDING_PREVIOUS_MODEL, EMBEDDING_MODEL, limit=batch_size
+    )
+    if not chunks:
+        return 0
+
+    token_counts = [chunk.token_count for chunk in chunks]
+    chunk_hashes, vectors = embed_new_chunks(
+        db,
+        [chunk.cleaned_chunk or chunk.chunk_content for chunk in chunks],
+        EMBEDDING_MODEL,
+        token_counts=token_counts if None not in token_counts else None,
+    )
+    rows = [
+        models.Embedding(
+            source_id=chunk.source_id,
+            user_id=chunk.user_id,
+            chunk_content=chunk.chunk_content,
+            cleaned_chunk=chunk.cleaned_chunk,
+            chunking_strategy=chunk.chunking_strategy,
+            source_hash=chunk.source_hash,
+            chunk_hash=chunk_hash,
+            token_count=chunk.token_count,
+            embedding_model=EMBEDDING_MODEL,
+            embedding_dimensions=EMBEDDING_DIMENSIONS,
+        )
+        for chunk, chunk_hash in zip(chunks, chunk_hashes)
+    ]
+    operations.insert_embeddings(db, rows, vectors)
+    return len(rows)
+
+
+def cutover(db: Session) -> int:
+    """
+    Deletes the previous model's embeddings once every chunk has been
+    migrated. Returns the number of embeddings deleted.
+    """
+    remaining = remaining_chunks(db)
+    if remaining:
+        raise ValueError(
+            f"{remaining} chunks have not been migrated to {EMBEDDING_MODEL}"
+        )
+
+    deleted = operations.delete_model_embeddings(db, EMBEDDING_PREVIOUS_MODEL)
+    logger.info(
+        f"Deleted {deleted} embeddings from {EMBEDDING_PREVIOUS_MODEL}"
+    )
+    return deleted
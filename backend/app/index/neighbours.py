@@ -0,0 +1,87 @@
+"""
+Keeps the precomputed similar clips of every clip up to date.
+
+A clip's list is rebuilt when the clip is new or edited, when it is
+indexed with a new embedding model, or when a clip in its list is edited
+or deleted. A new or edited clip may also belong in the lists of the clips
+near it, so those lists are marked stale and rebuilt after it.
+"""
+
+import logging
+from typing import Optional
+
+from sqlalchemy.orm import Session
+
+from app.config import CLIP_NEIGHBOURS_COUNT, EMBEDDING_MODEL
+from app.db import models, operations
+from app.index.vector_index import search_storage
+
+logger = logging.getLogger(__name__)
+
+
+def build_clip_neighbours(
+    db: Session, clip: models.Clip, count: int = CLIP_NEIGHBOURS_COUNT
+) -> list[tuple]:
+    """
+    Searches for the clip's most similar clips and stores them. Returns
+    the (clip id, score) pairs stored.
+    """
+    rows = operations.get_similar_clips(
+        db,
+        str(clip.user_id),
+        str(clip.id),
+        topk=count,
+        aggregation="mean",
+        storage=search_storage(),
+    )
+    neighbours = [(neighbour.id, score) for neighbour, _, score in rows]
+    operations.replace_clip_neighbours(
+        db, clip, EMBEDDING_MODEL, neighbours
+    )
+    return neighbours
+
+
+def refresh_clip_neighbours(
+    db: Session,
+    user_id: Optional[str] = None,
+    batch_size: int = 100,
+    limit: Optional[int] = None,
+) -> int:
+    """
+    Rebuilds the neighbour lists that are missing or out of date, stopping
+    after limit clips when given. Returns the number of lists rebuilt.
+    """
+    refreshed = 0
+    after_id = None
+    while limit is None or refreshed < limit:
+        if limit is not None:
+            batch_size = min(batch_size, limit - refreshed)
+        clips = operations.get_clips_needing_neighbours(
+            db, EMBEDDING_MODEL, user_id, after_id, batch_size
+        )
+        if not clips:
+            break
+
+        statuses = operations.get_clip_neighbour_statuses(
+            db, [clip.id for clip in clips]
+        )
+        # New or edited clips, read before any list is rebuilt
+        changed = {
+            clip.id
+            for clip in clips
+            if clip.id not in statuses
+            or statuses[clip.id].content_hash != clip.content_hash
+        }
+        for clip in clips:
+            neighbours = build_clip_neighbours(db, clip)
+            if clip.id in changed:
+                # The clip may now belong in its neighbours' lists
+                operations.mark_clip_neighbours_stale(
+                    db, [neighbour_id for neighbour_id, _ in neighbours]
+                )
+
+        refreshed += len(clips)
+        after_id = clips[-1].id
+        logger.info(f"Rebuilt neighbours of {refreshed} clips")
+
+    return refreshed
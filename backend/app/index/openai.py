@@ -2,72 +2,508 @@
 Code to initialise and interact with openai embedding model
 """
 
+import asyncio
+from functools import lru_cache
+import logging
+import random
+from threading import Lock
+import time
+from typing import Optional
+
 import numpy as np
 import openai
 import tiktoken
 
+from app.index.cache import EmbeddingCache
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def get_encoding(encoding_name: str = "cl100k_base") -> tiktoken.Encoding:
+    """Returns the tokeniser for the encoding, loading it only once."""
+    return tiktoken.get_encoding(encoding_name)
+
 
 def num_tokens_from_string(
     string: str, encoding_name: str = "cl100k_base"
 ) -> int:
     """Returns the number of tokens in a text string."""
-    encoding = tiktoken.get_encoding(encoding_name)
+    encoding = get_encoding(encoding_name)
     num_tokens = len(encoding.encode(string))
     return num_tokens
 
 
+def split_long_texts(
+    texts: list[str],
+    max_tokens: int,
+    encoding_name: str = "cl100k_base",
+    known_token_counts: Optional[list[Optional[int]]] = None,
+) -> tuple[list[str], list[int], list[int]]:
+    """
+    Splits any text longer than max_tokens on token boundaries into slices
+    of at most max_tokens. Texts that fit are kept whole.
+
+    Texts with a count in known_token_counts that fits are not tokenised
+    again.
+
+    Returns the slices, the token count of each slice and the index of the
+    text each slice came from.
+    """
+    encoding = get_encoding(encoding_name)
+    slices = []
+    token_counts = []
+    owners = []
+    for owner, text in enumerate(texts):
+        known = known_token_counts[owner] if known_token_counts else None
+        if known is not None and known <= max_tokens:
+            slices.append(text)
+            token_counts.append(known)
+            owners.append(owner)
+            continue
+
+        tokens = encoding.encode(text)
+        if len(tokens) <= max_tokens:
+            slices.append(text)
+            token_counts.append(len(tokens))
+            owners.append(owner)
+            continue
+
+        for start in range(0, len(tokens), max_tokens):
+            slice_tokens = tokens[start : start + max_tokens]
+            slices.append(encoding.decode(slice_tokens))
+            token_counts.append(len(slice_tokens))
+            owners.append(owner)
+
+    return slices, token_counts, owners
+
+
+def aggregate_embeddings(
+    embeddings: list[list[float]],
+    token_counts: list[int],
+    owners: list[int],
+    n_texts: int,
+    aggregation: str = "mean",
+) -> list[list[float]]:
+    """
+    Combines slice embeddings back into one unit length embedding per text.
+
+    "mean" weights each slice by its token count and "max" takes the
+    element wise maximum over the slices.
+    """
+    vectors = np.asarray(embeddings, dtype=np.float32)
+    owner_index = np.asarray(owners)
+    if aggregation == "max":
+        combined = np.full((n_texts, vectors.shape[1]), -np.inf, np.float32)
+        np.maximum.at(combined, owner_index, vectors)
+    else:
+        weights = np.maximum(np.asarray(token_counts, np.float32), 1)
+        combined = np.zeros((n_texts, vectors.shape[1]), np.float32)
+        np.add.at(combined, owner_index, vectors * weights[:, None])
+        combined /= np.bincount(
+            owner_index, weights=weights, minlength=n_texts
+        )[:, None]
+
+    combined /= np.linalg.norm(combined, axis=1, keepdims=True)
+    return combined.tolist()
+
+
+def batch_inputs(
+    token_counts: list[int], max_items: int, max_tokens: int
+) -> list[list[int]]:
+    """
+    Groups inputs into batches that fit within the item and token budget
+    of a single embeddings request. Returns the input indices of each batch
+    in their original order.
+
+    An input larger than max_tokens is placed in a batch of its own.
+    """
+    batches: list[list[int]] = []
+    current: list[int] = []
+    current_tokens = 0
+    for index, n_tokens in enumerate(token_counts):
+        if current and (
+            len(current) >= max_items
+            or current_tokens + n_tokens > max_tokens
+        ):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append(index)
+        current_tokens += n_tokens
+
+    if current:
+        batches.append(current)
+
+    return batches
+
+
 class OpenAIEmbedder:
 
-    def __init__(self, api_key: str, model_name: str) -> None:
+    def __init__(
+        self,
+        api_key: str,
+        model_name: str,
+        batch_size: int = 1024,
+        max_batch_tokens: int = 250000,
+        cache: Optional[EmbeddingCache] = None,
+        aggregation: str = "mean",
+        dimensions: Optional[int] = None,
+        base_url: Optional[str] = None,
+        max_retries: int = 6,
+        max_backoff: float = 60.0,
+    ) -> None:
         super().__init__()
-        self._client = openai.OpenAI(api_key=api_key)
+        # Only retry rate limited requests in _embed_batch, not in the SDK
+        self._client = openai.OpenAI(
+            api_key=api_key, base_url=base_url, max_retries=0
+        )
+        self._base_url = base_url
         self._model_name = model_name
+        self._dimensions = dimensions
+        self._batch_size = batch_size
+        self._max_batch_tokens = max_batch_tokens
+        self._cache = cache
+        self._aggregation = aggregation
+        self._max_retries = max_retries
+        self._max_backoff = max_backoff
 
     def preprocess(self, text: str) -> str:
         return text.replace("\n", " ")
 
-    def _embed_long_content(
-        self, content: str, max_tokens: int, aggregation: str = "max"
-    ) -> list[list[float]]:
+    def _request_options(self) -> dict:
+        """
+        text-embedding-3 models can return shortened embeddings, so ask for
+        the configured size. Older models only have one size.
         """
-        Embeds long content by splitting it into smaller chunks and embedding
-        each chunk separately then aggregating the embeddings.
+        if self._dimensions and self._model_name.startswith(
+            "text-embedding-3"
+        ):
+            return {"dimensions": self._dimensions}
+        return {}
 
-        Default is average.
+    def _embed_batch(self, texts: list[str]) -> list[list[float]]:
         """
-        embeddings = []
-        index = 0
-        while index < len(content):
-            chunk = content[index : index + max_tokens]
-            data = self._client.embeddings.create(
-                input=[self.preprocess(chunk)], model=self._model_name
-            )
-            embeddings.append(data.data[0].embedding)
-            index += max_tokens
+        Embeds a batch of preprocessed texts with a single request. The
+        response items are put back into the order of the inputs.
+        """
+        attempt = 0
+        while True:
+            try:
+                data = self._client.embeddings.create(
+                    input=texts,
+                    model=self._model_name,
+                    **self._request_options(),
+                )
+                items = sorted(data.data, key=lambda item: item.index)
+                return [item.embedding for item in items]
+            except openai.RateLimitError as e:
+                time.sleep(self._retry_delay(e, attempt))
+                attempt += 1
 
-        if aggregation == "max":
-            return np.max(embeddings, axis=0)
+    def _retry_delay(
+        self, error: openai.RateLimitError, attempt: int
+    ) -> float:
+        """
+        Seconds to wait before retrying a rate limited request, using
+        jittered exponential backoff and honouring the server's retry-after
+        header when it is given. Raises the error once the retries are used.
+        """
+        if attempt >= self._max_retries:
+            raise error
 
-        return np.mean(embeddings, axis=0)
+        retry_after = error.response.headers.get("retry-after")
+        backoff = min(self._max_backoff, 2**attempt)
+        delay = backoff * random.uniform(0.5, 1.5)
+        if retry_after:
+            delay = max(delay, float(retry_after))
+        logger.warning(
+            f"Embedding request rate limited, retrying in "
+            f"{delay:.1f}s (attempt {attempt + 1})"
+        )
+        return delay
 
     def embed(
-        self, content: list[str] | str, max_tokens: int = 8000
+        self,
+        content: list[str] | str,
+        max_tokens: int = 8000,
+        token_counts: Optional[list[int]] = None,
     ) -> list[list[float]]:
+        """
+        Embeds the content and returns the embeddings in the same order as
+        the input. Texts found in the cache are not sent to the model and
+        repeated texts are only embedded once.
+
+        token_counts, when known from chunking, saves tokenising the texts
+        again to batch them.
+        """
         if isinstance(content, str):
             content = [content]
 
+        texts = [self.preprocess(c) for c in content]
+        counts = dict(zip(texts, token_counts)) if token_counts else {}
+        if self._cache is None:
+            return self._embed_uncached(
+                texts, max_tokens, [counts.get(t) for t in texts]
+            )
+
+        return self._cache.get_or_embed(
+            texts,
+            lambda missing: self._embed_uncached(
+                missing, max_tokens, [counts.get(t) for t in missing]
+            ),
+        )
+
+    def embed_query(self, query: str) -> list[float]:
+        """Embeds a search query. Queries and passages share one space."""
+        return self.embed(query)[0]
+
+    def embed_queries(self, queries: list[str]) -> list[list[float]]:
+        """Embeds several search queries with as few requests as possible."""
+        return self.embed(queries)
+
+    def _embed_uncached(
+        self,
+        texts: list[str],
+        max_tokens: int,
+        known_token_counts: Optional[list[Optional[int]]] = None,
+    ) -> list[list[float]]:
+        """
+        Embeds preprocessed texts packing them into as few requests as the
+        batch size and token budget allow. Texts longer than max_tokens are
+        split on token boundaries and their slices are sent in the same
+        requests before being aggregated.
+        """
+        slices, token_counts, owners = split_long_texts(
+            texts, max_tokens, known_token_counts=known_token_counts
+        )
         try:
-            embeddings = []
-            for c in content:
-                n_tokens = num_tokens_from_string(c)
-                if n_tokens > 8000:
-                    embedding = self._embed_long_content(c, max_tokens)
-                else:
-                    data = self._client.embeddings.create(
-                        input=[self.preprocess(c)], model=self._model_name
-                    )
-                    embedding = data.data[0].embedding
-                embeddings.append(embedding)
-            return embeddings
+            embeddings: list = [None] * len(slices)
+            batches = batch_inputs(
+                token_counts, self._batch_size, self._max_batch_tokens
+            )
+            for batch in batches:
+                batch_slices = [slices[i] for i in batch]
+                batch_embeddings = self._embed_batch(batch_slices)
+                for i, embedding in zip(batch, batch_embeddings):
+                    embeddings[i] = embedding
         except openai.OpenAIError as e:
             raise ValueError(f"An error occurred: {str(e)}")
+
+        if len(slices) == len(texts):
+            return embeddings
+
+        return aggregate_embeddings(
+            embeddings, token_counts, owners, len(texts), self._aggregation
+        )
+
+
+class RateLimiter:
+    """
+    Token bucket scheduler that keeps requests within a requests per minute
+    and tokens per minute quota.
+
+    Callers reserve capacity up front and then wait until the buckets have
+    refilled enough to cover the reservation. As reservations are made
+    without awaiting, the limiter can be shared between event loops.
+    """
+
+    def __init__(
+        self, requests_per_minute: int, tokens_per_minute: int
+    ) -> None:
+        self._request_capacity = float(requests_per_minute)
+        self._token_capacity = float(tokens_per_minute)
+        self._requests = self._request_capacity
+        self._tokens = self._token_capacity
+        self._updated_at = time.monotonic()
+        self._lock = Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed_minutes = (now - self._updated_at) / 60
+        self._requests = min(
+            self._request_capacity,
+            self._requests + elapsed_minutes * self._request_capacity,
+        )
+        self._tokens = min(
+            self._token_capacity,
+            self._tokens + elapsed_minutes * self._token_capacity,
+        )
+        self._updated_at = now
+
+    def reserve(self, n_tokens: int) -> float:
+        """
+        Reserves capacity for one request of n_tokens and returns the
+        number of seconds to wait before sending it.
+        """
+        # A request bigger than the bucket can never fit so only wait for
+        # a full bucket
+        n_tokens = min(n_tokens, self._token_capacity)
+        with self._lock:
+            self._refill()
+            self._requests -= 1
+            self._tokens -= n_tokens
+            wait_minutes = max(
+                -self._requests / self._request_capacity,
+                -self._tokens / self._token_capacity,
+                0.0,
+            )
+        return wait_minutes * 60
+
+    async def acquire(self, n_tokens: int) -> None:
+        wait = self.reserve(n_tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class AsyncOpenAIEmbedder(OpenAIEmbedder):
+    """
+    Embeds batches concurrently while staying within the account's rate
+    limits. Requests rejected with a 429 are retried with jittered
+    exponential backoff.
+
+    The concurrent path is aembed. The inherited embed, embed_query and
+    embed_queries still embed synchronously.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        model_name: str,
+        batch_size: int = 1024,
+        max_batch_tokens: int = 250000,
+        cache: Optional[EmbeddingCache] = None,
+        aggregation: str = "mean",
+        dimensions: Optional[int] = None,
+        base_url: Optional[str] = None,
+        max_concurrency: int = 8,
+        requests_per_minute: int = 3000,
+        tokens_per_minute: int = 1000000,
+        max_retries: int = 6,
+        max_backoff: float = 60.0,
+    ) -> None:
+        super().__init__(
+            api_key,
+            model_name,
+            batch_size,
+            max_batch_tokens,
+            cache,
+            aggregation,
+            dimensions,
+            base_url,
+            max_retries,
+            max_backoff,
+        )
+        self._api_key = api_key
+        self._max_concurrency = max_concurrency
+        self._rate_limiter = RateLimiter(
+            requests_per_minute, tokens_per_minute
+        )
+
+    async def aembed(
+        self,
+        content: list[str] | str,
+        max_tokens: int = 8000,
+        token_counts: Optional[list[int]] = None,
+    ) -> list[list[float]]:
+        """
+        Embeds the content and returns the embeddings in the same order as
+        the input. Uncached texts are split into batches which are sent
+        concurrently.
+        """
+        if isinstance(content, str):
+            content = [content]
+
+        texts = [self.preprocess(c) for c in content]
+        counts = dict(zip(texts, token_counts)) if token_counts else {}
+        if self._cache is None:
+            return await self._aembed_uncached(
+                texts, max_tokens, [counts.get(t) for t in texts]
+            )
+
+        # Cache lookups may go to the database so keep them off the loop
+        embeddings = await asyncio.to_thread(self._cache.get_many, texts)
+        missing = list(
+            dict.fromkeys(t for t, e in zip(texts, embeddings) if e is None)
+        )
+        if missing:
+            new_embeddings = await self._aembed_uncached(
+                missing, max_tokens, [counts.get(t) for t in missing]
+            )
+            await asyncio.to_thread(
+                self._cache.set_many, missing, new_embeddings
+            )
+            computed = dict(zip(missing, new_embeddings))
+            embeddings = [
+                computed[t] if e is None else e
+                for t, e in zip(texts, embeddings)
+            ]
+
+        return embeddings
+
+    async def _aembed_uncached(
+        self,
+        texts: list[str],
+        max_tokens: int,
+        known_token_counts: Optional[list[Optional[int]]] = None,
+    ) -> list[list[float]]:
+        slices, token_counts, owners = split_long_texts(
+            texts, max_tokens, known_token_counts=known_token_counts
+        )
+        embeddings: list = [None] * len(slices)
+
+        # The client and semaphore belong to the running event loop so are
+        # created per call.
+        semaphore = asyncio.Semaphore(self._max_concurrency)
+        # The SDK's own retries would skip the rate limiter, so only
+        # _create_with_retry retries
+        async with openai.AsyncOpenAI(
+            api_key=self._api_key, base_url=self._base_url, max_retries=0
+        ) as client:
+
+            async def embed_batch(batch: list[int]) -> None:
+                n_tokens = sum(token_counts[i] for i in batch)
+                async with semaphore:
+                    batch_embeddings = await self._create_with_retry(
+                        client, [slices[i] for i in batch], n_tokens
+                    )
+                for i, embedding in zip(batch, batch_embeddings):
+                    embeddings[i] = embedding
+
+            batches = batch_inputs(
+                token_counts, self._batch_size, self._max_batch_tokens
+            )
+            try:
+                await asyncio.gather(*[embed_batch(b) for b in batches])
+            except openai.OpenAIError as e:
+                raise ValueError(f"An error occurred: {str(e)}")
+
+        if len(slices) == len(texts):
+            return embeddings
+
+        return aggregate_embeddings(
+            embeddings, token_counts, owners, len(texts), self._aggregation
+        )
+
+    async def _create_with_retry(
+        self, client: openai.AsyncOpenAI, texts: list[str], n_tokens: int
+    ) -> list[list[float]]:
+        """
+        Sends one embeddings request once the rate limiter allows it.
+        Rate limited requests are retried with jittered exponential backoff,
+        honouring the server's retry-after header when it is given.
+        """
+        attempt = 0
+        while True:
+            await self._rate_limiter.acquire(n_tokens)
+            try:
+                data = await client.embeddings.create(
+                    input=texts,
+                    model=self._model_name,
+                    **self._request_options(),
+                )
+                items = sorted(data.data, key=lambda item: item.index)
+                return [item.embedding for item in items]
+            except openai.RateLimitError as e:
+                await asyncio.sleep(self._retry_delay(e, attempt))
+                attempt += 1
@@ -0,0 +1,326 @@
+"""
+Streaming pipeline that takes an import from the raw file through to
+searchable embeddings.
+
+    parse -> dedupe -> insert clips -> chunk -> embed -> write vectors
+
+Each stage runs in its own thread and hands batches to the next through a
+bounded queue. A slow stage blocks the ones before it instead of letting
+work pile up in memory, and the stages overlap in time so parsing and
+inserting continue while earlier batches are being embedded.
+"""
+
+from collections.abc import Callable, Iterable
+import logging
+from queue import Queue
+from threading import Event, Lock, Thread
+import time
+from typing import Any, Optional
+
+from sqlalchemy.orm import Session
+
+from app.config import EMBEDDING_DIMENSIONS, EMBEDDING_MODEL
+from app.db import models, operations
+from app.index import embed_passages
+from app.index.index_job import embed_new_chunks
+from app.index.chunking import Chunker, get_chunker
+from app.schemas import BookAnnotation, BookAnnotationType
+from app.utils import hash_content
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of a stage's output
+DONE = object()
+
+
+class StageMetrics:
+    """
+    Counts the items a stage consumed and produced, and how long it spent
+    working compared with waiting on the stages either side of it.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.items_in = 0
+        self.items_out = 0
+        self.busy_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._lock = Lock()
+
+    def add(self, items_in: int, items_out: int, busy: float) -> None:
+        with self._lock:
+            self.items_in += items_in
+            self.items_out += items_out
+            self.busy_seconds += busy
+
+    def add_wait(self, seconds: float) -> None:
+        with self._lock:
+            self.wait_seconds += seconds
+
+    def as_dict(self) -> dict[str, Any]:
+        with self._lock:
+            end = self.finished_at or time.perf_counter()
+            elapsed = end - self.started_at if self.started_at else 0.0
+            return {
+                "items_in": self.items_in,
+                "items_out": self.items_out,
+                "busy_seconds": round(self.busy_seconds, 3),
+                "wait_seconds": round(self.wait_seconds, 3),
+                "elapsed_seconds": round(elapsed, 3),
+                "items_per_second": (
+                    round(self.items_out / elapsed, 1) if elapsed else 0.0
+                ),
+            }
+
+
+class ImportPipeline:
+    """
+    Imports Kindle annotations for a user and indexes the new clips as they
+    are inserted.
+
+    Every stage that talks to the database gets its own session from
+    session_factory as sessions cannot be shared between threads.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session],
+        user_id: str,
+        clip_batch_size: int = 500,
+        embed_batch_size: int = 1000,
+        queue_size: int = 4,
+        embed_fn: Callable[..., list] = embed_passages,
+        chunker: Optional[Chunker] = None,
+    ) -> None:
+        self._session_factory = session_factory
+        self._user_id = user_id
+        self._clip_batch_size = clip_batch_size
+        self._embed_batch_size = embed_batch_size
+        self._queue_size = queue_size
+        self._embed_fn = embed_fn
+        self._chunker = chunker or get_chunker()
+        self._stop = Event()
+        self._errors: list[BaseException] = []
+        self._document_ids: dict[tuple, Any] = {}
+        self.metrics = {
+            name: StageMetrics(name)
+            for name in ["parse", "insert", "chunk", "embed", "write"]
+        }
+
+    def run(self, annotations: Iterable[BookAnnotation]) -> dict[str, dict]:
+        """
+        Runs the pipeline to completion and returns the metrics of each
+        stage. Raises the first error raised by any stage.
+        """
+        queues = [Queue(maxsize=self._queue_size) for _ in range(4)]
+        stages = [
+            (self._parse, None, queues[0], annotations),
+            (self._insert, queues[0], queues[1], None),
+            (self._chunk, queues[1], queues[2], None),
+            (self._embed, queues[2], queues[3], None),
+            (self._write, queues[3], None, None),
+        ]
+        threads = [
+            Thread(
+                target=self._run_stage,
+                args=stage,
+                name=f"pipeline-{stage[0].__name__.strip('_')}",
+                daemon=True,
+            )
+            for stage in stages
+        ]
+        self._insert_db = self._session_factory()
+        self._embed_db = self._session_factory()
+        self._write_db = self._session_factory()
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            self._insert_db.close()
+            self._embed_db.close()
+            self._write_db.close()
+
+        if self._errors:
+            raise self._errors[0]
+        return self.stats()
+
+    def stats(self) -> dict[str, dict]:
+        """Throughput metrics of each stage so far."""
+        return {name: m.as_dict() for name, m in self.metrics.items()}
+
+    def _run_stage(self, stage, inbox, outbox, source) -> None:
+        metrics = self.metrics[stage.__name__.strip("_")]
+        metrics.started_at = time.perf_counter()
+        try:
+            if source is not None:
+                stage(source, outbox, metrics)
+            else:
+                for batch in self._consume(inbox, metrics):
+                    start = time.perf_counter()
+                    result = stage(batch)
+                    metrics.add(
+                        len(batch), len(result), time.perf_counter() - start
+                    )
+                    if outbox is not None and result:
+                        self._put(outbox, result, metrics)
+        except BaseException as e:
+            logger.error(f"Import pipeline stage {metrics.name} failed: {e}")
+            self._errors.append(e)
+            self._stop.set()
+            # Keep reading so the stage before is never blocked on a put
+            if inbox is not None:
+                for _ in self._consume(inbox, metrics):
+                    pass
+        finally:
+            metrics.finished_at = time.perf_counter()
+            if outbox is not None:
+                self._put(outbox, DONE, metrics)
+
+    def _put(self, queue: Queue, item, metrics: StageMetrics) -> None:
+        """Blocks while the next stage is behind."""
+        start = time.perf_counter()
+        queue.put(item)
+        metrics.add_wait(time.perf_counter() - start)
+
+    def _consume(self, queue: Queue, metrics):
+        while True:
+            start = time.perf_counter()
+            item = queue.get()
+            metrics.add_wait(time.perf_counter() - start)
+            if item is DONE:
+                return
+            if self._stop.is_set():
+                # Drain without working so earlier stages can finish
+                continue
+            yield item
+
+    def _parse(self, annotations, outbox, metrics) -> None:
+        """
+        Keeps highlights, drops repeats within the file and groups them into
+        batches for inserting.
+        """
+        seen = set()
+        batch = []
+        start = time.perf_counter()
+        n_in = 0
+        for annotation in annotations:
+            if self._stop.is_set():
+                return
+            n_in += 1
+            # Only highlights are imported as clips, notes are skipped
+            if annotation.annotation_type != BookAnnotationType.HIGHLIGHT:
+                continue
+
+            content_hash = hash_content(annotation.content)
+            key = (annotation.title, annotation.authors, content_hash)
+            if key in seen:
+                continue
+            seen.add(key)
+
+            batch.append((annotation, content_hash))
+            if len(batch) >= self._clip_batch_size:
+                metrics.add(n_in, len(batch), time.perf_counter() - start)
+                self._put(outbox, batch, metrics)
+                batch, n_in = [], 0
+                start = time.perf_counter()
+
+        if batch:
+            metrics.add(n_in, len(batch), time.perf_counter() - start)
+            self._put(outbox, batch, metrics)
+
+    def _insert(self, batch) -> list[tuple]:
+        """
+        Inserts a batch of clips, creating any documents that are new, and
+        returns the id and content of the clips that were not already in the
+        user's library.
+        """
+        db = self._insert_db
+        new_keys = {
+            (a.title, a.authors)
+            for a, _ in batch
+            if (a.title, a.authors) not in self._document_ids
+        }
+        document_values = []
+        for title, authors in new_keys:
+            books = operations.find_catalogue_books(db, title, authors)
+            document_values.append(
+                {
+                    "user_id": self._user_id,
+                    "title": title,
+                    "authors": authors,
+                    "user_thumbnail_path": None,
+                    "catalogue_id": str(books[0].id) if books else None,
+                }
+            )
+        for doc in operations.insert_documents(db, document_values):
+            self._document_ids[(doc.title, doc.authors)] = doc.id
+
+        clips = operations.insert_clips(
+            db,
+            [
+                {
+                    "user_id": self._user_id,
+                    "document_id": self._document_ids[(a.title, a.authors)],
+                    "content": a.content,
+                    "content_hash": content_hash,
+                    "location_type": a.location_type,
+                    "clip_start": a.location_start,
+                    "clip_end": a.location_end,
+                }
+                for a, content_hash in batch
+            ],
+        )
+        return [(clip.id, clip.content, clip.content_hash) for clip in clips]
+
+    def _chunk(self, clips) -> list[tuple]:
+        """Splits each new clip with the configured chunker."""
+        return [
+            (clip_id, content_hash, chunk, token_count)
+            for clip_id, content, content_hash in clips
+            for chunk, token_count in self._chunker.chunk_with_counts(content)
+        ]
+
+    def _embed(self, chunks) -> list[tuple]:
+        """
+        Embeds chunks not embedded before in batches of embed_batch_size.
+        Each chunk's row is paired with its new vector, or None when the
+        text already has one.
+        """
+        rows = []
+        for start in range(0, len(chunks), self._embed_batch_size):
+            batch = chunks[start : start + self._embed_batch_size]
+            chunk_hashes, vectors = embed_new_chunks(
+                self._embed_db,
+                [chunk for _, _, chunk, _ in batch],
+                embed_fn=self._embed_fn,
+                token_counts=[token_count for *_, token_count in batch],
+            )
+            new_vectors = {vector.chunk_hash: vector for vector in vectors}
+            for (clip_id, content_hash, chunk, token_count), chunk_hash in zip(
+                batch, chunk_hashes
+            ):
+                row = models.Embedding(
+                    source_id=clip_id,
+                    user_id=self._user_id,
+                    chunk_content=chunk,
+                    cleaned_chunk=chunk,
+                    chunking_strategy=self._chunker.strategy_id,
+                    source_hash=content_hash,
+                    chunk_hash=chunk_hash,
+                    token_count=token_count,
+                    embedding_model=EMBEDDING_MODEL,
+                    embedding_dimensions=EMBEDDING_DIMENSIONS,
+                )
+                rows.append((row, new_vectors.pop(chunk_hash, None)))
+        return rows
+
+    def _write(self, rows) -> list[tuple]:
+        """Bulk writes the new chunk vectors and the embeddings."""
+        embeddings = [row for row, _ in rows]
+        vectors = [vector for _, vector in rows if vector is not None]
+        operations.insert_embeddings(self._write_db, embeddings, vectors)
+        return rows
@@ -13,22 +13,99 @@ The most convenient but less optimal could be just sentence.
 Having chunks of like 2-3 sentences could probably work well.
 """
 
-import nltk
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+import logging
+import os
+import re
+
+from app.config import CHUNKING_WORKERS, NLTK_DATA_DIR, SENTENCE_SPLITTER
+
+logger = logging.getLogger(__name__)
+
+# Below this many texts chunking in the current process is faster than
+# starting a pool
+MIN_PARALLEL_TEXTS = 2000
+
+# Abbreviations that end in a full stop without ending the sentence
+ABBREVIATIONS = {
+    "mr", "mrs", "ms", "dr", "prof", "sr", "jr", "st", "vs", "etc", "e.g",
+    "i.e", "cf", "fig", "no", "vol", "ch", "p", "pp", "ed", "eds", "inc",
+    "ltd", "co", "jan", "feb", "mar", "apr", "jun", "jul", "aug", "sep",
+    "sept", "oct", "nov", "dec",
+}  # fmt: skip
+
+# Candidate end of sentence: terminal punctuation and any closing quotes or
+# brackets, followed by whitespace and something that can start a sentence.
+SENTENCE_END = re.compile(
+    r"[.!?][\"'\u201d\u2019)\]]*(?=\s+[\"'\u201c\u2018(\[]?[A-Z0-9])"
+)
+LAST_WORD = re.compile(r"(\S+)\.[\"'\u201d\u2019)\]]*$")
+
+
+@lru_cache(maxsize=1)
+def get_punkt_tokenizer():
+    """
+    Loads the English Punkt model once per process. The model is downloaded
+    into NLTK_DATA_DIR the first time it is needed rather than on import.
+    """
+    import nltk
+    from nltk.tokenize.punkt import PunktTokenizer
+
+    data_dir = os.path.abspath(NLTK_DATA_DIR)
+    if data_dir not in nltk.data.path:
+        nltk.data.path.insert(0, data_dir)
 
-nltk.download("punkt")
+    try:
+        return PunktTokenizer("english")
+    except LookupError:
+        logger.info(f"Downloading Punkt model to {data_dir}")
+        nltk.download("punkt_tab", download_dir=data_dir, quiet=True)
+        return PunktTokenizer("english")
 
 
-def split_sentences(text: str) -> list[str]:
+def split_sentences_rules(text: str) -> list[str]:
+    """
+    Splits text into sentences on terminal punctuation followed by a capital
+    letter or digit, ignoring common abbreviations and initials. Much faster
+    than Punkt and needs no model, but less accurate on unusual text.
+    """
+    sentences = []
+    start = 0
+    for match in SENTENCE_END.finditer(text):
+        candidate = text[start : match.end()]
+        last_word = LAST_WORD.search(candidate)
+        if last_word:
+            word = last_word.group(1).lower().lstrip("(\"'")
+            # Initials such as "J. R. R. Tolkien"
+            if word in ABBREVIATIONS or (len(word) == 1 and word.isalpha()):
+                continue
+
+        sentences.append(candidate.strip())
+        start = match.end()
+
+    last = text[start:].strip()
+    if last:
+        sentences.append(last)
+    return sentences
+
+
+def split_sentences(text: str, splitter: str = SENTENCE_SPLITTER) -> list[str]:
     """
     Splits a piece of text into sentences.
 
     Args:
     - text (str): The input text to be tokenized.
+    - splitter (str): "punkt" or "rules".
 
     Returns:
     List[str]: List of sentences.
     """
-    return nltk.sent_tokenize(text)
+    if splitter == "rules":
+        return split_sentences_rules(text)
+    if splitter == "punkt":
+        return get_punkt_tokenizer().tokenize(text)
+    raise ValueError(f"Unknown sentence splitter {splitter}")
 
 
 def multisentence_tokeniser(
@@ -36,6 +113,7 @@ def multisentence_tokeniser(
     max_sentences: int = 3,
     group_overlap: int = 1,
     min_characters: int = 20,
+    splitter: str = SENTENCE_SPLITTER,
 ) -> list[str]:
     """
     Chunks a piece of text into sentences or cluster of sentences.
@@ -50,6 +128,7 @@ def multisentence_tokeniser(
     - group_overlap (int): Number of sentences to overlap between groups.
     Must be non-negative and less than ngroup.
     - min_characters (int): Minimum number of characters in a chunk.
+    - splitter (str): Sentence splitter, "punkt" or "rules".
 
     Returns:
     List[str]: List of sentence groups.
@@ -64,7 +143,7 @@ def multisentence_tokeniser(
     if not text:
         return []
 
-    sentences = nltk.sent_tokenize(text)
+    sentences = split_sentences(text, splitter)
     sentences = _combine_short_strings(sentences, min_characters)
     idx = 0
     new_sentences = []
@@ -114,3 +193,32 @@ def _combine_short_strings(strings: list[str], min_length: int) -> list[str]:
         i += 1
 
     return result
+
+
+def chunk_texts(
+    texts: list[str],
+    max_sentences: int = 3,
+    group_overlap: int = 1,
+    min_characters: int = 20,
+    splitter: str = SENTENCE_SPLITTER,
+    workers: int = CHUNKING_WORKERS,
+) -> list[list[str]]:
+    """
+    Chunks many texts with multisentence_tokeniser, returning the chunks of
+    each text in input order. Large batches are spread across a process pool
+    of the given number of workers.
+    """
+    tokenise = partial(
+        multisentence_tokeniser,
+        max_sentences=max_sentences,
+        group_overlap=group_overlap,
+        min_characters=min_characters,
+        splitter=splitter,
+    )
+    if workers <= 1 or len(texts) < MIN_PARALLEL_TEXTS:
+        return [tokenise(text) for text in texts]
+
+    # Large chunks of work per task keep the pickling overhead low
+    chunksize = max(1, len(texts) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(tokenise, texts, chunksize=chunksize))
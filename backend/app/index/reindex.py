@@ -0,0 +1,116 @@
+"""
+Rebuilds the embeddings of every clip of some users, or of everyone.
+
+A run splits the clips into shards by a hash of their id and records the
+progress of each shard in the reindex_checkpoint table after every batch.
+Shards can be indexed by separate processes, and a run that stops part way
+resumes each shard after the last clip it indexed.
+"""
+
+import hashlib
+import logging
+from typing import Optional
+
+from sqlalchemy.orm import Session
+
+from app.config import CHUNKING_STRATEGY, EMBEDDING_MODEL
+from app.db import models, operations
+from app.index.chunking import get_chunker
+from app.index.index_job import index_content
+
+logger = logging.getLogger(__name__)
+
+
+def default_run_id(user_ids: Optional[list[str]] = None) -> str:
+    """
+    Run id derived from the users, embedding model and chunking strategy so
+    that running the same command again resumes the same run.
+    """
+    scope = ",".join(sorted(str(user_id) for user_id in user_ids or []))
+    strategy = get_chunker(CHUNKING_STRATEGY).strategy_id
+    key = f"{scope or 'all'}|{EMBEDDING_MODEL}|{strategy}"
+    return "reindex-" + hashlib.md5(key.encode()).hexdigest()[:12]
+
+
+def start_run(
+    db: Session,
+    run_id: str,
+    shards: int,
+    user_ids: Optional[list[str]] = None,
+) -> list[models.ReindexCheckpoint]:
+    """
+    Returns the checkpoints of the run, creating them for a new run. A
+    resumed run keeps the number of shards it was started with.
+    """
+    checkpoints = operations.get_reindex_checkpoints(db, run_id)
+    if checkpoints:
+        logger.info(
+            f"Resuming reindex run {run_id} with {len(checkpoints)} shards"
+        )
+        return checkpoints
+
+    logger.info(f"Starting reindex run {run_id} with {shards} shards")
+    return operations.create_reindex_checkpoints(db, run_id, shards, user_ids)
+
+
+def reindex_shard(
+    db: Session, run_id: str, shard: int, batch_size: int = 100
+) -> int:
+    """
+    Re-chunks and re-embeds the clips of one shard in id order, starting
+    after the shard's checkpoint and saving it after every batch.
+    Returns the number of clips indexed by this call.
+    """
+    checkpoint = operations.get_reindex_checkpoint(db, run_id, shard)
+    if checkpoint is None:
+        raise ValueError(f"Reindex run {run_id} has no shard {shard}")
+    if checkpoint.status == "completed":
+        return 0
+
+    operations.update_reindex_checkpoint(db, checkpoint, status="running")
+    indexed = 0
+    try:
+        while True:
+            clips = operations.get_clips_for_reindex(
+                db,
+                shard,
+                checkpoint.shards,
+                checkpoint.user_ids,
+                checkpoint.last_clip_id,
+                batch_size,
+            )
+            if not clips:
+                break
+
+            index_content(db, clips)
+            indexed += len(clips)
+            operations.update_reindex_checkpoint(
+                db,
+                checkpoint,
+                last_clip_id=clips[-1].id,
+                processed=checkpoint.processed + len(clips),
+            )
+
+        operations.update_reindex_checkpoint(
+            db, checkpoint, status="completed"
+        )
+    except Exception as e:
+        logger.error(f"Reindex run {run_id} shard {shard} failed: {e}")
+        db.rollback()
+        operations.update_reindex_checkpoint(
+            db, checkpoint, status="failed", error=str(e)
+        )
+        raise e
+    return indexed
+
+
+def run_progress(db: Session, run_id: str) -> dict[str, int]:
+    """Progress of a run summed over its shards."""
+    checkpoints = operations.get_reindex_checkpoints(db, run_id)
+    return {
+        "processed": sum(c.processed for c in checkpoints),
+        "total": sum(c.total for c in checkpoints),
+        "shards": len(checkpoints),
+        "completed": sum(c.status == "completed" for c in checkpoints),
+        "failed": sum(c.status == "failed" for c in checkpoints),
+    }
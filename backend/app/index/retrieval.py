@@ -2,17 +2,100 @@
 Code for doing information retrieval.
 """
 
-from typing import Tuple
+from typing import Optional, Tuple
 
-import numpy as np
 from sqlalchemy import Row
 from sqlalchemy.orm import Session
 
+from app.config import (
+    CLIP_NEIGHBOURS_COUNT,
+    EMBEDDING_MODEL,
+    EMBEDDING_PREVIOUS_MODEL,
+    LLM_CONTEXT_MAX_TOKENS,
+    QUERY_CACHE_SIZE,
+    QUERY_CACHE_TTL,
+    RETRIEVAL_MODE,
+    VECTOR_SEARCH_EF_SEARCH,
+    VECTOR_SEARCH_PROBES,
+)
 from app.db import operations, models
-from app.index import embedding_model
+from app.index import embedding_model, previous_embedding_model
+from app.index.cache import LRUCache
+from app.index.openai import num_tokens_from_string
+from app.index.vector_index import search_storage
 
 # TODO: Consider re-ranking
 
+query_embedding_cache = LRUCache(QUERY_CACHE_SIZE, ttl=QUERY_CACHE_TTL)
+
+# Damps the weight of top ranks in reciprocal rank fusion
+RRF_K = 60
+
+
+def normalise_query(query: str) -> str:
+    """Queries differing only in case or whitespace share an embedding."""
+    return " ".join(query.casefold().split())
+
+
+def embed_queries(
+    queries: list[str],
+    embedder=embedding_model,
+    model_name: str = EMBEDDING_MODEL,
+) -> list[list[float]]:
+    """
+    Embeds search queries returning one embedding per query in order.
+    Recently embedded queries are served from the cache and the rest are
+    deduplicated and embedded together.
+    """
+    keys = [(model_name, normalise_query(q)) for q in queries]
+    embeddings = [query_embedding_cache.get(key) for key in keys]
+
+    # First spelling of each uncached query
+    missing = {}
+    for key, query, embedding in zip(keys, queries, embeddings):
+        if embedding is None and key not in missing:
+            missing[key] = query
+
+    if missing:
+        new_embeddings = embedder.embed_queries(list(missing.values()))
+        computed = dict(zip(missing.keys(), new_embeddings))
+        for key, embedding in computed.items():
+            query_embedding_cache.set(key, embedding)
+        embeddings = [
+            computed[key] if e is None else e
+            for key, e in zip(keys, embeddings)
+        ]
+
+    return embeddings
+
+
+def model_filter(model_name: Optional[str]) -> dict:
+    """
+    Search arguments restricting embeddings to those from one model.
+    Embeddings with no recorded model predate versioning and belong to the
+    model in use before any migration.
+    """
+    legacy_model = EMBEDDING_PREVIOUS_MODEL or EMBEDDING_MODEL
+    model_name = model_name or legacy_model
+    return {
+        "embedding_model": model_name,
+        "include_legacy": model_name == legacy_model,
+    }
+
+
+def _merge_model_results(
+    chunks: list[Row], previous: list[Row], topk: int, threshold: float
+) -> list[Row]:
+    """
+    Merges the results of searching the new and previous model. Cosine
+    distances from two models are not comparable, so each list is filtered
+    by threshold on its own and the two are fused by rank instead.
+    """
+    if threshold:
+        chunks = [chunk for chunk in chunks if chunk.score <= threshold]
+        previous = [chunk for chunk in previous if chunk.score <= threshold]
+    return fuse_rankings([chunks, previous])[:topk]
+
 
 def retrieve_candidate_chunks(
     db: Session,
@@ -20,142 +103,202 @@ def retrieve_candidate_chunks(
     query: str,
     topk: int = 5,
     threshold: float = 0.5,
+    mode: str = RETRIEVAL_MODE,
+    ef_search: int = VECTOR_SEARCH_EF_SEARCH,
+    probes: int = VECTOR_SEARCH_PROBES,
 ) -> list[Row[Tuple[models.Embedding, float]]]:
     """
     Retrieve documents from the user's library that match a query.
 
+    While embeddings are migrated to a new model, clips not yet migrated are
+    searched with a query embedding from the previous model and the results
+    of both searches are fused by rank.
+
+    ef_search (HNSW) and probes (IVFFlat) set how much of the vector index
+    is explored, trading latency for recall.
+
     # threshold is the maximum cosine distance score before not a match.
     """
-    query_embedding = embedding_model.embed(query)
+    index_params = {"ef_search": ef_search, "probes": probes}
+    query_embedding = embed_queries([query])[0]
     chunks = operations.get_similar_chunks(
-        db, user_id, np.squeeze(query_embedding), topk=topk
+        db,
+        user_id,
+        query_embedding,
+        topk=topk,
+        storage=search_storage(mode),
+        **index_params,
+        **model_filter(EMBEDDING_MODEL),
     )
+    if previous_embedding_model is not None:
+        previous_embedding = embed_queries(
+            [query], previous_embedding_model, EMBEDDING_PREVIOUS_MODEL
+        )[0]
+        previous = operations.get_similar_chunks(
+            db,
+            user_id,
+            previous_embedding,
+            topk=topk,
+            storage=search_storage(mode),
+            exclude_indexed_with=EMBEDDING_MODEL,
+            **index_params,
+            **model_filter(EMBEDDING_PREVIOUS_MODEL),
+        )
+        return _merge_model_results(chunks, previous, topk, threshold)
     if threshold:
         chunks = [chunk for chunk in chunks if chunk.score <= threshold]
     return chunks
 
 
-def get_similar_user_clips(
-    db: Session, user_id: str, clip_id: str, topk: int = 5
-) -> list[Tuple[str, float]]:
-    """
-    Retrieve semantically similar documents to a query. Return a list
-    of document ids and scores. Documents are ordered by best score first.
+def _group_by_query(rows: list[Row], n_queries: int) -> list[list[Row]]:
+    results = [[] for _ in range(n_queries)]
+    for row in rows:
+        results[row.query_index].append(row)
+    return results
 
-    This is quite complex as a document can have many semantically distinct
-    parts. So I will take all the chunks from a document and compare those to
-    the entire database of embeddings. I will take all the results and rank
-    them returning the topk documents aggregated from all chunk comparisons.
 
-    TODO: Can this be done in parallel as this is quite slow.
+def retrieve_candidate_chunks_for_queries(
+    db: Session,
+    user_id: str,
+    queries: list[str],
+    topk: int = 5,
+    threshold: float = 0.5,
+    mode: str = RETRIEVAL_MODE,
+    ef_search: int = VECTOR_SEARCH_EF_SEARCH,
+    probes: int = VECTOR_SEARCH_PROBES,
+) -> Tuple[list[list[Row]], list[Row]]:
     """
+    Retrieves chunks for several queries, e.g. variants of a question, with
+    one embedding request and one search per embedding model.
 
-    # Get document chunks
-    document_chunks = operations.get_document_chunks(db, clip_id)
+    Returns the topk chunks of each query, best first and filtered by
+    threshold like retrieve_candidate_chunks, and every retrieved chunk
+    once, ranked by reciprocal rank fusion of the per query lists.
+    """
+    if not queries:
+        return [], []
 
-    # Get similar chunks for each embedding excluding comparison with itself
-    # and the document's own embeddings
-    chunk_collection = {}
-    for chunk in document_chunks:
-        chunks = operations.get_similar_chunks(
+    index_params = {"ef_search": ef_search, "probes": probes}
+    rows = operations.get_similar_chunks_for_queries(
+        db,
+        user_id,
+        embed_queries(queries),
+        topk=topk,
+        storage=search_storage(mode),
+        **index_params,
+        **model_filter(EMBEDDING_MODEL),
+    )
+    results = _group_by_query(rows, len(queries))
+    if previous_embedding_model is not None:
+        previous_rows = operations.get_similar_chunks_for_queries(
             db,
             user_id,
-            chunk.embedding,
-            topk=10,
-            exclude_documents=[clip_id],
-            exclude_chunks=None,
+            embed_queries(
+                queries, previous_embedding_model, EMBEDDING_PREVIOUS_MODEL
+            ),
+            topk=topk,
+            storage=search_storage(mode),
+            exclude_indexed_with=EMBEDDING_MODEL,
+            **index_params,
+            **model_filter(EMBEDDING_PREVIOUS_MODEL),
+        )
+        previous_results = _group_by_query(previous_rows, len(queries))
+        results = [
+            _merge_model_results(chunks, previous, topk, threshold)
+            for chunks, previous in zip(results, previous_results)
+        ]
+        return results, fuse_rankings(results)
+    if threshold:
+        results = [
+            [chunk for chunk in chunks if chunk.score <= threshold]
+            for chunks in results
+        ]
+    return results, fuse_rankings(results)
+
+
+def fuse_rankings(rankings: list[list[Row]], k: int = RRF_K) -> list[Row]:
+    """
+    Reciprocal rank fusion. Each chunk scores the sum of 1 / (k + rank)
+    over the lists it appears in, so chunks found by several queries rank
+    above those found by one.
+    """
+    scores: dict = {}
+    chunks: dict = {}
+    for ranking in rankings:
+        for rank, chunk in enumerate(ranking, start=1):
+            scores[chunk.id] = scores.get(chunk.id, 0.0) + 1 / (k + rank)
+            chunks.setdefault(chunk.id, chunk)
+    return [
+        chunks[chunk_id]
+        for chunk_id in sorted(scores, key=scores.get, reverse=True)
+    ]
+
+
+def pack_context(
+    chunks: list[Row],
+    max_tokens: int = LLM_CONTEXT_MAX_TOKENS,
+    ranked: bool = False,
+) -> list[Row]:
+    """
+    Keeps the best scoring chunks that fit within max_tokens using the
+    token counts stored at chunking time. Chunks indexed before counts were
+    stored are counted here.
+
+    Chunks are taken in order of score, or in the given order when ranked.
+    """
+    if not ranked:
+        chunks = sorted(chunks, key=lambda chunk: chunk.score)
+    packed = []
+    total = 0
+    for chunk in chunks:
+        n_tokens = chunk.token_count
+        if n_tokens is None:
+            n_tokens = num_tokens_from_string(chunk.chunk_content)
+        if total + n_tokens > max_tokens:
+            continue
+        packed.append(chunk)
+        total += n_tokens
+    return packed
+
+
+def get_similar_user_clips(
+    db: Session,
+    user_id: str,
+    clip_id: str,
+    topk: int = 5,
+    aggregation: str = "mean",
+    ef_search: int = VECTOR_SEARCH_EF_SEARCH,
+    probes: int = VECTOR_SEARCH_PROBES,
+    threshold: Optional[float] = None,
+) -> list[Row[Tuple[models.Clip, models.Book, float]]]:
+    """
+    Retrieve the clips most similar to a clip, with their books. Clips are
+    ordered by best score first and those scoring above threshold are left
+    out.
+
+    A clip can have many semantically distinct parts, so every chunk of the
+    clip is compared with the user's other chunks and the distances of each
+    neighbouring clip's chunks are aggregated with min or mean.
+
+    Mean aggregated results are served from the precomputed neighbours of
+    the clip when its list is up to date and long enough, and searched
+    otherwise.
+    """
+    if aggregation == "mean" and topk <= CLIP_NEIGHBOURS_COUNT:
+        neighbours = operations.get_clip_neighbours(
+            db, user_id, clip_id, EMBEDDING_MODEL, topk, threshold
         )
+        if neighbours is not None:
+            return neighbours
 
-        # Don't add duplicates
-        for row in chunks:
-            if (
-                row.id in chunk_collection
-                and row.score < chunk_collection[row.id].score
-            ):
-                # minumum as cosine distance is used with best value being 0
-                chunk_collection[row.id] = row
-            else:
-                chunk_collection[row.id] = row
-
-    # Aggregation step. A documents total score is the average of all its
-    # chunks. We want to return the topk documents which is a list of tuples
-    # containing the document id and the average score, ordered by highest
-    # to lowest score.
-    doc_scores = {}
-    for chunk in chunk_collection.values():
-        if chunk.source_id in doc_scores:
-            doc_scores[chunk.source_id].append(chunk.score)
-        else:
-            doc_scores[chunk.source_id] = [chunk.score]
-
-    # Average the scores
-    for doc_id, scores in doc_scores.items():
-        doc_scores[doc_id] = sum(scores) / len(scores)
-
-    # Sort the documents by score
-    sorted_docs = sorted(doc_scores.items(), key=lambda x: x[1], reverse=True)
-
-    return sorted_docs[:topk]
-
-
-# def get_similar_user_clips(
-#     db: Session, user_id: str, clip_id: str, topk: int = 5
-# ) -> list[Tuple[str, float]]:
-#     """
-#     Retrieve semantically similar documents to a query. Return a list
-#     of document ids and scores. Documents are ordered by best score first.
-
-#     This is quite complex as a document can have many semantically distinct
-#     parts. So I will take all the chunks from a document and compare those to
-#     the entire database of embeddings. I will take all the results and rank
-#     them returning the topk documents aggregated from all chunk comparisons.
-
-#     TODO: Can this be done in parallel as this is quite slow.
-#     """
-
-#     # Get document chunks
-#     document_chunks = operations.get_document_chunks(db, clip_id)
-
-#     # Get similar chunks for each embedding excluding comparison with itself
-#     # and the document's own embeddings
-#     chunk_collection = {}
-#     for chunk in document_chunks:
-#         chunks = operations.get_similar_chunks(
-#             db,
-#             user_id,
-#             chunk.embedding,
-#             topk=10,
-#             exclude_documents=[clip_id],
-#             exclude_chunks=None,
-#         )
-
-#         # Don't add duplicates
-#         for row in chunks:
-#             if (
-#                 row.id in chunk_collection
-#                 and row.score < chunk_collection[row.id].score
-#             ):
-#                 # minumum as cosine distance is used with best value being 0
-#                 chunk_collection[row.id] = row
-#             else:
-#                 chunk_collection[row.id] = row
-
-#     # Aggregation step. A documents total score is the average of all its
-#     # chunks. We want to return the topk documents which is a list of tuples
-#     # containing the document id and the average score, ordered by highest
-#     # to lowest score.
-#     doc_scores = {}
-#     for chunk in chunk_collection.values():
-#         if chunk.source_id in doc_scores:
-#             doc_scores[chunk.source_id].append(chunk.score)
-#         else:
-#             doc_scores[chunk.source_id] = [chunk.score]
-
-#     # Average the scores
-#     for doc_id, scores in doc_scores.items():
-#         doc_scores[doc_id] = sum(scores) / len(scores)
-
-#     # Sort the documents by score
-#     sorted_docs = sorted(doc_scores.items(), key=lambda x: x[1], reverse=True)
-
-#     return sorted_docs[:topk]
+    return operations.get_similar_clips(
+        db,
+        user_id,
+        clip_id,
+        topk=topk,
+        aggregation=aggregation,
+        storage=search_storage(RETRIEVAL_MODE),
+        ef_search=ef_search,
+        probes=probes,
+        threshold=threshold,
+    )
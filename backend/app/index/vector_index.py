@@ -0,0 +1,150 @@
+"""
+Approximate nearest neighbour indexes on the chunk vectors.
+
+Without an index every search is an exact scan of the user's vectors, so
+latency grows with the size of their library. HNSW indexes give the best
+speed and recall and can be built on an empty table. IVFFlat indexes build
+faster and use less memory but should be built once the table holds data
+as the lists are learnt from the existing vectors.
+
+The index is built on the column searched first by RETRIEVAL_MODE: the
+full embedding, its halfvec or binary copy, or its shortened copy.
+"""
+
+import logging
+import math
+from typing import Optional
+
+from sqlalchemy import Connection, text
+
+from app.config import (
+    EMBEDDING_STORAGE,
+    RETRIEVAL_MODE,
+    VECTOR_INDEX_HNSW_EF_CONSTRUCTION,
+    VECTOR_INDEX_HNSW_M,
+    VECTOR_INDEX_IVFFLAT_LISTS,
+    VECTOR_INDEX_TYPE,
+)
+
+logger = logging.getLogger(__name__)
+
+INDEX_NAME = "ix_chunk_vector_ann"
+
+# Column searched first for each storage and its cosine or hamming opclass
+SEARCH_COLUMNS = {
+    "full": ("embedding", "vector_cosine_ops"),
+    "halfvec": ("embedding_compressed", "halfvec_cosine_ops"),
+    "binary": ("embedding_compressed", "bit_hamming_ops"),
+    "matryoshka": ("embedding_short", "vector_cosine_ops"),
+}
+
+
+def search_storage(mode: str = RETRIEVAL_MODE) -> str:
+    """
+    Maps a retrieval mode to the copy of the embeddings searched first.
+
+    - exact: search the full precision embeddings only
+    - compressed: search the EMBEDDING_STORAGE copy then rerank
+    - matryoshka: search the shortened embeddings then rerank
+    """
+    if mode == "exact":
+        return "full"
+    if mode == "compressed":
+        return EMBEDDING_STORAGE
+    if mode == "matryoshka":
+        return "matryoshka"
+    raise ValueError(f"Unknown retrieval mode {mode}")
+
+
+def ivfflat_lists(n_rows: int) -> int:
+    """Number of lists suggested by pgvector for a table of n_rows."""
+    if n_rows > 1_000_000:
+        return int(math.sqrt(n_rows))
+    return max(n_rows // 1000, 1)
+
+
+def index_definition(
+    name: str,
+    index_type: str,
+    storage: str,
+    m: int = VECTOR_INDEX_HNSW_M,
+    ef_construction: int = VECTOR_INDEX_HNSW_EF_CONSTRUCTION,
+    lists: int = 100,
+    concurrently: bool = True,
+) -> str:
+    """CREATE INDEX statement for an HNSW or IVFFlat index."""
+    column, opclass = SEARCH_COLUMNS[storage]
+    if index_type == "hnsw":
+        options = f"m = {int(m)}, ef_construction = {int(ef_construction)}"
+    elif index_type == "ivfflat":
+        options = f"lists = {int(lists)}"
+    else:
+        raise ValueError(f"Unknown vector index type {index_type}")
+
+    return (
+        f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}{name} "
+        f"ON chunk_vector USING {index_type} ({column} {opclass}) "
+        f"WITH ({options})"
+    )
+
+
+def get_vector_index(connection: Connection) -> Optional[str]:
+    """Definition of the current vector index, if there is one."""
+    return connection.execute(
+        text("SELECT indexdef FROM pg_indexes WHERE indexname = :name"),
+        {"name": INDEX_NAME},
+    ).scalar()
+
+
+def drop_vector_index(connection: Connection) -> None:
+    connection.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {INDEX_NAME}"))
+
+
+def build_vector_index(
+    connection: Connection,
+    index_type: str = VECTOR_INDEX_TYPE,
+    storage: Optional[str] = None,
+    m: int = VECTOR_INDEX_HNSW_M,
+    ef_construction: int = VECTOR_INDEX_HNSW_EF_CONSTRUCTION,
+    lists: int = VECTOR_INDEX_IVFFLAT_LISTS,
+    maintenance_work_mem: Optional[str] = None,
+) -> str:
+    """
+    Builds the vector index, replacing any existing one. The new index is
+    built concurrently under a temporary name and swapped in, so searches
+    keep using the old index until the new one is ready.
+
+    The connection must be in autocommit mode. Returns the definition of
+    the new index.
+    """
+    storage = storage or search_storage()
+    if index_type == "none":
+        drop_vector_index(connection)
+        logger.info("Dropped the vector index")
+        return ""
+
+    if index_type == "ivfflat" and not lists:
+        n_rows = connection.execute(
+            text("SELECT count(*) FROM chunk_vector")
+        ).scalar()
+        lists = ivfflat_lists(n_rows)
+
+    if maintenance_work_mem:
+        # Builds are much faster when the graph fits in memory
+        connection.execute(
+            text("SELECT set_config('maintenance_work_mem', :value, false)"),
+            {"value": maintenance_work_mem},
+        )
+
+    new_name = f"{INDEX_NAME}_new"
+    connection.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {new_name}"))
+    definition = index_definition(
+        new_name, index_type, storage, m, ef_construction, lists
+    )
+    logger.info(f"Building vector index: {definition}")
+    connection.execute(text(definition))
+    drop_vector_index(connection)
+    connection.execute(
+        text(f"ALTER INDEX {new_name} RENAME TO {INDEX_NAME}")
+    )
+    return get_vector_index(connection)
@@ -1,3 +1,15 @@
+"""
+Local embedding models that run on CPU without calling an external API.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import numpy as np
+
+from app.index.cache import EmbeddingCache
+
+
 def prepare_text_e5(text: str, is_passage: bool = False) -> str:
     """
     intfloat/e5-large-v2 embedding model has been trained with text
@@ -7,3 +19,108 @@ def prepare_text_e5(text: str, is_passage: bool = False) -> str:
     """
     prefix = "passage: " if is_passage else "query: "
     return prefix + text
+
+
+class LocalEmbedder:
+    """
+    Embeds text with a sentence-transformers model, e.g. intfloat/e5-base-v2,
+    running on CPU.
+
+    Inputs are encoded in batches of batch_size. With num_workers > 1 the
+    batches are spread over a thread pool. Setting backend to "onnx" runs
+    the model with onnxruntime, and onnx_file can point to a quantised int8
+    export such as "onnx/model_qint8_avx512_vnni.onnx".
+
+    e5 models expect "query: " and "passage: " prefixes which are added
+    automatically.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        dimensions: int,
+        batch_size: int = 32,
+        num_workers: int = 1,
+        backend: str = "torch",
+        onnx_file: Optional[str] = None,
+        cache: Optional[EmbeddingCache] = None,
+    ) -> None:
+        # Optional dependency that is only needed for local embeddings
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError as e:
+            raise ImportError(
+                "Local embeddings need the packages in "
+                "requirements-local.txt"
+            ) from e
+
+        model_kwargs = {"file_name": onnx_file} if onnx_file else None
+        self._model = SentenceTransformer(
+            model_name,
+            device="cpu",
+            backend=backend,
+            model_kwargs=model_kwargs,
+        )
+        model_dimensions = self._model.get_sentence_embedding_dimension()
+        if model_dimensions != dimensions:
+            raise ValueError(
+                f"{model_name} produces {model_dimensions} dimensional "
+                f"embeddings but {dimensions} were configured."
+            )
+
+        self._model_name = model_name
+        self._batch_size = batch_size
+        self._num_workers = num_workers
+        self._cache = cache
+        self._use_e5_prefix = "e5" in model_name.lower()
+
+    def preprocess(self, text: str, is_query: bool = False) -> str:
+        text = text.replace("\n", " ")
+        if self._use_e5_prefix:
+            text = prepare_text_e5(text, is_passage=not is_query)
+        return text
+
+    def _encode_batch(self, texts: list[str]) -> np.ndarray:
+        return self._model.encode(
+            texts,
+            batch_size=self._batch_size,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+        )
+
+    def _encode(self, texts: list[str]) -> list[list[float]]:
+        if self._num_workers <= 1 or len(texts) <= self._batch_size:
+            return self._encode_batch(texts).tolist()
+
+        batches = [
+            texts[i : i + self._batch_size]
+            for i in range(0, len(texts), self._batch_size)
+        ]
+        with ThreadPoolExecutor(max_workers=self._num_workers) as executor:
+            results = list(executor.map(self._encode_batch, batches))
+        return np.concatenate(results).tolist()
+
+    def _embed(self, content: list[str], is_query: bool) -> list[list[float]]:
+        texts = [self.preprocess(c, is_query) for c in content]
+        if self._cache is None:
+            return self._encode(texts)
+
+        return self._cache.get_or_embed(texts, self._encode)
+
+    def embed(self, content: list[str] | str) -> list[list[float]]:
+        """
+        Embeds passages and returns the embeddings in the same order as the
+        input.
+        """
+        if isinstance(content, str):
+            content = [content]
+
+        return self._embed(content, is_query=False)
+
+    def embed_query(self, query: str) -> list[float]:
+        """Embeds a search query."""
+        return self._embed([query], is_query=True)[0]
+
+    def embed_queries(self, queries: list[str]) -> list[list[float]]:
+        """Embeds several search queries in one batch."""
+        return self._embed(queries, is_query=True)
@@ -1,7 +1,13 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
-from app.api import AuthRouter, ImportRouter, LibraryRouter, ConversationRouter
+from app.api import (
+    AuthRouter,
+    ConversationRouter,
+    ImportRouter,
+    JobRouter,
+    LibraryRouter,
+)
 from app.logging import setup_logging
 
 setup_logging()
@@ -24,3 +30,4 @@ app.include_router(ImportRouter)
 app.include_router(LibraryRouter)
 app.include_router(ConversationRouter)
 app.include_router(AuthRouter)
+app.include_router(JobRouter)
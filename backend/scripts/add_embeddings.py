@@ -8,7 +8,14 @@ import numpy as np
 import pandas as pd
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-from app.config import DB_DRIVER, DB_USERNAME, DB_HOST, DB_NAME, DB_PORT
+from app.config import (
+    DB_DRIVER,
+    DB_USERNAME,
+    DB_HOST,
+    DB_NAME,
+    DB_PORT,
+    EMBEDDING_MODEL,
+)
 from sqlalchemy.engine import URL
 from tqdm import tqdm
 
@@ -62,17 +69,27 @@ def main(
             if not clips:
                 print("Could not find source for chunk '{chunk}'.")
 
+            chunk_hash = hash_content(chunk)
+            vector = models.ChunkVector(
+                chunk_hash=chunk_hash,
+                embedding_model=EMBEDDING_MODEL,
+                embedding_dimensions=len(embedding),
+                embedding=embedding,
+            )
             for document in clips:
                 source_id = document.id
                 embedding_model = models.Embedding(
                     source_id=source_id,
+                    user_id=user_id,
                     chunk_content=chunk,
                     cleaned_chunk=chunk,
-                    embedding=embedding,
+                    chunk_hash=chunk_hash,
+                    embedding_model=EMBEDDING_MODEL,
                 )
                 try:
-                    db.add(embedding_model)
-                    db.commit()
+                    operations.insert_embeddings(
+                        db, [embedding_model], [vector]
+                    )
                 except Exception as e:
                     print(
                         f"Could not insert embedding for {chunk}\n"
@@ -0,0 +1,74 @@
+"""
+Check the search index for clips that are missing from it or were indexed
+from old content, with an old chunking strategy or with vectors of the
+wrong size.
+
+With --repair the affected clips are queued for scripts.index_worker.
+
+Run from the backend directory with
+    python -m scripts.audit_index --user-id <id> --repair
+"""
+
+import argparse
+import json
+
+from app.db.database import SessionLocal
+from app.index.audit import audit_index, repair_index
+from app.logging import setup_logging
+
+
+def main(user_id: str | None, samples: int, repair: bool, as_json: bool):
+    with SessionLocal() as db:
+        report = audit_index(db, user_id, samples)
+        if as_json:
+            print(json.dumps(report, indent=2))
+        else:
+            print(
+                f"{report['clips']} clips checked against "
+                f"{report['embedding_model']} chunked with "
+                f"{report['chunking_strategy']}"
+            )
+            for check, count in report["failing"].items():
+                sample = ", ".join(report["samples"].get(check, []))
+                print(f"  {check:<16} {count:>8}  {sample}")
+            for name, info in report["strategies"].items():
+                label = "current" if info["current"] else "stale"
+                if not info["known"]:
+                    label = "unknown"
+                print(f"  strategy {name}: {info['chunks']} chunks, {label}")
+            print(
+                "  vectors with wrong dimensions: "
+                f"{report['bad_dimension_vectors']}"
+            )
+
+        if repair:
+            jobs = repair_index(db, user_id)
+            clips = sum(job.total for job in jobs)
+            print(f"Queued {clips} clips in {len(jobs)} index jobs.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check the search index for missing or stale chunks."
+    )
+    parser.add_argument(
+        "--user-id", type=str, default=None, help="Only check this user."
+    )
+    parser.add_argument(
+        "--samples",
+        type=int,
+        default=5,
+        help="Clip ids listed for each failing check.",
+    )
+    parser.add_argument(
+        "--repair",
+        action="store_true",
+        help="Queue index jobs for every failing clip.",
+    )
+    parser.add_argument(
+        "--json", action="store_true", help="Print the report as JSON."
+    )
+    args = parser.parse_args()
+
+    setup_logging()
+    main(args.user_id, args.samples, args.repair, args.json)
@@ -0,0 +1,136 @@
+"""
+Compare chunking strategies on a sample corpus.
+
+For each strategy reports the number of chunks, the tokens sent to the
+embedding model and their estimated cost, and the latency of searching the
+chunks for sample queries. Queries are sentences taken from the clips, and
+hit rate is the fraction whose source clip appears in the top k results.
+
+The corpus is a Kindle clippings file when given, otherwise generated text.
+Point OPENAI_BASE_URL at scripts.mock_openai_server to run it offline.
+
+Run from the backend directory with
+    python -m scripts.benchmark_chunking --file "My Clippings.txt"
+"""
+
+import argparse
+import random
+import time
+
+import numpy as np
+
+from app.file_handlers.kindle_file_parser import iter_annotations_from_buffer
+from app.index import embedding_model
+from app.index.chunking import get_chunker
+from app.index.openai import num_tokens_from_string
+from app.index.preprocessing import split_sentences
+
+DEFAULT_STRATEGIES = [
+    "sent-group-3-overlap-1",
+    "sent-group-1-overlap-0",
+    "token-window-64-overlap-16",
+    "whole-clip",
+]
+
+WORDS = (
+    "the reader highlighted a passage about habits discipline memory "
+    "attention learning writing stoicism history economics science "
+    "progress craft practice curiosity notes ideas knowledge"
+).split()
+
+
+def generate_clips(n_clips: int, seed: int = 0) -> list[str]:
+    rng = random.Random(seed)
+    clips = []
+    for _ in range(n_clips):
+        sentences = [
+            " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 20)))
+            for _ in range(rng.randint(1, 6))
+        ]
+        clips.append(". ".join(s.capitalize() for s in sentences) + ".")
+    return clips
+
+
+def load_clips(filename: str, n_clips: int) -> list[str]:
+    with open(filename, "rb") as f:
+        clips = [a.content for a in iter_annotations_from_buffer(f)]
+    return clips[:n_clips]
+
+
+def run(
+    strategy: str,
+    clips: list[str],
+    queries: list[tuple[str, int]],
+    topk: int,
+    price_per_million: float,
+) -> None:
+    chunker = get_chunker(strategy)
+    start = time.perf_counter()
+    chunked = chunker.chunk_many(clips)
+    chunk_seconds = time.perf_counter() - start
+
+    chunks = [chunk for clip_chunks in chunked for chunk in clip_chunks]
+    owners = np.array(
+        [i for i, clip_chunks in enumerate(chunked) for _ in clip_chunks]
+    )
+    n_tokens = sum(num_tokens_from_string(chunk) for chunk in chunks)
+
+    start = time.perf_counter()
+    vectors = np.array(embedding_model.embed(chunks))
+    embed_seconds = time.perf_counter() - start
+    query_vectors = np.array(
+        embedding_model.embed_queries([query for query, _ in queries])
+    )
+
+    latencies = []
+    hits = 0
+    for query_vector, (_, owner) in zip(query_vectors, queries):
+        start = time.perf_counter()
+        scores = vectors @ query_vector
+        best = np.argpartition(-scores, min(topk, len(scores) - 1))[:topk]
+        latencies.append(time.perf_counter() - start)
+        hits += owner in owners[best]
+
+    latencies_ms = np.array(latencies) * 1000
+    print(
+        f"{chunker.strategy_id:<28} chunks={len(chunks):<7} "
+        f"tokens={n_tokens:<8} "
+        f"cost=${n_tokens / 1e6 * price_per_million:.4f} "
+        f"chunk={chunk_seconds:.2f}s embed={embed_seconds:.2f}s "
+        f"search_p50={np.percentile(latencies_ms, 50):.2f}ms "
+        f"search_p95={np.percentile(latencies_ms, 95):.2f}ms "
+        f"hit_rate@{topk}={hits / len(queries):.2f}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--file", type=str, help="Kindle clippings file.")
+    parser.add_argument("--n-clips", type=int, default=1000)
+    parser.add_argument("--n-queries", type=int, default=100)
+    parser.add_argument("--topk", type=int, default=5)
+    parser.add_argument(
+        "--price-per-million",
+        type=float,
+        default=0.02,
+        help="Embedding price in dollars per million tokens.",
+    )
+    parser.add_argument(
+        "--strategies", nargs="+", default=DEFAULT_STRATEGIES
+    )
+    args = parser.parse_args()
+
+    if args.file:
+        clips = load_clips(args.file, args.n_clips)
+    else:
+        clips = generate_clips(args.n_clips)
+
+    rng = random.Random(0)
+    queries = []
+    n_queries = min(args.n_queries, len(clips))
+    for owner in rng.sample(range(len(clips)), n_queries):
+        sentences = split_sentences(clips[owner]) or [clips[owner]]
+        queries.append((rng.choice(sentences), owner))
+
+    for strategy in args.strategies:
+        run(strategy, clips, queries, args.topk, args.price_per_million)
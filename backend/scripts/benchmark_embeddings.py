@@ -0,0 +1,74 @@
+"""
+Benchmark the throughput of the embedding model when embedding one input
+per request compared with packing inputs into batched requests.
+
+Run from the backend directory with
+    python -m scripts.benchmark_embeddings --n-texts 500
+"""
+
+import argparse
+import random
+import time
+
+from app.index import embedding_cache, embedding_model
+
+WORDS = (
+    "the reader highlighted a passage about habits discipline memory "
+    "attention learning writing stoicism history economics science "
+    "progress craft practice curiosity notes ideas knowledge"
+).split()
+
+
+def make_texts(n_texts: int, n_words: int, seed: int = 0) -> list[str]:
+    rng = random.Random(seed)
+    return [
+        " ".join(rng.choice(WORDS) for _ in range(n_words)) + f" {i}"
+        for i in range(n_texts)
+    ]
+
+
+class RequestCounter:
+    """Wraps the embeddings endpoint to count the requests made"""
+
+    def __init__(self, embeddings) -> None:
+        self._embeddings = embeddings
+        self.count = 0
+
+    def create(self, *args, **kwargs):
+        self.count += 1
+        return self._embeddings.create(*args, **kwargs)
+
+
+def run(name: str, texts: list[str], batched: bool) -> None:
+    counter = RequestCounter(embedding_model._client.embeddings)
+    original = embedding_model._client.embeddings
+    embedding_model._client.embeddings = counter
+    try:
+        start = time.perf_counter()
+        if batched:
+            embedding_model.embed(texts)
+        else:
+            for text in texts:
+                embedding_model.embed(text)
+        elapsed = time.perf_counter() - start
+    finally:
+        embedding_model._client.embeddings = original
+
+    print(
+        f"{name:<10} texts={len(texts)} requests={counter.count} "
+        f"time={elapsed:.2f}s "
+        f"requests/s={counter.count / elapsed:.2f} "
+        f"texts/s={len(texts) / elapsed:.2f}"
+    )
+    print(f"{'':<10} cache={embedding_cache.stats()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n-texts", type=int, default=200)
+    parser.add_argument("--n-words", type=int, default=40)
+    args = parser.parse_args()
+
+    # Different texts per run so neither run benefits from the other
+    run("sequential", make_texts(args.n_texts, args.n_words, 0), False)
+    run("batched", make_texts(args.n_texts, args.n_words, 1), True)
@@ -0,0 +1,105 @@
+"""
+Build or rebuild the approximate nearest neighbour index used for vector
+search. The new index is built concurrently and swapped in, so search keeps
+working while it builds.
+
+Rebuild an IVFFlat index after the number of vectors has grown a lot, as
+its lists are learnt from the vectors present when it was built.
+
+Run from the backend directory with
+    python -m scripts.build_vector_index --type hnsw --m 16
+    python -m scripts.build_vector_index --show
+"""
+
+import argparse
+
+from app.config import (
+    VECTOR_INDEX_HNSW_EF_CONSTRUCTION,
+    VECTOR_INDEX_HNSW_M,
+    VECTOR_INDEX_IVFFLAT_LISTS,
+    VECTOR_INDEX_TYPE,
+)
+from app.db.database import engine
+from app.index import vector_index
+from app.logging import setup_logging
+
+
+def main(
+    index_type: str,
+    storage: str | None,
+    m: int,
+    ef_construction: int,
+    lists: int,
+    maintenance_work_mem: str | None,
+    show: bool,
+):
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    with engine.connect().execution_options(
+        isolation_level="AUTOCOMMIT"
+    ) as connection:
+        if show:
+            definition = vector_index.get_vector_index(connection)
+            print(definition or "No vector index.")
+            return
+
+        definition = vector_index.build_vector_index(
+            connection,
+            index_type,
+            storage,
+            m,
+            ef_construction,
+            lists,
+            maintenance_work_mem,
+        )
+    print(f"Built {definition}" if definition else "Vector index dropped.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build the vector index on the chunk vectors."
+    )
+    parser.add_argument(
+        "--type",
+        choices=["hnsw", "ivfflat", "none"],
+        default=VECTOR_INDEX_TYPE,
+        help="Index type, or none to drop the index.",
+    )
+    parser.add_argument(
+        "--storage",
+        choices=list(vector_index.SEARCH_COLUMNS),
+        default=None,
+        help="Column to index. Defaults to the one RETRIEVAL_MODE searches.",
+    )
+    parser.add_argument("--m", type=int, default=VECTOR_INDEX_HNSW_M)
+    parser.add_argument(
+        "--ef-construction",
+        type=int,
+        default=VECTOR_INDEX_HNSW_EF_CONSTRUCTION,
+    )
+    parser.add_argument(
+        "--lists",
+        type=int,
+        default=VECTOR_INDEX_IVFFLAT_LISTS,
+        help="IVFFlat lists, 0 to size them from the number of vectors.",
+    )
+    parser.add_argument(
+        "--maintenance-work-mem",
+        type=str,
+        default=None,
+        help="Memory for the build, e.g. 2GB.",
+    )
+    parser.add_argument(
+        "--show", action="store_true", help="Print the current index."
+    )
+    args = parser.parse_args()
+
+    setup_logging()
+    main(
+        args.type,
+        args.storage,
+        args.m,
+        args.ef_construction,
+        args.lists,
+        args.maintenance_work_mem,
+        args.show,
+    )
@@ -0,0 +1,76 @@
+"""
+Imports a Kindle clippings file for a user and indexes the new clips in one
+streaming pass, printing the throughput of each stage.
+
+Run from the backend directory with
+    python -m scripts.import_pipeline --file "My Clippings.txt" --user-id ...
+"""
+
+import argparse
+import json
+
+from app.db.database import SessionLocal
+from app.file_handlers.kindle_file_parser import iter_annotations_from_buffer
+from app.index.pipeline import ImportPipeline
+from app.logging import setup_logging
+
+
+def main(
+    filename: str,
+    user_id: str,
+    clip_batch_size: int,
+    embed_batch_size: int,
+    queue_size: int,
+):
+    pipeline = ImportPipeline(
+        SessionLocal,
+        user_id,
+        clip_batch_size=clip_batch_size,
+        embed_batch_size=embed_batch_size,
+        queue_size=queue_size,
+    )
+    with open(filename, "rb") as f:
+        stats = pipeline.run(iter_annotations_from_buffer(f))
+
+    print(json.dumps(stats, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Import and index a Kindle clippings file."
+    )
+    parser.add_argument("--file", type=str, required=True)
+    parser.add_argument(
+        "--user-id",
+        type=str,
+        default="6d032281-9e69-4753-a455-b48f7cb9b5c9",
+        help="User ID to import the clips for.",
+    )
+    parser.add_argument(
+        "--clip-batch-size",
+        type=int,
+        default=500,
+        help="Clips inserted per statement.",
+    )
+    parser.add_argument(
+        "--embed-batch-size",
+        type=int,
+        default=1000,
+        help="Chunks sent to the embedding model at a time.",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=4,
+        help="Batches buffered between stages.",
+    )
+    args = parser.parse_args()
+
+    setup_logging()
+    main(
+        args.file,
+        args.user_id,
+        args.clip_batch_size,
+        args.embed_batch_size,
+        args.queue_size,
+    )
@@ -0,0 +1,103 @@
+"""
+Worker that chunks and embeds clips queued by the import endpoints. With
+--neighbours it also rebuilds out of date similar clip lists when there are
+no jobs.
+
+Workers claim jobs with SELECT ... FOR UPDATE SKIP LOCKED so several can run
+side by side. Run from the backend directory with
+    python -m scripts.index_worker
+"""
+
+import argparse
+import logging
+import time
+
+from app.db.database import SessionLocal
+from app.db import operations
+from app.index.index_job import index_stale_clips, run_index_job
+from app.index.neighbours import refresh_clip_neighbours
+from app.logging import setup_logging
+
+logger = logging.getLogger(__name__)
+
+
+def main(
+    poll_interval: float,
+    batch_size: int,
+    once: bool,
+    sweep: bool,
+    neighbours: bool,
+):
+    logger.info("Index worker started")
+    if sweep:
+        # Catch up on clips edited or imported while no worker was running
+        with SessionLocal() as db:
+            index_stale_clips(db, batch_size=batch_size)
+            deleted = operations.delete_orphan_chunk_vectors(db)
+            logger.info(f"Deleted {deleted} unused chunk vectors")
+
+    while True:
+        refreshed = 0
+        with SessionLocal() as db:
+            job = operations.claim_index_job(db)
+            if job:
+                try:
+                    run_index_job(db, job, batch_size)
+                except Exception:
+                    # The job is requeued or marked as failed, move on
+                    pass
+            elif neighbours:
+                # Rebuild similar clip lists between jobs
+                try:
+                    refreshed = refresh_clip_neighbours(db, limit=batch_size)
+                except Exception as e:
+                    logger.error(f"Could not refresh clip neighbours: {e}")
+
+        if once:
+            break
+        if not job and not refreshed:
+            time.sleep(poll_interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run queued indexing jobs."
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=2.0,
+        help="Seconds to wait when there are no queued jobs.",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=100,
+        help="Clips chunked and embedded per progress update.",
+    )
+    parser.add_argument(
+        "--once", action="store_true", help="Run at most one job then exit."
+    )
+    parser.add_argument(
+        "--sweep",
+        action="store_true",
+        help=(
+            "First index every clip with missing or stale embeddings and "
+            "delete unused chunk vectors."
+        ),
+    )
+    parser.add_argument(
+        "--neighbours",
+        action="store_true",
+        help="Keep the precomputed similar clips up to date when idle.",
+    )
+    args = parser.parse_args()
+
+    setup_logging()
+    main(
+        args.poll_interval,
+        args.batch_size,
+        args.once,
+        args.sweep,
+        args.neighbours,
+    )
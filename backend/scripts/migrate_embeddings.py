@@ -0,0 +1,139 @@
+"""
+Migrate embeddings to a new embedding model without downtime.
+
+1. Set EMBEDDING_MODEL to the new model and EMBEDDING_PREVIOUS_MODEL to the
+   old one and restart the app. Retrieval now reads from both.
+2. Run this script to fill in new model embeddings in throttled batches.
+   It can be stopped and restarted at any point.
+3. Run with --cutover to delete the old embeddings, then unset
+   EMBEDDING_PREVIOUS_MODEL and restart the app.
+
+--prepare brings the tables of an existing database up to date and is
+needed after upgrading whether or not the model is changing. Without
+EMBEDDING_PREVIOUS_MODEL it only prepares the tables.
+
+Run from the backend directory with
+    python -m scripts.migrate_embeddings --prepare
+    python -m scripts.migrate_embeddings --prepare --batch-size 100
+"""
+
+import argparse
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from app.config import DB_DRIVER, DB_USERNAME, DB_HOST, DB_NAME, DB_PORT
+from app.config import EMBEDDING_MODEL, EMBEDDING_PREVIOUS_MODEL
+from sqlalchemy.engine import URL
+
+from app.index import migration
+
+
+# Create database URL
+DB_URL = URL.create(
+    drivername=DB_DRIVER,
+    username=DB_USERNAME,
+    host=DB_HOST,
+    database=DB_NAME,
+    port=DB_PORT,
+)
+
+# Create engine and session
+engine = create_engine(DB_URL)
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+def main(
+    batch_size: int,
+    sleep: float,
+    max_batches: int | None,
+    prepare: bool,
+    cutover: bool,
+):
+    if prepare:
+        with SessionLocal() as db:
+            migration.prepare_embeddings_table(db)
+        print("Embeddings table prepared.")
+
+    if not EMBEDDING_PREVIOUS_MODEL:
+        if not prepare:
+            print("Set EMBEDDING_PREVIOUS_MODEL to the model to migrate from.")
+        return
+
+    print(f"Migrating from {EMBEDDING_PREVIOUS_MODEL} to {EMBEDDING_MODEL}")
+    with SessionLocal() as db:
+        if cutover:
+            deleted = migration.cutover(db)
+            print(
+                f"Deleted {deleted} embeddings. Unset "
+                "EMBEDDING_PREVIOUS_MODEL and restart the app."
+            )
+            return
+
+        remaining = migration.remaining_chunks(db)
+        print(f"{remaining} chunks to migrate.")
+        migrated = 0
+        batches = 0
+        start = time.perf_counter()
+        while max_batches is None or batches < max_batches:
+            n_migrated = migration.migrate_batch(db, batch_size)
+            if n_migrated == 0:
+                break
+
+            migrated += n_migrated
+            batches += 1
+            rate = migrated / (time.perf_counter() - start)
+            print(
+                f"Migrated {migrated} of {remaining} chunks "
+                f"({rate:.1f} chunks/s)"
+            )
+            time.sleep(sleep)
+
+    if migrated >= remaining:
+        print("Migration complete. Run with --cutover to finish.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Re-embed chunks with a new embedding model."
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=100,
+        help="Clips migrated per batch, with all their chunks.",
+    )
+    parser.add_argument(
+        "--sleep",
+        type=float,
+        default=1.0,
+        help="Seconds to wait between batches to limit load.",
+    )
+    parser.add_argument(
+        "--max-batches",
+        type=int,
+        default=None,
+        help="Stop after this many batches.",
+    )
+    parser.add_argument(
+        "--prepare",
+        action="store_true",
+        help=(
+            "Bring the tables of an existing database up to date first. "
+            "Runs on its own when EMBEDDING_PREVIOUS_MODEL is unset."
+        ),
+    )
+    parser.add_argument(
+        "--cutover",
+        action="store_true",
+        help="Delete the previous model's embeddings once migrated.",
+    )
+    args = parser.parse_args()
+
+    main(
+        args.batch_size,
+        args.sleep,
+        args.max_batches,
+        args.prepare,
+        args.cutover,
+    )
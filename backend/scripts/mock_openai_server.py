@@ -0,0 +1,234 @@
+"""
+Local stand in for the OpenAI API so the indexing pipeline and
+conversations can be load tested and benchmarked offline.
+
+Implements /v1/embeddings and /v1/chat/completions with deterministic
+outputs: the same input always gives the same embedding or completion.
+Latency, error rates and completion token throughput are configurable.
+
+Run from the backend directory with
+    python -m scripts.mock_openai_server --port 8100 --latency-ms 50
+
+then point the app at it by setting OPENAI_BASE_URL=http://localhost:8100/v1
+"""
+
+import argparse
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import time
+
+import numpy as np
+
+
+def count_tokens(text: str) -> int:
+    """Rough token count, about four characters per token."""
+    return max(1, len(text) // 4)
+
+
+def deterministic_embedding(text: str, dimensions: int) -> list[float]:
+    """Unit length vector seeded from the hash of the text."""
+    seed = int(hashlib.md5(text.encode()).hexdigest()[:8], 16)
+    vector = np.random.default_rng(seed).standard_normal(dimensions)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def deterministic_completion(messages: list[dict]) -> str:
+    """Builds a reply from the last user message."""
+    user_messages = [m for m in messages if m.get("role") == "user"]
+    prompt = str(user_messages[-1]["content"]) if user_messages else ""
+    digest = hashlib.md5(prompt.encode()).hexdigest()
+    lines = [line.strip() for line in prompt.splitlines() if line.strip()]
+    last_line = lines[-1] if lines else ""
+    return (
+        f"Mock response {digest[:8]}\n"
+        f"{last_line[:200]}\n"
+        "No sources were used for this answer."
+    )
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    # Set from the command line arguments
+    options: argparse.Namespace
+
+    def log_message(self, format, *args) -> None:
+        if self.options.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status: int, body: dict, headers=None) -> None:
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _simulate_latency(self) -> None:
+        latency = self.options.latency_ms + random.uniform(
+            -self.options.jitter_ms, self.options.jitter_ms
+        )
+        if latency > 0:
+            time.sleep(latency / 1000)
+
+    def _simulate_error(self) -> bool:
+        """Returns True if an error response was sent."""
+        roll = random.random()
+        if roll < self.options.rate_limit_rate:
+            self._send_json(
+                429,
+                {
+                    "error": {
+                        "message": "Rate limit reached (mock)",
+                        "type": "requests",
+                        "code": "rate_limit_exceeded",
+                    }
+                },
+                headers={"retry-after": str(self.options.retry_after)},
+            )
+            return True
+        if roll < self.options.rate_limit_rate + self.options.error_rate:
+            self._send_json(
+                500,
+                {
+                    "error": {
+                        "message": "Internal server error (mock)",
+                        "type": "server_error",
+                    }
+                },
+            )
+            return True
+        return False
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+
+        self._simulate_latency()
+        if self._simulate_error():
+            return
+
+        if self.path.endswith("/embeddings"):
+            self._handle_embeddings(body)
+        elif self.path.endswith("/chat/completions"):
+            self._handle_chat_completion(body)
+        else:
+            self._send_json(404, {"error": {"message": "Not found"}})
+
+    def _handle_embeddings(self, body: dict) -> None:
+        inputs = body.get("input", [])
+        if isinstance(inputs, str):
+            inputs = [inputs]
+
+        dimensions = body.get("dimensions") or self.options.dimensions
+        texts = [str(text) for text in inputs]
+        n_tokens = sum(count_tokens(text) for text in texts)
+        self._send_json(
+            200,
+            {
+                "object": "list",
+                "data": [
+                    {
+                        "object": "embedding",
+                        "index": index,
+                        "embedding": deterministic_embedding(
+                            text, dimensions
+                        ),
+                    }
+                    for index, text in enumerate(texts)
+                ],
+                "model": body.get("model", "mock-embedding"),
+                "usage": {"prompt_tokens": n_tokens, "total_tokens": n_tokens},
+            },
+        )
+
+    def _handle_chat_completion(self, body: dict) -> None:
+        messages = body.get("messages", [])
+        content = deterministic_completion(messages)
+        prompt_tokens = sum(
+            count_tokens(str(m.get("content", ""))) for m in messages
+        )
+        completion_tokens = count_tokens(content)
+
+        # Simulate the time taken to generate the completion
+        if self.options.tokens_per_second > 0:
+            time.sleep(completion_tokens / self.options.tokens_per_second)
+
+        digest = hashlib.md5(content.encode()).hexdigest()
+        self._send_json(
+            200,
+            {
+                "id": f"chatcmpl-mock-{digest[:12]}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", "mock-chat"),
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+            },
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Offline stand in for the OpenAI API."
+    )
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument(
+        "--dimensions",
+        type=int,
+        default=1536,
+        help="Embedding size when the request does not specify one.",
+    )
+    parser.add_argument(
+        "--latency-ms", type=float, default=0, help="Latency per request."
+    )
+    parser.add_argument(
+        "--jitter-ms", type=float, default=0, help="Random +/- latency."
+    )
+    parser.add_argument(
+        "--rate-limit-rate",
+        type=float,
+        default=0,
+        help="Fraction of requests rejected with a 429.",
+    )
+    parser.add_argument(
+        "--retry-after",
+        type=float,
+        default=1,
+        help="Seconds sent in the retry-after header of 429s.",
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0,
+        help="Fraction of requests failing with a 500.",
+    )
+    parser.add_argument(
+        "--tokens-per-second",
+        type=float,
+        default=0,
+        help="Completion token throughput. 0 returns immediately.",
+    )
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    MockOpenAIHandler.options = args
+    server = ThreadingHTTPServer((args.host, args.port), MockOpenAIHandler)
+    print(f"Mock OpenAI server listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,175 @@
+"""
+Rebuild the embeddings of one user, several users or everyone.
+
+Clips are split into one shard per worker and each shard is re-chunked and
+re-embedded by its own process. Progress is checkpointed to the
+reindex_checkpoint table after every batch, so running the same command
+again after a crash resumes where it stopped. Once a run has completed,
+running it again does nothing unless --restart is passed. Chunks whose text
+was embedded before reuse the stored vector.
+
+Run from the backend directory with
+    python -m scripts.reindex --user-id <id> --workers 4
+    python -m scripts.reindex --all --workers 8
+"""
+
+import argparse
+from concurrent.futures import FIRST_EXCEPTION, ProcessPoolExecutor, wait
+from datetime import timedelta
+import logging
+import time
+
+from app.db.database import SessionLocal, engine
+from app.db import operations
+from app.index import reindex
+from app.logging import setup_logging
+
+logger = logging.getLogger(__name__)
+
+
+def init_worker() -> None:
+    # Connections inherited from the parent must not be reused
+    engine.dispose(close=False)
+    setup_logging()
+
+
+def reindex_shard(run_id: str, shard: int, batch_size: int) -> int:
+    with SessionLocal() as db:
+        return reindex.reindex_shard(db, run_id, shard, batch_size)
+
+
+def print_progress(
+    progress: dict[str, int], start_processed: int, elapsed: float
+) -> None:
+    done = progress["processed"] - start_processed
+    remaining = progress["total"] - progress["processed"]
+    rate = done / elapsed if elapsed else 0.0
+    eta = timedelta(seconds=int(remaining / rate)) if rate else "unknown"
+    print(
+        f"{progress['processed']}/{progress['total']} clips, "
+        f"{progress['completed']}/{progress['shards']} shards done, "
+        f"{rate:.1f} clips/s, ETA {eta}",
+        flush=True,
+    )
+
+
+def main(
+    user_ids: list[str] | None,
+    workers: int,
+    batch_size: int,
+    run_id: str | None,
+    restart: bool,
+    report_interval: float,
+):
+    run_id = run_id or reindex.default_run_id(user_ids)
+    with SessionLocal() as db:
+        if restart:
+            operations.delete_reindex_checkpoints(db, run_id)
+        checkpoints = reindex.start_run(db, run_id, workers, user_ids)
+        shards = [c.shard for c in checkpoints if c.status != "completed"]
+        progress = reindex.run_progress(db, run_id)
+        finished_at = max(c.updated_at for c in checkpoints)
+
+    if not shards:
+        # The default run id only changes with the users, embedding model
+        # and chunking strategy, so a finished run is found again
+        print(
+            f"Reindex run {run_id} already completed {progress['processed']} "
+            f"clips at {finished_at:%Y-%m-%d %H:%M:%S}, nothing was indexed. "
+            "Pass --restart to rebuild it again."
+        )
+        return
+    print(f"Reindex run {run_id}: {len(shards)} shards to index")
+    start_processed = progress["processed"]
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(
+        max_workers=min(workers, len(shards)), initializer=init_worker
+    ) as executor:
+        futures = [
+            executor.submit(reindex_shard, run_id, shard, batch_size)
+            for shard in shards
+        ]
+        pending = futures
+        while pending:
+            _, pending = wait(
+                pending, timeout=report_interval, return_when=FIRST_EXCEPTION
+            )
+            with SessionLocal() as db:
+                progress = reindex.run_progress(db, run_id)
+            print_progress(
+                progress, start_processed, time.perf_counter() - start
+            )
+            if any(f.done() and f.exception() for f in futures):
+                # Let the other shards finish, a rerun retries the failures
+                logger.error("A shard failed, waiting for the others")
+                wait(pending)
+                break
+
+    for future in futures:
+        if future.exception():
+            print(
+                f"Reindex run {run_id} did not finish: {future.exception()}. "
+                "Run the same command again to resume."
+            )
+            return
+    print(f"Reindex run {run_id} complete.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Re-chunk and re-embed every clip of some users."
+    )
+    scope = parser.add_mutually_exclusive_group(required=True)
+    scope.add_argument(
+        "--user-id",
+        action="append",
+        dest="user_ids",
+        help="User to reindex. Repeat for several users.",
+    )
+    scope.add_argument(
+        "--all", action="store_true", help="Reindex every user."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Worker processes, and shards of a new run.",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=100,
+        help="Clips chunked and embedded per checkpoint.",
+    )
+    parser.add_argument(
+        "--run-id",
+        type=str,
+        default=None,
+        help=(
+            "Checkpoint name. Defaults to one derived from the users, "
+            "embedding model and chunking strategy."
+        ),
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="Discard the run's checkpoints and start from the beginning.",
+    )
+    parser.add_argument(
+        "--report-interval",
+        type=float,
+        default=5.0,
+        help="Seconds between progress reports.",
+    )
+    args = parser.parse_args()
+
+    setup_logging()
+    main(
+        args.user_ids,
+        args.workers,
+        args.batch_size,
+        args.run_id,
+        args.restart,
+        args.report_interval,
+    )
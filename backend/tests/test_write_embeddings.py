@@ -0,0 +1,109 @@
+"""
+Round trip tests of the bulk embedding writers against a postgres database
+with pgvector, configured with the same DB_* settings as the app. They are
+skipped when the database cannot be reached. Each test runs in a
+transaction that is rolled back afterwards.
+
+Run from the backend directory with
+    python -m pytest tests
+"""
+
+import pytest
+
+psycopg2 = pytest.importorskip("psycopg2")
+
+from app.config import (  # noqa: E402
+    DB_HOST,
+    DB_NAME,
+    DB_PORT,
+    DB_USERNAME,
+    EMBEDDING_DIMENSIONS,
+)
+
+try:
+    psycopg2.connect(
+        dbname=DB_NAME, user=DB_USERNAME, host=DB_HOST, port=DB_PORT
+    ).close()
+except psycopg2.OperationalError:
+    pytest.skip("No database to test against", allow_module_level=True)
+
+from sqlalchemy import select  # noqa: E402
+from sqlalchemy.orm import Session  # noqa: E402
+
+from app.db import models, operations  # noqa: E402
+from app.db.database import engine  # noqa: E402
+from app.utils import hash_content  # noqa: E402
+
+MODEL = "test-model"
+
+
+@pytest.fixture
+def db():
+    connection = engine.connect()
+    transaction = connection.begin()
+    # Commits in the code under test only release a savepoint
+    session = Session(
+        bind=connection, join_transaction_mode="create_savepoint"
+    )
+    yield session
+    session.close()
+    transaction.rollback()
+    connection.close()
+
+
+@pytest.fixture
+def clip(db):
+    user = models.User(email="test@example.com", hashed_password="hash")
+    db.add(user)
+    db.flush()
+    book = models.Book(title="Book", user_id=user.id)
+    db.add(book)
+    db.flush()
+    clip = models.Clip(
+        user_id=user.id,
+        document_id=book.id,
+        content="A highlight.",
+        content_hash=hash_content("A highlight."),
+    )
+    db.add(clip)
+    db.flush()
+    return clip
+
+
+@pytest.mark.parametrize("method", ["copy", "insert"])
+def test_insert_embeddings_keeps_nulls(db, clip, method):
+    chunk_hash = hash_content(f"A chunk written with {method}")
+    vector = models.ChunkVector(
+        chunk_hash=chunk_hash,
+        embedding_model=MODEL,
+        embedding_dimensions=None,
+        embedding=[0.5] * EMBEDDING_DIMENSIONS,
+    )
+    row = models.Embedding(
+        source_id=clip.id,
+        user_id=clip.user_id,
+        chunk_content=f'A "chunk", written with {method}',
+        cleaned_chunk="",
+        chunking_strategy=None,
+        embedding_model=MODEL,
+        embedding_dimensions=None,
+        source_hash=None,
+        chunk_hash=chunk_hash,
+        token_count=None,
+    )
+
+    inserted = operations.insert_embeddings(db, [row], [vector], method)
+
+    assert inserted == 1
+    stored = db.scalars(
+        select(models.Embedding).where(models.Embedding.source_id == clip.id)
+    ).one()
+    assert stored.chunk_content == f'A "chunk", written with {method}'
+    assert stored.cleaned_chunk == ""
+    assert stored.chunking_strategy is None
+    assert stored.embedding_dimensions is None
+    assert stored.source_hash is None
+    assert stored.token_count is None
+    stored_vector = db.get(models.ChunkVector, (chunk_hash, MODEL))
+    assert stored_vector.embedding_dimensions is None
+    assert list(stored_vector.embedding) == [0.5] * EMBEDDING_DIMENSIONS